@@ -0,0 +1,88 @@
+"""
+Per-request signing and verification cost of RSA and EC keys,
+as paid by the token, userinfo and fetch endpoints.
+
+    python benchmarks/bench_jws_algs.py --requests 400
+
+Results are printed as JSON.
+"""
+import argparse
+import json
+import sys
+import time
+
+import django
+from django.conf import settings
+
+if not settings.configured:
+    settings.configure()
+    django.setup()
+
+from spid_cie_oidc.entity.jwks import (  # noqa: E402
+    create_jwk,
+    default_jws_alg,
+    public_jwk_from_private_jwk
+)
+from spid_cie_oidc.entity.jwtse import JwsSigner, verify_jws  # noqa: E402
+
+KEYS = (
+    ("RSA", None),
+    ("EC", "P-256"),
+    ("EC", "P-384"),
+)
+
+
+def _payload(n: int) -> dict:
+    return {
+        "iss": "https://op.example.org/",
+        "sub": "a0d6e3c1b1b1e0a7c4e0",
+        "aud": ["https://rp.example.org/"],
+        "jti": str(n),
+    }
+
+
+def timed(func, requests: int) -> float:
+    start = time.perf_counter()
+    for i in range(requests):
+        func(i)
+    return time.perf_counter() - start
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=400)
+    parser.add_argument("--keys", type=int, default=5)
+    args = parser.parse_args(argv)
+
+    signer = JwsSigner()
+    results = []
+    for kty, crv in KEYS:
+        keygen = timed(lambda i: create_jwk(kty=kty, crv=crv), args.keys)
+        jwk = create_jwk(kty=kty, crv=crv)
+        pub = public_jwk_from_private_jwk(jwk)
+        # loads the key before measuring
+        jws = signer.sign(_payload(0), jwk)
+        sign = timed(lambda i: signer.sign(_payload(i), jwk), args.requests)
+        verify = timed(lambda i: verify_jws(jws, pub), args.requests)
+        results.append(
+            {
+                "alg": default_jws_alg(jwk),
+                "kty": kty,
+                "crv": crv,
+                "keygen_ms": round(keygen * 1000 / args.keys, 3),
+                "sign_ms": round(sign * 1000 / args.requests, 3),
+                "verify_ms": round(verify * 1000 / args.requests, 3),
+                "jws_bytes": len(jws),
+            }
+        )
+
+    json.dump(
+        {"benchmark": "jws_algs", "requests": args.requests, "results": results},
+        sys.stdout,
+        indent=2,
+    )
+    sys.stdout.write("\n")
+
+
+if __name__ == "__main__":
+    main()
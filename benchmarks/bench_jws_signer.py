@@ -0,0 +1,106 @@
+"""
+Throughput of the JWS signing services compared with the inline path.
+
+    python benchmarks/bench_jws_signer.py --requests 400 --workers 4
+
+Results are printed as JSON.
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+
+import django
+from django.conf import settings
+
+if not settings.configured:
+    settings.configure()
+    django.setup()
+
+from spid_cie_oidc.entity.jwks import create_jwk  # noqa: E402
+from spid_cie_oidc.entity.jwtse import (  # noqa: E402
+    JwsSignerServer,
+    JwsSigner,
+    ProcessPoolJwsSigner,
+    UnixSocketJwsSigner,
+    create_jws
+)
+
+
+def _payload(n: int) -> dict:
+    return {
+        "iss": "https://op.example.org/",
+        "sub": "a0d6e3c1b1b1e0a7c4e0",
+        "aud": ["https://rp.example.org/"],
+        "jti": str(n),
+    }
+
+
+def run(name: str, func, requests: int) -> dict:
+    start = time.perf_counter()
+    func(requests)
+    elapsed = time.perf_counter() - start
+    return {
+        "name": name,
+        "requests": requests,
+        "seconds": round(elapsed, 4),
+        "per_second": round(requests / elapsed, 2),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=400)
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--batch", type=int, default=20)
+    args = parser.parse_args(argv)
+
+    jwk = create_jwk()
+    requests = [dict(payload=_payload(i), jwk_dict=jwk) for i in range(args.batch)]
+
+    def batched(signer):
+        def _run(n):
+            for _ in range(n // args.batch):
+                signer.sign_many(requests)
+        return _run
+
+    results = [
+        run(
+            "create_jws",
+            lambda n: [create_jws(_payload(i), jwk) for i in range(n)],
+            args.requests,
+        ),
+        run("inline", batched(JwsSigner()), args.requests),
+    ]
+
+    pool = ProcessPoolJwsSigner(max_workers=args.workers, jwks=[jwk])
+    # spawns the processes before measuring
+    pool.sign_many(requests)
+    results.append(run("process_pool", batched(pool), args.requests))
+    pool.shutdown()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, "signer.sock")
+        server = JwsSignerServer(path, jwks=[jwk], max_workers=args.workers)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        signer = UnixSocketJwsSigner(path)
+        signer.sign_many(requests)
+        results.append(run("unix_socket", batched(signer), args.requests))
+        server.shutdown()
+        server.server_close()
+        thread.join()
+
+    json.dump(
+        {"benchmark": "jws_signer", "workers": args.workers, "results": results},
+        sys.stdout,
+        indent=2,
+    )
+    sys.stdout.write("\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,181 @@
+"""
+Trust Chain resolution cost over a synthetic federation,
+see mock_federation.py, served on localhost with an injectable latency.
+
+    python benchmarks/bench_trust_chain.py --depth 2 --fanout 3 --leaves 20 --latency 5
+
+Measures, for each leaf:
+ - builder: TrustChainBuilder.start(), discovery and policy application
+ - policy: TrustChainBuilder.apply_metadata_policy() over the built chain
+ - persistence: the statements and the TrustChain stored in the DB
+ - get_or_create: get_or_create_trust_chain() without a chain in the DB
+ - get_or_create_cached: get_or_create_trust_chain() with a valid chain in the DB
+
+Results are printed as JSON.
+"""
+import argparse
+import json
+import statistics
+import sys
+import time
+
+import django
+from django.conf import settings
+
+if not settings.configured:
+    settings.configure(
+        DATABASES={
+            "default": {"ENGINE": "django.db.backends.sqlite3", "NAME": ":memory:"}
+        },
+        INSTALLED_APPS=[
+            "django.contrib.auth",
+            "django.contrib.contenttypes",
+            "spid_cie_oidc.entity",
+        ],
+        USE_TZ=True,
+    )
+    django.setup()
+
+from django.core.management import call_command  # noqa: E402
+from django.utils import timezone  # noqa: E402
+
+from mock_federation import MockFederation  # noqa: E402
+from spid_cie_oidc.entity.models import (  # noqa: E402
+    FetchedEntityStatement,
+    TrustChain
+)
+from spid_cie_oidc.entity.statements import (  # noqa: E402
+    EntityConfiguration,
+    get_entity_configurations
+)
+from spid_cie_oidc.entity.trust_chain import TrustChainBuilder  # noqa: E402
+from spid_cie_oidc.entity.trust_chain_operations import (  # noqa: E402
+    dumps_statements_from_trust_chain_to_db,
+    get_or_create_trust_chain
+)
+
+
+def timed(func) -> tuple:
+    start = time.perf_counter()
+    res = func()
+    return (time.perf_counter() - start) * 1000, res
+
+
+def summary(values: list) -> dict:
+    values = sorted(values)
+
+    def _pct(p):
+        return round(values[min(len(values) - 1, int(len(values) * p))], 3)
+
+    return {
+        "count": len(values),
+        "mean_ms": round(statistics.mean(values), 3),
+        "p50_ms": _pct(0.50),
+        "p95_ms": _pct(0.95),
+        "max_ms": round(values[-1], 3),
+    }
+
+
+def persist(builder: TrustChainBuilder, trust_anchor: FetchedEntityStatement):
+    dumps_statements_from_trust_chain_to_db(builder)
+    return TrustChain.objects.create(
+        sub=builder.subject,
+        trust_anchor=trust_anchor,
+        exp=builder.exp_datetime,
+        processing_start=timezone.localtime(),
+        chain=builder.serialize(),
+        jwks=builder.subject_configuration.jwks,
+        metadata=builder.final_metadata,
+        parties_involved=[i.sub for i in builder.trust_path],
+        status="valid",
+        is_active=True,
+    )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--depth", type=int, default=1, help="intermediate levels")
+    parser.add_argument("--fanout", type=int, default=2)
+    parser.add_argument("--leaves", type=int, default=10)
+    parser.add_argument("--authority-hints", type=int, default=1)
+    parser.add_argument("--latency", type=float, default=0, help="in milliseconds")
+    parser.add_argument("--kty", default=None, help="RSA or EC, the default is RSA")
+    parser.add_argument("--crv", default=None)
+    args = parser.parse_args(argv)
+
+    call_command("migrate", verbosity=0)
+    results = {
+        i: [] for i in (
+            "builder", "policy", "persistence", "get_or_create", "get_or_create_cached"
+        )
+    }
+    start = time.perf_counter()
+    federation = MockFederation(
+        depth=args.depth,
+        fanout=args.fanout,
+        leaves=args.leaves,
+        authority_hints=args.authority_hints,
+        kty=args.kty,
+        crv=args.crv,
+    )
+    keygen = time.perf_counter() - start
+    invalid = 0
+
+    with federation.serve(latency=args.latency / 1000):
+        ta_id = federation.entity_id(federation.trust_anchor)
+        ta_conf = EntityConfiguration(get_entity_configurations([ta_id])[0])
+        for leaf in federation.leaves:
+            sub = federation.entity_id(leaf)
+            builder = TrustChainBuilder(sub, trust_anchor=ta_conf)
+            elapsed, _ = timed(builder.start)
+            if not builder.is_valid:
+                invalid += 1
+                continue
+            results["builder"].append(elapsed)
+
+            path = builder.trust_path
+
+            def _policy():
+                builder.trust_path = []
+                return builder.apply_metadata_policy()
+
+            results["policy"].append(timed(_policy)[0])
+            builder.trust_path = path
+
+            # get_or_create_trust_chain() stores the Trust Anchor, once
+            get_or_create_trust_chain(sub, ta_id)
+            TrustChain.objects.filter(sub=sub).delete()
+            fetched_ta = FetchedEntityStatement.objects.get(sub=ta_id, iss=ta_id)
+            results["persistence"].append(
+                timed(lambda: persist(builder, fetched_ta))[0]
+            )
+
+            TrustChain.objects.filter(sub=sub).delete()
+            results["get_or_create"].append(
+                timed(lambda: get_or_create_trust_chain(sub, ta_id))[0]
+            )
+            results["get_or_create_cached"].append(
+                timed(lambda: get_or_create_trust_chain(sub, ta_id))[0]
+            )
+
+    json.dump(
+        {
+            "benchmark": "trust_chain",
+            "federation": dict(
+                federation.as_dict(),
+                fanout=args.fanout,
+                authority_hints=args.authority_hints,
+                keygen_seconds=round(keygen, 3),
+            ),
+            "latency_ms": args.latency,
+            "invalid_chains": invalid,
+            "results": {k: summary(v) for k, v in results.items() if v},
+        },
+        sys.stdout,
+        indent=2,
+    )
+    sys.stdout.write("\n")
+
+
+if __name__ == "__main__":
+    main()
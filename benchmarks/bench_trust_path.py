@@ -0,0 +1,104 @@
+"""
+Trust path search cost over wide synthetic trust graphs,
+without network: each entity of a level is verified by all the ones
+of the level above, the worst case for the search.
+
+    python benchmarks/bench_trust_path.py --depth 2 --widths 10 50 100 200
+
+Measures, for each width:
+ - shortest: TrustGraph.get_path(), the path used by the TrustChainBuilder
+ - all: TrustGraph.get_paths(), only if the paths are at most --max-paths
+and the entities visited by them, bounded by the entities of the graph.
+
+Results are printed as JSON.
+"""
+import argparse
+import json
+import sys
+import time
+from types import SimpleNamespace
+
+import django
+from django.conf import settings
+
+if not settings.configured:
+    settings.configure()
+    django.setup()
+
+from spid_cie_oidc.entity.trust_chain import TrustGraph  # noqa: E402
+
+
+def layered_graph(depth: int, width: int) -> TrustGraph:
+    """
+    a leaf, depth levels of width intermediaries and a trust anchor
+    """
+    graph = TrustGraph()
+    above = [SimpleNamespace(sub="ta")]
+    for level in range(depth, 0, -1):
+        entities = [SimpleNamespace(sub=f"int-{level}-{i}") for i in range(width)]
+        for ent in entities:
+            graph.add(
+                SimpleNamespace(
+                    sub=ent.sub, verified_by_superiors={i.sub: i for i in above}
+                )
+            )
+        above = entities
+    graph.add(
+        SimpleNamespace(sub="leaf", verified_by_superiors={i.sub: i for i in above})
+    )
+    return graph
+
+
+def timed(func, repeat: int) -> tuple:
+    start = time.perf_counter()
+    for _ in range(repeat):
+        res = func()
+    return round((time.perf_counter() - start) * 1000 / repeat, 4), res
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--depth", type=int, default=2, help="intermediate levels")
+    parser.add_argument(
+        "--widths", type=int, nargs="+", default=[10, 50, 100, 200, 400]
+    )
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--max-paths", type=int, default=100000)
+    args = parser.parse_args(argv)
+
+    results = []
+    for width in args.widths:
+        graph = layered_graph(args.depth, width)
+        entities = args.depth * width + 2
+        edges = sum(len(i) for i in graph.superiors.values())
+
+        shortest_ms, path = timed(
+            lambda: graph.get_path("leaf", "ta", args.depth), args.repeat
+        )
+        res = {
+            "width": width,
+            "entities": entities,
+            "edges": edges,
+            "path_len": len(path),
+            "shortest_ms": shortest_ms,
+            "shortest_visited": graph.visited,
+        }
+        if width ** args.depth <= args.max_paths:
+            all_ms, paths = timed(
+                lambda: graph.get_paths("leaf", "ta", args.depth), 1
+            )
+            res.update(
+                paths=len(paths), all_ms=all_ms, all_visited=graph.visited
+            )
+        results.append(res)
+
+    json.dump(
+        {"benchmark": "trust_path", "depth": args.depth, "results": results},
+        sys.stdout,
+        indent=2,
+    )
+    sys.stdout.write("\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,284 @@
+"""
+End-to-end login load test of the OP and the RP of the example
+federation_authority project, that hosts the Trust Anchor, the OP and the RP.
+
+    python benchmarks/load_login.py --logins 200 --concurrency 8
+
+The project is served by a threaded WSGI server on 127.0.0.1:8000,
+the entity ids of examples/federation_authority/dumps/example.json,
+with a new sqlite DB where the dump is loaded, so no outside network is needed.
+It requires examples/federation_authority/federation_authority/settingslocal.py (not versioned),
+copied from settingslocal.py.example.
+
+Each virtual user drives the whole flow, rp_begin, authz, login, consent,
+the callback with the token and userinfo back-channel requests of the RP, then logs out.
+The first login is a warm up that builds the trust chains.
+
+Results are printed as JSON: the throughput, the percentiles of each step
+measured by the user agent and of each endpoint measured by the server,
+with its DB queries.
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from html.parser import HTMLParser
+from urllib.parse import urljoin, urlparse
+
+import requests
+
+PROJECT_DIR = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    "examples",
+    "federation_authority",
+)
+SETTINGSLOCAL = os.path.join(PROJECT_DIR, "federation_authority", "settingslocal.py")
+if not os.path.exists(SETTINGSLOCAL):
+    sys.exit(
+        f"{SETTINGSLOCAL} not found, "
+        "copy it from settingslocal.py.example before running the load test"
+    )
+sys.path.insert(0, PROJECT_DIR)
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "federation_authority.settings")
+
+import django  # noqa: E402
+from django.conf import settings  # noqa: E402
+
+DB_PATH = os.path.join(tempfile.mkdtemp(), "load_login.sqlite3")
+settings.DATABASES["default"] = {
+    "ENGINE": "django.db.backends.sqlite3",
+    "NAME": DB_PATH,
+    "OPTIONS": {"timeout": 30},
+}
+settings.LOGGING = {"version": 1, "disable_existing_loggers": True}
+django.setup()
+
+from django.core.management import call_command  # noqa: E402
+from django.core.servers.basehttp import (  # noqa: E402
+    ThreadedWSGIServer,
+    WSGIRequestHandler
+)
+from django.core.wsgi import get_wsgi_application  # noqa: E402
+from django.db import connection  # noqa: E402
+
+HOST = "127.0.0.1"
+PORT = 8000
+BASE_URL = f"http://{HOST}:{PORT}"
+PROVIDER = f"{BASE_URL}/oidc/op"
+
+ENDPOINTS = {
+    "/oidc/rp/authorization": "rp_begin",
+    "/oidc/op/authorization": "authz",
+    "/oidc/op/consent": "consent",
+    "/oidc/op/token": "token",
+    "/oidc/op/userinfo": "userinfo",
+    "/oidc/rp/callback": "callback",
+}
+
+
+def percentiles(values: list) -> dict:
+    values = sorted(values)
+
+    def _pct(p):
+        return round(values[min(len(values) - 1, int(len(values) * p))], 3)
+
+    return {
+        "count": len(values),
+        "mean_ms": round(statistics.mean(values), 3),
+        "p50_ms": _pct(0.50),
+        "p95_ms": _pct(0.95),
+        "p99_ms": _pct(0.99),
+    }
+
+
+class Stats:
+    """
+    durations and DB queries of each endpoint, collected by the server threads
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.enabled = False
+        self.durations = defaultdict(list)
+        self.queries = defaultdict(list)
+
+    def add(self, name: str, elapsed: float, queries: int):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.durations[name].append(elapsed * 1000)
+            self.queries[name].append(queries)
+
+    def as_dict(self) -> dict:
+        res = {}
+        for name, values in sorted(self.durations.items()):
+            res[name] = percentiles(values)
+            res[name]["queries_mean"] = round(statistics.mean(self.queries[name]), 2)
+            res[name]["queries_max"] = max(self.queries[name])
+        return res
+
+
+def instrumented(app, stats: Stats):
+    def wsgi(environ, start_response):
+        name = ENDPOINTS.get(environ["PATH_INFO"], environ["PATH_INFO"])
+        name = f"{environ['REQUEST_METHOD']} {name}"
+        counter = [0]
+
+        def _count(execute, sql, params, many, context):
+            counter[0] += 1
+            return execute(sql, params, many, context)
+
+        start = time.perf_counter()
+        with connection.execute_wrapper(_count):
+            response = app(environ, start_response)
+        stats.add(name, time.perf_counter() - start, counter[0])
+        return response
+
+    return wsgi
+
+
+class QuietHandler(WSGIRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+class FormParser(HTMLParser):
+    """
+    the inputs of the forms of the login and consent pages
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.inputs = {}
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        if tag == "input" and attrs.get("name"):
+            self.inputs[attrs["name"]] = attrs.get("value") or ""
+
+
+def form_inputs(html: str) -> dict:
+    parser = FormParser()
+    parser.feed(html)
+    return parser.inputs
+
+
+class UserAgent:
+    def __init__(self, username: str, password: str):
+        self.username = username
+        self.password = password
+        self.steps = defaultdict(list)
+
+    def _step(self, name: str, method: str, url: str, expected: int = 302, **kwargs):
+        start = time.perf_counter()
+        res = self.session.request(method, url, allow_redirects=False, **kwargs)
+        self.steps[name].append((time.perf_counter() - start) * 1000)
+        if res.status_code != expected:
+            raise Exception(f"{name}: {res.status_code} from {url}")
+        return res
+
+    def _location(self, res) -> str:
+        return urljoin(res.url, res.headers["Location"])
+
+    def login(self):
+        self.session = requests.Session()
+        res = self._step(
+            "rp_begin", "GET", f"{BASE_URL}/oidc/rp/authorization",
+            params={"provider": PROVIDER, "profile": "spid"},
+        )
+        res = self._step("authz", "GET", self._location(res), expected=200)
+        data = form_inputs(res.text)
+        data.update(username=self.username, password=self.password)
+        res = self._step(
+            "login", "POST", f"{BASE_URL}/oidc/op/authorization",
+            data=data, headers={"Referer": res.url},
+        )
+        consent_url = self._location(res)
+        res = self._step("consent", "GET", consent_url, expected=200)
+        data = form_inputs(res.text)
+        data["agree"] = "on"
+        res = self._step(
+            "consent_post", "POST", consent_url, data=data, headers={"Referer": res.url}
+        )
+        callback_url = self._location(res)
+        if urlparse(callback_url).path != "/oidc/rp/callback":
+            raise Exception(f"consent: unexpected redirect to {callback_url}")
+        self._step("callback", "GET", callback_url)
+        self.session.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--logins", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--username", default="user")
+    parser.add_argument("--password", default="oidcuser")
+    args = parser.parse_args(argv)
+
+    call_command("migrate", verbosity=0)
+    call_command("loaddata", os.path.join(PROJECT_DIR, "dumps", "example.json"), verbosity=0)
+
+    stats = Stats()
+    server = ThreadedWSGIServer((HOST, PORT), QuietHandler)
+    server.daemon_threads = True
+    server.set_app(instrumented(get_wsgi_application(), stats))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    def _login(n):
+        agent = UserAgent(args.username, args.password)
+        try:
+            agent.login()
+        except Exception as e:
+            return agent, str(e)
+        return agent, None
+
+    # builds the trust chains and the caches
+    agent, error = _login(0)
+    if error:
+        sys.exit(f"Warm up login failed: {error}")
+
+    stats.enabled = True
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        results = list(executor.map(_login, range(args.logins)))
+    elapsed = time.perf_counter() - start
+    stats.enabled = False
+    server.shutdown()
+    server.server_close()
+
+    steps = defaultdict(list)
+    errors = defaultdict(int)
+    for agent, error in results:
+        if error:
+            errors[error.split(":")[0]] += 1
+        for name, values in agent.steps.items():
+            steps[name].extend(values)
+    completed = args.logins - sum(errors.values())
+
+    json.dump(
+        {
+            "benchmark": "load_login",
+            "logins": args.logins,
+            "concurrency": args.concurrency,
+            "completed": completed,
+            "errors": errors,
+            "seconds": round(elapsed, 3),
+            "logins_per_second": round(completed / elapsed, 2),
+            "steps": {k: percentiles(v) for k, v in steps.items()},
+            "endpoints": stats.as_dict(),
+        },
+        sys.stdout,
+        indent=2,
+    )
+    sys.stdout.write("\n")
+    os.remove(DB_PATH)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,242 @@
+"""
+A synthetic federation, with real signed entity configurations
+and subordinate statements, served by a local HTTP server.
+
+    federation = MockFederation(depth=2, fanout=4, leaves=20)
+    with federation.serve(latency=0.005):
+        federation.trust_anchor, federation.leaves[0]
+
+The Trust Anchor is at level 0, the intermediates of each level
+are `fanout` times the ones of the level above,
+the leaves (openid_provider) are distributed over the last level.
+Each entity lists `authority_hints` superiors of the level above.
+"""
+import contextlib
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import django
+from django.conf import settings
+
+if not settings.configured:
+    settings.configure()
+    django.setup()
+
+from spid_cie_oidc.authority.settings import FEDERATION_DEFAULT_POLICY  # noqa: E402
+from spid_cie_oidc.entity.jwks import (  # noqa: E402
+    create_jwk,
+    public_jwk_from_private_jwk
+)
+from spid_cie_oidc.entity.jwtse import create_jws  # noqa: E402
+from spid_cie_oidc.entity.utils import exp_from_now, iat_now  # noqa: E402
+
+WELLKNOWN_PATH = "/.well-known/openid-federation"
+FETCH_PATH = "/fetch"
+
+
+class MockEntity:
+    def __init__(self, path: str, level: int, kty: str = None, crv: str = None):
+        self.path = path
+        self.level = level
+        self.jwk = create_jwk(kty=kty, crv=crv)
+        self.public_jwk = public_jwk_from_private_jwk(self.jwk)
+        self.superiors = []
+        self.subordinates = []
+
+    def __repr__(self) -> str:
+        return self.path
+
+
+class MockFederation:
+    def __init__(
+        self,
+        depth: int = 1,
+        fanout: int = 2,
+        leaves: int = 10,
+        authority_hints: int = 1,
+        kty: str = None,
+        crv: str = None,
+        exp_minutes: int = 60,
+    ):
+        self.exp_minutes = exp_minutes
+        self.base_url = ""
+        self.statements = {}
+        self.trust_anchor = MockEntity("/ta", 0, kty, crv)
+        self.levels = [[self.trust_anchor]]
+        for level in range(1, depth + 1):
+            self.levels.append(
+                [
+                    MockEntity(f"/int-{level}-{i}", level, kty, crv)
+                    for i in range(fanout ** level)
+                ]
+            )
+        self.leaves = [
+            MockEntity(f"/leaf-{i}", depth + 1, kty, crv) for i in range(leaves)
+        ]
+        for level, entities in enumerate(self.levels[1:] + [self.leaves], start=1):
+            superiors = self.levels[level - 1]
+            for i, ent in enumerate(entities):
+                # the parent of the tree first, then its siblings
+                parent = i // fanout if level <= depth else i % len(superiors)
+                for n in range(min(authority_hints, len(superiors))):
+                    sup = superiors[(parent + n) % len(superiors)]
+                    ent.superiors.append(sup)
+                    sup.subordinates.append(ent)
+
+    @property
+    def depth(self) -> int:
+        return len(self.levels) - 1
+
+    @property
+    def entities(self) -> list:
+        return [ent for entities in self.levels for ent in entities] + self.leaves
+
+    def entity_id(self, entity: MockEntity) -> str:
+        return f"{self.base_url}{entity.path}"
+
+    def _sign(self, payload: dict, entity: MockEntity) -> str:
+        return create_jws(payload, entity.jwk, typ="entity-statement+jwt")
+
+    def _metadata(self, entity: MockEntity) -> dict:
+        _id = self.entity_id(entity)
+        metadata = {
+            "federation_entity": {
+                "organization_name": entity.path[1:],
+                "homepage_uri": _id,
+                "contacts": ["ops@localhost"],
+            }
+        }
+        if entity.level > self.depth:
+            metadata["openid_provider"] = {
+                "issuer": _id,
+                "authorization_endpoint": f"{_id}/authorization",
+                "token_endpoint": f"{_id}/token",
+                "userinfo_endpoint": f"{_id}/userinfo",
+                "jwks": {"keys": [entity.public_jwk]},
+                "scopes_supported": ["openid", "offline_access"],
+                "response_types_supported": ["code"],
+                "subject_types_supported": ["pairwise"],
+                "id_token_signing_alg_values_supported": ["RS256", "ES256"],
+                "userinfo_signing_alg_values_supported": ["RS256", "ES256"],
+                "token_endpoint_auth_methods_supported": ["private_key_jwt"],
+            }
+        else:
+            metadata["federation_entity"].update(
+                federation_fetch_endpoint=f"{_id}{FETCH_PATH}",
+                federation_list_endpoint=f"{_id}/list",
+            )
+        return metadata
+
+    def entity_configuration(self, entity: MockEntity) -> str:
+        _id = self.entity_id(entity)
+        payload = {
+            "exp": exp_from_now(self.exp_minutes),
+            "iat": iat_now(),
+            "iss": _id,
+            "sub": _id,
+            "jwks": {"keys": [entity.public_jwk]},
+            "metadata": self._metadata(entity),
+        }
+        if entity.superiors:
+            payload["authority_hints"] = [self.entity_id(i) for i in entity.superiors]
+        else:
+            payload["constraints"] = {"max_path_length": self.depth}
+        return self._sign(payload, entity)
+
+    def subordinate_statement(self, issuer: MockEntity, entity: MockEntity) -> str:
+        payload = {
+            "exp": exp_from_now(self.exp_minutes),
+            "iat": iat_now(),
+            "iss": self.entity_id(issuer),
+            "sub": self.entity_id(entity),
+            "jwks": {"keys": [entity.public_jwk]},
+        }
+        if entity.level > self.depth:
+            payload["metadata_policy"] = {
+                "openid_provider": FEDERATION_DEFAULT_POLICY["openid_provider"]
+            }
+        return self._sign(payload, issuer)
+
+    def sign_all(self) -> None:
+        """
+        signs the statements of the whole federation,
+        to be called once the base url is known
+        """
+        self.statements = {}
+        for ent in self.entities:
+            _id = self.entity_id(ent)
+            self.statements[(_id, None)] = self.entity_configuration(ent)
+            for sub in ent.subordinates:
+                self.statements[(_id, self.entity_id(sub))] = (
+                    self.subordinate_statement(ent, sub)
+                )
+
+    def get_statement(self, path: str, sub: str = None):
+        if path.endswith(WELLKNOWN_PATH):
+            path = path[: -len(WELLKNOWN_PATH)]
+            sub = None
+        elif path.endswith(FETCH_PATH):
+            path = path[: -len(FETCH_PATH)]
+            if not sub:
+                return None
+        else:
+            return None
+        return self.statements.get((f"{self.base_url}{path}", sub))
+
+    @contextlib.contextmanager
+    def serve(self, latency: float = 0, host: str = "127.0.0.1"):
+        """
+        serves the federation on a random port of host,
+        each response is delayed by latency seconds
+        """
+        federation = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                sub = parse_qs(url.query).get("sub", [None])[0]
+                jws = federation.get_statement(url.path, sub)
+                if latency:
+                    time.sleep(latency)
+                body = (jws or "").encode()
+                self.send_response(200 if jws else 404)
+                self.send_header("Content-Type", "application/entity-statement+jwt")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, 0), Handler)
+        server.daemon_threads = True
+        self.base_url = f"http://{host}:{server.server_address[1]}"
+        self.sign_all()
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        try:
+            yield self
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def as_dict(self) -> dict:
+        return {
+            "depth": self.depth,
+            "intermediates": sum(len(i) for i in self.levels[1:]),
+            "leaves": len(self.leaves),
+            "statements": len(self.statements),
+        }
+
+
+if __name__ == "__main__":  # pragma: no cover
+    federation = MockFederation()
+    with federation.serve():
+        print(json.dumps(federation.as_dict(), indent=2))
+        print(federation.entity_id(federation.trust_anchor))
+        input("Press enter to stop ")
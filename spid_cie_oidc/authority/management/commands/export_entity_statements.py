@@ -0,0 +1,111 @@
+import logging
+import os
+import urllib.parse
+
+from concurrent.futures import ProcessPoolExecutor
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.translation import gettext as _
+
+from spid_cie_oidc.authority.models import FederationDescendant
+from spid_cie_oidc.entity.jwtse import create_jws
+from spid_cie_oidc.entity.models import get_first_self_trust_anchor
+from spid_cie_oidc.entity.statements import OIDCFED_FEDERATION_WELLKNOWN_URL
+
+
+logger = logging.getLogger(__name__)
+
+
+def fetch_statement_path(sub: str) -> str:
+    """
+    relative path of the static file that mirrors fetch?sub=<sub>
+    """
+    return os.path.join("fetch", urllib.parse.quote(sub, safe=""))
+
+
+class Command(BaseCommand):
+    help = (
+        "Signs the subordinate statements of all the active descendants "
+        "and the entity configuration of the trust anchor, "
+        "then writes them in a static directory tree"
+    )
+
+    def add_arguments(self, parser):
+        parser.epilog = (
+            "Example: ./manage.py export_entity_statements -o /var/www/federation"
+        )
+        parser.add_argument(
+            "-o",
+            "--output",
+            required=True,
+            help=_("Directory where the signed statements will be written"),
+        )
+        parser.add_argument(
+            "--iss",
+            required=False,
+            default=None,
+            help=_("The issuer of the statements, the first trust anchor if omitted"),
+        )
+        parser.add_argument(
+            "-w",
+            "--workers",
+            type=int,
+            required=False,
+            default=os.cpu_count(),
+            help=_("Number of processes for signing, 0 signs in this process"),
+        )
+        parser.add_argument(
+            "-debug", required=False, action="store_true", help="see debug message"
+        )
+
+    def get_payloads(self, issuer) -> dict:
+        payloads = {
+            OIDCFED_FEDERATION_WELLKNOWN_URL: (
+                issuer.entity_configuration_as_dict
+            ),
+        }
+        # fetch without sub returns the entity configuration of the issuer
+        payloads[os.path.join("fetch", "index")] = payloads[
+            OIDCFED_FEDERATION_WELLKNOWN_URL
+        ]
+        for desc in FederationDescendant.get_with_statement_data(is_active=True):
+            payloads[fetch_statement_path(desc.sub)] = desc.entity_statement_as_dict(
+                issuer=issuer
+            )
+        return payloads
+
+    def handle(self, *args, **options):
+        issuer = get_first_self_trust_anchor(options["iss"])
+        if not issuer:
+            raise CommandError(_("No active trust anchor configuration found"))
+
+        payloads = self.get_payloads(issuer)
+        sign_kwargs = dict(
+            jwk_dict=issuer.jwks_fed[0],
+            alg=issuer.default_signature_alg,
+            typ="entity-statement+jwt",
+        )
+
+        if options["workers"]:
+            with ProcessPoolExecutor(max_workers=options["workers"]) as executor:
+                futures = {
+                    path: executor.submit(create_jws, payload, **sign_kwargs)
+                    for path, payload in payloads.items()
+                }
+                jwts = {path: fut.result() for path, fut in futures.items()}
+        else:
+            jwts = {
+                path: create_jws(payload, **sign_kwargs)
+                for path, payload in payloads.items()
+            }
+
+        for path, jwt in jwts.items():
+            fpath = os.path.join(options["output"], path)
+            os.makedirs(os.path.dirname(fpath), exist_ok=True)
+            with open(fpath, "w") as f:
+                f.write(jwt)
+            logger.debug(f"Exported {fpath}")
+
+        logger.info(
+            f"Exported {len(jwts)} signed statements issued by {issuer.sub} "
+            f"in {options['output']}"
+        )
@@ -13,7 +13,7 @@ from spid_cie_oidc.entity.models import (
     FederationEntityConfiguration
 )
 
-from spid_cie_oidc.entity.jwtse import create_jws
+from spid_cie_oidc.entity.jwtse import sign_jws
 from spid_cie_oidc.entity.validators import validate_public_jwks
 from spid_cie_oidc.entity.utils import iat_now, exp_from_now
 from spid_cie_oidc.entity.settings import FEDERATION_DEFAULT_EXP
@@ -155,11 +155,50 @@ class FederationDescendant(TimeStampedModel):
         verbose_name = "Federation Entity Descendant"
         verbose_name_plural = "Federation Entity Descendants"
 
+    @classmethod
+    def get_with_statement_data(cls, **lookup) -> models.QuerySet:
+        """
+        returns the descendants matching the lookup together with
+        their assigned profiles, profile issuers and contacts,
+        fetched in a constant number of queries
+        """
+        return cls.objects.filter(**lookup).prefetch_related(
+            models.Prefetch(
+                "federationentityassignedprofile_set",
+                queryset=FederationEntityAssignedProfile.objects.select_related(
+                    "profile", "issuer"
+                ),
+                to_attr="prefetched_assigned_profiles",
+            ),
+            models.Prefetch(
+                "federationdescendantcontact_set",
+                to_attr="prefetched_contacts",
+            ),
+        )
+
+    @property
+    def assigned_profiles(self) -> list:
+        if hasattr(self, "prefetched_assigned_profiles"):
+            return self.prefetched_assigned_profiles
+        return list(
+            self.federationentityassignedprofile_set.select_related(
+                "profile", "issuer"
+            )
+        )
+
+    @property
+    def contacts(self) -> list:
+        if hasattr(self, "prefetched_contacts"):
+            return [i.contact for i in self.prefetched_contacts]
+        return list(
+            FederationDescendantContact.objects.filter(entity=self).values_list(
+                "contact", flat=True
+            )
+        )
+
     @property
     def trust_marks(self):
-        #
-        profiles = FederationEntityAssignedProfile.objects.filter(descendant=self)
-        return [i.trust_mark for i in profiles]
+        return [i.trust_mark for i in self.assigned_profiles]
 
     @property
     def trust_marks_as_json(self):
@@ -167,20 +206,24 @@ class FederationDescendant(TimeStampedModel):
 
     @property
     def entity_profiles(self):
-        return [
-            i.profile.profile_category
-            for i in FederationEntityAssignedProfile.objects.filter(descendant=self)
-        ]
+        return [i.profile.profile_category for i in self.assigned_profiles]
 
-    def entity_statement_as_dict(self, iss: str = None, aud: list = None) -> dict:
+    def entity_statement_as_dict(
+        self,
+        iss: str = None,
+        aud: list = None,
+        issuer: FederationEntityConfiguration = None
+    ) -> dict:
 
+        assigned_profiles = self.assigned_profiles
+        entity_profiles = [i.profile.profile_category for i in assigned_profiles]
         policies = {
-            k: FEDERATION_DEFAULT_POLICY.get(k, {}) for k in self.entity_profiles
+            k: FEDERATION_DEFAULT_POLICY.get(k, {}) for k in entity_profiles
         }
 
         # apply custom policies if defined
         policies.update(self.metadata_policy)
-        ta = get_first_self_trust_anchor(iss)
+        ta = issuer or get_first_self_trust_anchor(iss)
         data = {
             "exp": exp_from_now(minutes=FEDERATION_DEFAULT_EXP),
             "iat": iat_now(),
@@ -199,9 +242,7 @@ class FederationDescendant(TimeStampedModel):
             data["aud"] = [aud] if isinstance(aud, str) else aud
 
         # add contacts
-        contacts = FederationDescendantContact.objects.filter(entity=self).values_list(
-            "contact", flat=True
-        )
+        contacts = self.contacts
 
         if contacts:
             for k, v in data.get("metadata_policy", {}).items():
@@ -215,7 +256,7 @@ class FederationDescendant(TimeStampedModel):
                     }
 
         # include active trust marks
-        tm = self.trust_marks
+        tm = [i.trust_mark for i in assigned_profiles]
         if tm:
             data["trust_marks"] = tm
 
@@ -227,10 +268,15 @@ class FederationDescendant(TimeStampedModel):
     def entity_statement_preview(self):
         return self.entity_statement_as_json()
 
-    def entity_statement_as_jws(self, iss: str = None, aud: list = None) -> str:
-        issuer = get_first_self_trust_anchor(iss)
-        return create_jws(
-            self.entity_statement_as_dict(iss, aud),
+    def entity_statement_as_jws(
+        self,
+        iss: str = None,
+        aud: list = None,
+        issuer: FederationEntityConfiguration = None
+    ) -> str:
+        issuer = issuer or get_first_self_trust_anchor(iss)
+        return sign_jws(
+            self.entity_statement_as_dict(iss, aud, issuer=issuer),
             issuer.jwks_fed[0],
             alg=issuer.default_signature_alg,
             typ="entity-statement+jwt"
@@ -265,7 +311,7 @@ class FederationEntityAssignedProfile(TimeStampedModel):
 
     @property
     def trust_mark_as_jws(self):
-        return create_jws(
+        return sign_jws(
             self.trust_mark_as_dict,
             self.issuer.jwks_fed[0],
             alg=self.issuer.default_signature_alg,
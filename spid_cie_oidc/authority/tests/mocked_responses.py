@@ -1,15 +1,18 @@
+from django.http import HttpResponseNotFound
 from django.test import Client
 from django.urls import reverse
 
 from spid_cie_oidc.entity.models import FederationEntityConfiguration
 from spid_cie_oidc.entity.jwtse import unpad_jwt_payload, create_jws
 from spid_cie_oidc.entity.exceptions import HttpError
+from spid_cie_oidc.entity.statements import OIDCFED_FEDERATION_WELLKNOWN_URL
 from spid_cie_oidc.entity.tests.settings import ta_conf_data
 
 from .settings import rp_onboarding_data, intermediary_conf, rp_conf
 
 import copy
 import logging
+from urllib.parse import parse_qs, urlparse
 
 logger = logging.getLogger(__name__)
 
@@ -172,3 +175,37 @@ class EntityResponseWithIntermediateManyHints(EntityResponse):
             return self.result_as_jws()
         except:
             return self.result_as_it_is()
+
+
+class EntityResponseRouter(EntityResponse):
+    """
+    side_effect of requests.get that responds by url, for the flows
+    where the order of the requests isn't fixed. The urls are kept in requests
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.requests = []
+
+    def __call__(self, url: str, *args, **kwargs):
+        self.requests.append(url)
+        _url = urlparse(url)
+        if _url.path.endswith(f"/{OIDCFED_FEDERATION_WELLKNOWN_URL}"):
+            sub = url[:-len(OIDCFED_FEDERATION_WELLKNOWN_URL)]
+            ec = FederationEntityConfiguration.objects.filter(
+                sub__in=(sub, sub.rstrip("/"))
+            ).first()
+            if not ec:
+                return HttpResponseNotFound()
+            return DummyContent(ec.entity_configuration_as_jws)
+
+        for ec in FederationEntityConfiguration.objects.all():
+            fetch_endpoint = ec.metadata.get("federation_entity", {}).get(
+                "federation_fetch_endpoint", None
+            )
+            if fetch_endpoint == f"{_url.scheme}://{_url.netloc}{_url.path}":
+                return self.client.get(
+                    reverse("oidcfed_fetch"),
+                    data={"sub": parse_qs(_url.query)["sub"][0], "iss": ec.sub},
+                )
+        return HttpResponseNotFound()
@@ -1,13 +1,21 @@
-from django.test import TestCase, Client, override_settings
+from asgiref.sync import async_to_sync
+from django.contrib.auth import get_user_model
+from django.test import TestCase, Client, RequestFactory, override_settings
 from django.urls import reverse
+from django.utils import timezone
 
+from spid_cie_oidc.entity import tracing
 from spid_cie_oidc.entity.exceptions import InvalidRequiredTrustMark
 from spid_cie_oidc.entity.jwtse import verify_jws, unpad_jwt_payload
 from spid_cie_oidc.entity.models import *
+from spid_cie_oidc.entity.policy import PolicyError
 
 from spid_cie_oidc.entity.trust_chain_operations import (
+    aget_or_create_trust_chains,
+    atrust_chain_builder,
     dumps_statements_from_trust_chain_to_db,
     get_or_create_trust_chain,
+    get_or_create_trust_chains,
     trust_chain_builder,
 )
 from spid_cie_oidc.entity.statements import (
@@ -16,6 +24,8 @@ from spid_cie_oidc.entity.statements import (
     TrustMark,
 )
 from spid_cie_oidc.entity.utils import get_jwks
+from spid_cie_oidc.entity.tests import AsyncHttpClientMock, QueryBudgetTestMixin
+from spid_cie_oidc.entity.views import aresolve_entity_statement
 from spid_cie_oidc.entity.tests.settings import *
 
 from spid_cie_oidc.authority.models import *
@@ -29,7 +39,7 @@ import copy
 import datetime
 
 
-class TrustChainTest(TestCase):
+class TrustChainTest(QueryBudgetTestMixin, TestCase):
     def setUp(self):
         self.ta_conf = FederationEntityConfiguration.objects.create(**ta_conf_data)
         self.rp_conf = FederationEntityConfiguration.objects.create(**rp_conf)
@@ -46,16 +56,60 @@ class TrustChainTest(TestCase):
         self.rp_profile.trust_mark_template_as_json
         url = reverse("oidcfed_fetch")
         c = Client()
-        res = c.get(url, data={"sub": self.rp.sub})
+        with self.assertQueryBudget("oidcfed_fetch"):
+            res = c.get(url, data={"sub": self.rp.sub})
         data = verify_jws(res.content.decode(), self.ta_conf.jwks_fed[0])
         
         self.assertEqual(data['source_endpoint'], 'http://testserver//fetch')
         self.assertTrue(data["jwks"])
 
+    def test_fetch_endpoint_queries(self):
+        for i in range(3):
+            profile = FederationEntityProfile.objects.create(
+                **dict(RP_PROFILE, profile_id=f"{RP_PROFILE['profile_id']}/{i}")
+            )
+            FederationEntityAssignedProfile.objects.create(
+                descendant=self.rp, profile=profile, issuer=self.ta_conf
+            )
+            FederationDescendantContact.objects.create(
+                entity=self.rp, contact=f"ops{i}@rp.example.it", type="email"
+            )
+
+        url = reverse("oidcfed_fetch")
+        c = Client()
+        # trust anchor, descendant, assigned profiles and contacts
+        with self.assertNumQueries(4):
+            res = c.get(url, data={"sub": self.rp.sub})
+        data = verify_jws(res.content.decode(), self.ta_conf.jwks_fed[0])
+        self.assertEqual(len(data["trust_marks"]), 4)
+
+    def test_bulk_entity_statements_queries(self):
+        for i in range(3):
+            desc = FederationDescendant.objects.create(
+                **dict(
+                    rp_onboarding_data,
+                    name=f"RP Test {i}",
+                    sub=f"http://rp-test-{i}.it/oidc/rp/"
+                )
+            )
+            FederationEntityAssignedProfile.objects.create(
+                descendant=desc, profile=self.rp_profile, issuer=self.ta_conf
+            )
+
+        with self.assertNumQueries(3):
+            statements = [
+                i.entity_statement_as_dict(issuer=self.ta_conf)
+                for i in FederationDescendant.get_with_statement_data(is_active=True)
+            ]
+        self.assertEqual(len(statements), 4)
+        for i in statements:
+            self.assertTrue(i["trust_marks"])
+
     def test_list_endpoint(self):
         url = reverse("oidcfed_list")
         c = Client()
-        res = c.get(url, data={})
+        with self.assertQueryBudget("oidcfed_list"):
+            res = c.get(url, data={})
         self.assertTrue(res.json())
         self.assertEqual(res.status_code, 200)
 
@@ -88,6 +142,79 @@ class TrustChainTest(TestCase):
 
         self.assertTrue(isinstance(trust_chain.exp, int))
         self.assertTrue(isinstance(trust_chain.exp_datetime, datetime.datetime))
+        # the metadata policy of the statement issued by the trust anchor
+        self.assertEqual(
+            trust_chain.final_metadata["openid_relying_party"]["scope"], ["openid"]
+        )
+        self.assertNotIn(
+            "scope",
+            trust_chain.subject_configuration.payload["metadata"]["openid_relying_party"]
+        )
+
+    @override_settings(HTTP_CLIENT_SYNC=True)
+    @patch("requests.get", return_value=EntityResponseNoIntermediate())
+    def test_trust_chain_metadata_policy_violated(self, mocked):
+        # the metadata of the RP has neither of these grant types
+        self.rp.metadata_policy = {
+            "openid_relying_party": {"grant_types": {"subset_of": ["implicit"]}}
+        }
+        self.rp.save()
+
+        with self.assertRaises(PolicyError):
+            get_or_create_trust_chain(
+                subject=rp_conf["sub"],
+                trust_anchor=self.ta_conf.sub,
+            )
+        self.assertFalse(TrustChain.objects.filter(sub=rp_conf["sub"]).exists())
+
+    @override_settings(HTTP_CLIENT_SYNC=True)
+    def test_async_trust_chain_valid_no_intermediaries(self):
+        self.ta_conf.constraints = {"max_path_length": 0}
+        self.ta_conf.save()
+
+        response = EntityResponseNoIntermediate()
+        with patch("requests.get", return_value=response):
+            jwt = get_entity_configurations(self.ta_conf.sub)
+        trust_anchor_ec = EntityConfiguration(jwt[0])
+
+        client = AsyncHttpClientMock(response)
+        with patch(
+            "spid_cie_oidc.entity.statements.get_async_http_client",
+            return_value=client
+        ):
+            trust_chain = async_to_sync(atrust_chain_builder)(
+                subject=rp_onboarding_data["sub"],
+                trust_anchor=trust_anchor_ec
+            )
+        self.assertTrue(trust_chain)
+        self.assertTrue(trust_chain.final_metadata)
+        self.assertEqual(len(trust_chain.trust_path), 2)
+        for ec in trust_chain.trust_path:
+            self.assertTrue(ec.is_valid)
+        # the entity configuration of the leaf and its statement by the trust anchor
+        self.assertEqual(len(client.requests), 2)
+
+    def test_async_resolve_endpoint_with_staff_token(self):
+        user = get_user_model().objects.create(username="staff", is_staff=True)
+        StaffToken.objects.create(user=user, token="secret-token", is_active=True)
+        request = RequestFactory().get(
+            reverse("oidcfed_resolve"),
+            data={"sub": self.rp.sub, "anchor": self.ta_conf.sub},
+            HTTP_AUTHORIZATION="secret-token"
+        )
+
+        with patch(
+            "spid_cie_oidc.entity.statements.get_async_http_client",
+            return_value=AsyncHttpClientMock(EntityResponseNoIntermediate())
+        ):
+            res = async_to_sync(aresolve_entity_statement)(request)
+
+        self.assertEqual(res.status_code, 200)
+        payload = verify_jws(res.content.decode(), self.ta_conf.jwks_fed[0])
+        self.assertEqual(payload["sub"], self.rp.sub)
+        self.assertTrue(payload["metadata"])
+        tc = TrustChain.objects.get(sub=self.rp.sub, trust_anchor__sub=self.ta_conf.sub)
+        self.assertIn("trust_chain.fetch_trust_anchor", tc.log)
 
     def _create_federation_with_intermediary(self) -> EntityConfiguration:
         jwt = get_entity_configurations(self.ta_conf.sub)
@@ -176,6 +303,85 @@ class TrustChainTest(TestCase):
             is_active=True,
         )
 
+    @override_settings(HTTP_CLIENT_SYNC=True)
+    def test_trust_chains_to_many_trust_anchors(self):
+        router = EntityResponseRouter()
+        with patch("requests.get", side_effect=router):
+            self._create_federation_with_intermediary()
+            router.requests = []
+            # the intermediary is a trust anchor too
+            trust_anchors = [self.ta_conf.sub, self.intermediate.sub]
+            tcs = get_or_create_trust_chains(self.rp.sub, trust_anchors)
+
+        self.assertEqual(
+            tcs[self.ta_conf.sub].parties_involved,
+            [self.rp.sub, self.intermediate.sub, self.ta_conf.sub]
+        )
+        self.assertEqual(
+            tcs[self.intermediate.sub].parties_involved,
+            [self.rp.sub, self.intermediate.sub]
+        )
+        for tc in tcs.values():
+            self.assertTrue(tc.metadata["openid_relying_party"])
+            self.assertEqual(
+                unpad_jwt_payload(tc.chain[0])["sub"], self.rp.sub
+            )
+        self.assertEqual(len(tcs[self.intermediate.sub].chain), 3)
+        self.assertEqual(len(tcs[self.ta_conf.sub].chain), 4)
+        # a single discovery: the trust anchors, the RP,
+        # its statement by the intermediary and the one of the intermediary
+        self.assertEqual(len(router.requests), 5)
+        self.assertEqual(len(set(router.requests)), 5)
+        # the discovery is shared, the statements of each one are stored by its own
+        for tc in tcs.values():
+            self.assertIn("trust_chain.discovery count=1", tc.log)
+            self.assertIn("trust_chain.dumps_statements_to_db count=1", tc.log)
+
+        # stored, then returned as they are
+        with patch("requests.get", side_effect=router):
+            self.assertEqual(
+                get_or_create_trust_chains(self.rp.sub, trust_anchors), tcs
+            )
+        self.assertEqual(len(router.requests), 5)
+
+        # disabled by staff
+        TrustChain.objects.filter(pk=tcs[self.ta_conf.sub].pk).update(is_active=False)
+        with patch("requests.get", side_effect=router):
+            tcs = get_or_create_trust_chains(self.rp.sub, trust_anchors, force=True)
+        self.assertIsNone(tcs[self.ta_conf.sub])
+        self.assertTrue(tcs[self.intermediate.sub].is_valid)
+
+    @override_settings(HTTP_CLIENT_SYNC=True)
+    def test_async_trust_chains_to_many_trust_anchors(self):
+        router = EntityResponseRouter()
+        with patch("requests.get", side_effect=router):
+            self._create_federation_with_intermediary()
+        router.requests = []
+
+        client = AsyncHttpClientMock(router)
+        with patch(
+            "spid_cie_oidc.entity.statements.get_async_http_client",
+            return_value=client
+        ):
+            tcs = async_to_sync(aget_or_create_trust_chains)(
+                self.rp.sub, [self.ta_conf.sub, "http://unknown-anchor.example.org"]
+            )
+        self.assertTrue(tcs[self.ta_conf.sub].is_valid)
+        self.assertIsInstance(tcs["http://unknown-anchor.example.org"], Exception)
+        self.assertFalse(
+            TrustChain.objects.filter(
+                trust_anchor__sub="http://unknown-anchor.example.org"
+            ).exists()
+        )
+        # the two trust anchors, then the RP and its superiors once
+        self.assertEqual(len(client.requests), 6)
+        self.assertEqual(
+            [url for method, url in client.requests].count(
+                "http://rp-test.it/oidc/rp/.well-known/openid-federation"
+            ),
+            1
+        )
+
     @override_settings(HTTP_CLIENT_SYNC=True)
     @patch("requests.get", return_value=EntityResponseWithIntermediateManyHints())
     def test_trust_chain_valid_with_intermediaries_many_authhints(self, mocked):
@@ -255,6 +461,57 @@ class TrustChainTest(TestCase):
         self.assertFalse(gctc.is_expired)
         self.assertTrue(gctc.is_valid)
 
+    @override_settings(HTTP_CLIENT_SYNC=True)
+    @patch("requests.get", return_value=EntityResponseWithIntermediate())
+    def test_trust_chain_spans(self, mocked):
+        trust_anchor_ec = self._create_federation_with_intermediary()
+        mocked.reset_mock()
+
+        trust_chain = trust_chain_builder(
+            subject=self.rp.sub,
+            trust_anchor=trust_anchor_ec
+        )
+        summary = trust_chain.recorder.summary()
+        for name in (
+            "trust_chain.start",
+            "trust_chain.get_trust_anchor_configuration",
+            "trust_chain.get_subject_configuration",
+            "trust_chain.discovery",
+            "trust_chain.apply_metadata_policy",
+        ):
+            self.assertEqual(summary[name]["count"], 1)
+        # a hop for the rp and one for the intermediary
+        self.assertEqual(summary["trust_chain.get_superiors"]["count"], 2)
+        self.assertEqual(summary["trust_chain.validate_by_superiors"]["count"], 2)
+        self.assertEqual(summary["http.fetch"]["count"], mocked.call_count)
+        self.assertTrue(summary["jws.verify"]["count"])
+
+    @override_settings(HTTP_CLIENT_SYNC=True)
+    @patch("requests.get", return_value=EntityResponseNoIntermediate())
+    def test_trust_chain_log(self, mocked):
+        spans = []
+
+        class ListTracer(tracing.Tracer):
+            def span(self, name, attributes):
+                spans.append((name, attributes))
+                return super().span(name, attributes)
+
+        with patch("spid_cie_oidc.entity.tracing._TRACER", ListTracer()):
+            gctc = get_or_create_trust_chain(
+                subject=rp_conf["sub"],
+                trust_anchor=self.ta_conf.sub,
+            )
+        names = [i[0] for i in spans]
+        self.assertIn(("trust_chain.start", {"sub": rp_conf["sub"]}), spans)
+        self.assertIn("trust_chain.dumps_statements_to_db", names)
+        self.assertIn("trust_chain.dumps_statements_to_db count=1", gctc.log)
+        self.assertIn("trust_chain.fetch_trust_anchor count=1", gctc.log)
+        self.assertIn(f"http.fetch count={mocked.call_count}", gctc.log)
+
+        # nothing is recorded outside the trust chain operations
+        verify_jws(gctc.chain[0], self.rp_conf.jwks_fed[0])
+        self.assertEqual(names, [i[0] for i in spans])
+
     @override_settings(HTTP_CLIENT_SYNC=True)
     @patch("requests.get", return_value=EntityResponseNoIntermediate())
     def test_resolve_endpoint(self, mocked):
@@ -268,25 +525,77 @@ class TrustChainTest(TestCase):
         url = reverse("oidcfed_resolve")
 
         c = Client()
-        res = c.get(url, data={
-                "sub": self.rp.sub, 
-                "anchor": self.ta_conf.sub
-            }
-        )
+        with self.assertQueryBudget("oidcfed_resolve"):
+            res = c.get(url, data={
+                    "sub": self.rp.sub, 
+                    "anchor": self.ta_conf.sub
+                }
+            )
         self.assertTrue(res.status_code == 200)
         verify_jws(res.content.decode(), self.ta_conf.jwks_fed[0])
 
+    @override_settings(HTTP_CLIENT_SYNC=True)
+    def test_resolve_endpoint_cache(self):
+        with patch("requests.get", return_value=EntityResponseNoIntermediate()):
+            get_or_create_trust_chain(
+                subject=rp_conf["sub"],
+                trust_anchor=self.ta_conf.sub,
+            )
+
+        url = reverse("oidcfed_resolve")
+        data = {"sub": self.rp.sub, "anchor": self.ta_conf.sub}
+        c = Client()
+        res = c.get(url, data=data)
+        self.assertEqual(res.status_code, 200)
+        etag = res["ETag"]
+
+        # signed once
+        with patch("spid_cie_oidc.entity.views.create_jws") as create_jws:
+            cached = c.get(url, data=data)
+        create_jws.assert_not_called()
+        self.assertEqual(cached.content, res.content)
+        self.assertEqual(cached["ETag"], etag)
+
+        res = c.get(url, data=data, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(res.status_code, 304)
+        self.assertFalse(res.content)
+
+        last_modified = cached["Last-Modified"]
+        res = c.get(url, data=data, HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(res.status_code, 304)
+
+        # a rotated signing key is another version
+        later = timezone.now() + datetime.timedelta(seconds=2)
+        with patch("django.utils.timezone.now", return_value=later):
+            self.ta_conf.save()
+        res = c.get(url, data=data, HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(res.status_code, 200)
+        self.assertNotEqual(res["Last-Modified"], last_modified)
+
+        # a renewed chain is another version
+        with patch("requests.get", return_value=EntityResponseNoIntermediate()):
+            get_or_create_trust_chain(
+                subject=rp_conf["sub"],
+                trust_anchor=self.ta_conf.sub,
+                force=True
+            )
+        res = c.get(url, data=data, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(res.status_code, 200)
+        self.assertNotEqual(res["ETag"], etag)
+        verify_jws(res.content.decode(), self.ta_conf.jwks_fed[0])
+
     def test_trust_mark_status_endpoint(self):
         url = reverse("oidcfed_trust_mark_status")
 
         c = Client()
-        res = c.post(
-            url,
-            data={
-                "trust_mark_id": self.rp_assigned_profile.profile.profile_id,
-                "sub": self.rp_assigned_profile.descendant.sub,
-            },
-        )
+        with self.assertQueryBudget("oidcfed_trust_mark_status"):
+            res = c.post(
+                url,
+                data={
+                    "trust_mark_id": self.rp_assigned_profile.profile.profile_id,
+                    "sub": self.rp_assigned_profile.descendant.sub,
+                },
+            )
         self.assertTrue(res.status_code == 200)
         self.assertTrue(res.json() == {"active": True})
 
@@ -5,10 +5,11 @@ from django.urls import reverse
 from spid_cie_oidc.authority.models import FederationDescendant
 from spid_cie_oidc.authority.tests.settings import rp_onboarding_data
 from spid_cie_oidc.entity.models import FederationEntityConfiguration
+from spid_cie_oidc.entity.tests import QueryBudgetTestMixin
 from spid_cie_oidc.entity.tests.settings import ta_conf_data
 
 
-class AdvanceEntityListing(TestCase):
+class AdvanceEntityListing(QueryBudgetTestMixin, TestCase):
 
     def setUp(self):
         FederationDescendant.objects.create(**rp_onboarding_data)
@@ -32,7 +33,8 @@ class AdvanceEntityListing(TestCase):
     @override_settings(MAX_ENTRIES_PAGE=1)
     def test_advanced_entity_listing_no_page(self):
         url = reverse("oidcfed_advanced_entity_listing")
-        res = Client().get(url)
+        with self.assertQueryBudget("oidcfed_advanced_entity_listing"):
+            res = Client().get(url)
         self.assertEqual(res.status_code, 200)
         self.assertEqual(res.json().get("iss"), "http://testserver/")
         self.assertEqual(len(res.json().get("entities")), 2)
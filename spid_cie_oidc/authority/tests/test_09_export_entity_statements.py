@@ -0,0 +1,70 @@
+import os
+import tempfile
+
+from django.core.management import call_command
+from django.test import TestCase
+
+from spid_cie_oidc.authority.management.commands.export_entity_statements import (
+    fetch_statement_path
+)
+from spid_cie_oidc.authority.models import (
+    FederationDescendant,
+    FederationEntityAssignedProfile,
+    FederationEntityProfile
+)
+from spid_cie_oidc.authority.tests.settings import (
+    RP_PROFILE,
+    rp_onboarding_data
+)
+from spid_cie_oidc.entity.jwtse import unpad_jwt_head, verify_jws
+from spid_cie_oidc.entity.models import FederationEntityConfiguration
+from spid_cie_oidc.entity.statements import OIDCFED_FEDERATION_WELLKNOWN_URL
+from spid_cie_oidc.entity.tests.settings import ta_conf_data
+
+
+class ExportEntityStatementsTest(TestCase):
+
+    def setUp(self):
+        self.ta_conf = FederationEntityConfiguration.objects.create(**ta_conf_data)
+        self.rp_profile = FederationEntityProfile.objects.create(**RP_PROFILE)
+        self.rp = FederationDescendant.objects.create(**rp_onboarding_data)
+        FederationEntityAssignedProfile.objects.create(
+            descendant=self.rp, profile=self.rp_profile, issuer=self.ta_conf
+        )
+        self.inactive = FederationDescendant.objects.create(
+            **dict(
+                rp_onboarding_data,
+                sub="http://rp-inactive.it/oidc/rp/",
+                is_active=False
+            )
+        )
+
+    def _export(self, workers):
+        with tempfile.TemporaryDirectory() as outdir:
+            call_command(
+                "export_entity_statements", output=outdir, workers=workers
+            )
+            ec_path = os.path.join(outdir, OIDCFED_FEDERATION_WELLKNOWN_URL)
+            with open(ec_path) as f:
+                ec = verify_jws(f.read(), self.ta_conf.jwks_fed[0])
+            self.assertEqual(ec["sub"], self.ta_conf.sub)
+
+            with open(os.path.join(outdir, fetch_statement_path(self.rp.sub))) as f:
+                jwt = f.read()
+            self.assertEqual(unpad_jwt_head(jwt)["typ"], "entity-statement+jwt")
+            statement = verify_jws(jwt, self.ta_conf.jwks_fed[0])
+            self.assertEqual(statement["sub"], self.rp.sub)
+            self.assertEqual(statement["iss"], self.ta_conf.sub)
+            self.assertTrue(statement["trust_marks"])
+
+            self.assertFalse(
+                os.path.exists(
+                    os.path.join(outdir, fetch_statement_path(self.inactive.sub))
+                )
+            )
+
+    def test_export_inline(self):
+        self._export(workers=0)
+
+    def test_export_process_pool(self):
+        self._export(workers=2)
@@ -22,6 +22,7 @@ from spid_cie_oidc.authority.settings import MAX_ENTRIES_PAGE
 from spid_cie_oidc.entity.jwtse import (
     unpad_jwt_head, unpad_jwt_payload
 )
+from spid_cie_oidc.entity.metrics import FETCHED_STATEMENTS
 from spid_cie_oidc.entity.models import get_first_self_trust_anchor
 from spid_cie_oidc.entity.utils import iat_now
 
@@ -72,19 +73,26 @@ def fetch(request):
                 content_type="application/entity-statement+jwt"
             )
 
-    sub = FederationDescendant.objects.filter(
+    sub = FederationDescendant.get_with_statement_data(
         sub=request.GET["sub"], is_active=True
     ).first()
     if not sub:
+        FETCHED_STATEMENTS.inc(result="not_found")
         raise Http404()
 
+    FETCHED_STATEMENTS.inc(result="issued")
     if request.GET.get("format") == "json":
         return JsonResponse(
-            sub.entity_statement_as_dict(iss.sub, request.GET.get("aud",[])), safe=False
+            sub.entity_statement_as_dict(
+                iss.sub, request.GET.get("aud",[]), issuer=iss
+            ),
+            safe=False
         )
     else:
         return HttpResponse(
-            sub.entity_statement_as_jws(iss.sub, request.GET.get("aud",[])),
+            sub.entity_statement_as_jws(
+                iss.sub, request.GET.get("aud",[]), issuer=iss
+            ),
             content_type="application/entity-statement+jwt",
         )
 
@@ -51,3 +51,7 @@ class TrustchainMissingMetadata(ValidationError):
 
 class InvalidEntityConfiguration(ValidationError):
     pass
+
+
+class JwsSignerError(Exception):
+    pass
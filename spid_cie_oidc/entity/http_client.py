@@ -1,13 +1,31 @@
 import aiohttp
 import asyncio
+import json
+import logging
+import os
+import threading
+import weakref
+
+import requests
+from http.cookiejar import DefaultCookiePolicy
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from .settings import HTTPC_PARAMS, HTTPC_POOL, HTTPC_TIMEOUT
+from .metrics import get_host, HTTP_REQUEST_SECONDS
+from .tracing import span
+
+
+logger = logging.getLogger(__name__)
 
 
 async def fetch(session, url, httpc_params: dict = {}):
-    async with session.get(url, **httpc_params.get("connection", {})) as response:
-        if response.status != 200: # pragma: no cover
-            # response.raise_for_status()
-            return ""
-        return await response.text()
+    with span("http.fetch", url=url), HTTP_REQUEST_SECONDS.time(host=get_host(url)):
+        async with session.get(url, **httpc_params.get("connection", {})) as response:
+            if response.status != 200: # pragma: no cover
+                # response.raise_for_status()
+                return ""
+            return await response.text()
 
 
 async def fetch_all(session, urls, httpc_params):
@@ -29,6 +47,152 @@ async def http_get(urls, httpc_params: dict = {}):
         return text
 
 
+class HttpClient:
+    """
+    Blocking HTTP client for the back-channel requests,
+    with a pool of keep-alive connections for each host
+    and retries of the connections that fail
+    """
+
+    def __init__(self, pool: dict = HTTPC_POOL, timeout: int = HTTPC_TIMEOUT):
+        self.timeout = timeout
+        self.verify = HTTPC_PARAMS.get("connection", {}).get("ssl", True)
+        self.session = requests.Session()
+        # the cookies of a response must not be sent with the following requests
+        self.session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+        adapter = HTTPAdapter(
+            pool_connections=pool["hosts"],
+            pool_maxsize=pool["maxsize"],
+            pool_block=pool["block"],
+            max_retries=Retry(
+                total=pool["retries"],
+                connect=pool["retries"],
+                read=0,
+                status=0,
+                backoff_factor=pool["backoff_factor"],
+            ),
+        )
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def _params(self, kwargs: dict) -> dict:
+        kwargs.setdefault("timeout", self.timeout)
+        kwargs.setdefault("verify", self.verify)
+        return kwargs
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        with HTTP_REQUEST_SECONDS.time(host=get_host(url)):
+            return self.session.get(url, **self._params(kwargs))
+
+    def post(self, url: str, **kwargs) -> requests.Response:
+        with HTTP_REQUEST_SECONDS.time(host=get_host(url)):
+            return self.session.post(url, **self._params(kwargs))
+
+    def close(self) -> None:
+        self.session.close()
+
+
+class AsyncHttpResponse:
+    """
+    the parts of a requests.Response used by the callers
+    """
+
+    def __init__(self, status_code: int, content: bytes, headers: dict):
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers
+
+    def json(self):
+        return json.loads(self.content)
+
+
+class AsyncHttpClient:
+    """
+    As HttpClient, for the ASGI deployments.
+    Each event loop has its own aiohttp session
+    """
+
+    def __init__(self, pool: dict = HTTPC_POOL, timeout: int = HTTPC_TIMEOUT):
+        self.pool = pool
+        self.timeout = timeout
+        self.ssl = HTTPC_PARAMS.get("connection", {}).get("ssl", True)
+        self._sessions = weakref.WeakKeyDictionary()
+
+    def get_session(self) -> aiohttp.ClientSession:
+        loop = asyncio.get_running_loop()
+        session = self._sessions.get(loop)
+        if session is None or session.closed:
+            session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    limit_per_host=self.pool["maxsize"], ssl=self.ssl
+                ),
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+                cookie_jar=aiohttp.DummyCookieJar(),
+            )
+            self._sessions[loop] = session
+        return session
+
+    async def request(self, method: str, url: str, **kwargs) -> AsyncHttpResponse:
+        with HTTP_REQUEST_SECONDS.time(host=get_host(url)):
+            return await self._request(method, url, **kwargs)
+
+    async def _request(self, method: str, url: str, **kwargs) -> AsyncHttpResponse:
+        session = self.get_session()
+        for attempt in range(self.pool["retries"] + 1):
+            try:
+                async with session.request(method, url, **kwargs) as response:
+                    return AsyncHttpResponse(
+                        response.status, await response.read(), response.headers
+                    )
+            except aiohttp.ClientConnectorError as e:
+                if attempt == self.pool["retries"]:
+                    raise
+                logger.warning(f"Connection to {url} failed, retrying: {e}")
+                await asyncio.sleep(self.pool["backoff_factor"] * (2 ** attempt))
+
+    async def get(self, url: str, **kwargs) -> AsyncHttpResponse:
+        return await self.request("GET", url, **kwargs)
+
+    async def post(self, url: str, **kwargs) -> AsyncHttpResponse:
+        return await self.request("POST", url, **kwargs)
+
+    async def close(self) -> None:
+        session = self._sessions.pop(asyncio.get_running_loop(), None)
+        if session:
+            await session.close()
+
+
+_HTTP_CLIENTS = {}
+_HTTP_CLIENTS_LOCK = threading.Lock()
+
+
+def _get_client(cls):
+    # the connections of a parent process are not reused after a fork
+    key = (cls, os.getpid())
+    client = _HTTP_CLIENTS.get(key)
+    if client is None:
+        with _HTTP_CLIENTS_LOCK:
+            client = _HTTP_CLIENTS.get(key)
+            if client is None:
+                client = cls()
+                _HTTP_CLIENTS[key] = client
+    return client
+
+
+def get_http_client() -> HttpClient:
+    """
+    the HttpClient shared by the requests of this process
+    """
+    return _get_client(HttpClient)
+
+
+def get_async_http_client() -> AsyncHttpClient:
+    """
+    the AsyncHttpClient shared by the requests of this process
+    """
+    return _get_client(AsyncHttpClient)
+
+
 if __name__ == "__main__": # pragma: no cover
     httpc_params = {
         "connection": {"ssl": True},
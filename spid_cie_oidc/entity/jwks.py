@@ -1,11 +1,16 @@
+import json
+
+from cryptojwt.jwk.ec import ECKey
+from cryptojwt.jwk.ec import new_ec_key
 from cryptojwt.jwk.jwk import key_from_jwk_dict
 from cryptojwt.jwk.rsa import new_rsa_key
 from cryptography.hazmat.primitives import serialization
 from cryptojwt.jwk.rsa import RSAKey
-from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.hazmat.primitives.asymmetric import ec, rsa
 
 import cryptography
 from django.conf import settings
+from functools import lru_cache
 
 from . import settings as local_settings
 
@@ -15,8 +20,35 @@ DEFAULT_HASH_FUNC = getattr(
 )
 
 
-def create_jwk(key = None, hash_func=None):
-    key = key or new_rsa_key()
+def new_key(kty: str = None, crv: str = None):
+    kty = kty or local_settings.DEFAULT_JWK_KTY
+    if kty == "EC":
+        return new_ec_key(crv or local_settings.DEFAULT_JWK_CRV)
+    elif kty == "RSA":
+        return new_rsa_key()
+    raise ValueError(f"Unsupported key type: {kty}")
+
+
+def default_jws_alg(jwk_dict: dict) -> str:
+    """
+    returns the JWS algorithm that fits the key type of the jwk
+    """
+    if jwk_dict.get("kty") == "EC":
+        return local_settings.EC_CRV_JWS_ALG[jwk_dict["crv"]]
+    return local_settings.DEFAULT_RSA_JWS_ALG
+
+
+def default_jwe_alg(jwk_dict: dict) -> str:
+    """
+    returns the JWE key management algorithm that fits the key type of the jwk
+    """
+    if jwk_dict.get("kty") == "EC":
+        return local_settings.DEFAULT_EC_JWE_ALG
+    return local_settings.DEFAULT_JWE_ALG
+
+
+def create_jwk(key = None, hash_func=None, kty: str = None, crv: str = None):
+    key = key or new_key(kty, crv)
     thumbprint = key.thumbprint(hash_function=hash_func or DEFAULT_HASH_FUNC)
     jwk = key.to_dict()
     jwk["kid"] = thumbprint.decode()
@@ -84,13 +116,79 @@ def serialize_rsa_key(rsa_key, kind="public", hash_func="SHA-256"):
     return jwk
 
 
+def serialize_ec_key(ec_key, hash_func="SHA-256"):
+    """
+    ec_key can be
+         cryptography.hazmat.primitives.asymmetric.ec.EllipticCurvePublicKey
+        or
+         cryptography.hazmat.primitives.asymmetric.ec.EllipticCurvePrivateKey
+    """
+    if isinstance(ec_key, ec.EllipticCurvePrivateKey):
+        jwk_obj = ECKey(priv_key=ec_key)
+    else:
+        jwk_obj = ECKey(pub_key=ec_key)
+    thumbprint = jwk_obj.thumbprint(hash_function=hash_func)
+
+    jwk = jwk_obj.to_dict()
+    jwk["kid"] = thumbprint.decode()
+    return jwk
+
+
+def serialize_key(key, kind="public", hash_func="SHA-256"):
+    """
+    serializes a RSA or EC key of the cryptography library as a JWK
+    """
+    if isinstance(
+        key, (ec.EllipticCurvePublicKey, ec.EllipticCurvePrivateKey)
+    ):
+        return serialize_ec_key(key, hash_func=hash_func)
+    return serialize_rsa_key(key, kind=kind, hash_func=hash_func)
+
+
 def private_jwk_from_pem(content:str, password:str = None):
     content = content.encode() if isinstance(content, str) else content
     key = serialization.load_pem_private_key(content, password=password)
-    return serialize_rsa_key(key, kind='private')
+    return serialize_key(key, kind='private')
 
 
 def public_jwk_from_pem(content:str, password:str = None):
     content = content.encode() if isinstance(content, str) else content
     key = serialization.load_pem_public_key(content)
-    return serialize_rsa_key(key, kind='public')
+    return serialize_key(key, kind='public')
+
+
+@lru_cache(maxsize=64)
+def _public_jwks_from_json(jwks_json: str) -> str:
+    res = []
+    for i in json.loads(jwks_json):
+        skey = serialize_key(key_from_jwk_dict(i).public_key())
+        skey["kid"] = i["kid"]
+        res.append(skey)
+    return json.dumps(res)
+
+
+def public_jwks_from_private_jwks(jwks: list) -> list:
+    """
+    public keys of a set of private jwks.
+    They are derived once for each key set,
+    a rotation changes the set and then the cache key.
+    """
+    return json.loads(_public_jwks_from_json(json.dumps(jwks, sort_keys=True)))
+
+
+@lru_cache(maxsize=64)
+def _pems_from_json(jwks_json: str) -> str:
+    res = {}
+    for i in json.loads(jwks_json):
+        res[i["kid"]] = {
+            "private": private_pem_from_jwk(i),
+            "public": public_pem_from_jwk(i),
+        }
+    return json.dumps(res)
+
+
+def pems_from_private_jwks(jwks: list) -> dict:
+    """
+    private and public PEMs of a set of private jwks, by kid
+    """
+    return json.loads(_pems_from_json(json.dumps(jwks, sort_keys=True)))
@@ -2,23 +2,33 @@ import base64
 import binascii
 import json
 import logging
+import os
+import socket
+import socketserver
 
 import cryptojwt
 from cryptojwt.exception import UnsupportedAlgorithm, VerificationError
-from cryptojwt.jwe.jwe import factory
-from cryptojwt.jwe.jwe_ec import JWE_EC
+from cryptojwt.jwe.jwe import JWE, factory
 from cryptojwt.jwe.jwe_rsa import JWE_RSA
 from cryptojwt.jwk.jwk import key_from_jwk_dict
 from cryptojwt.jws.jws import JWS
 from cryptojwt.jws.utils import left_hash
+from concurrent.futures import ProcessPoolExecutor
+from django.utils.module_loading import import_string
+from functools import lru_cache
 from typing import Union
 
+from .exceptions import JwsSignerError, UnknownKid
+from .jwks import default_jwe_alg, default_jws_alg
 from .settings import (
     DEFAULT_JWE_ALG,
     DEFAULT_JWE_ENC,
     ENCRYPTION_ALG_VALUES_SUPPORTED,
+    OIDCFED_JWS_SIGNER,
     SIGNING_ALG_VALUES_SUPPORTED,
 )
+from .metrics import JWS_OPERATIONS
+from .tracing import span
 
 logger = logging.getLogger(__name__)
 
@@ -42,11 +52,6 @@ def create_jwe(plain_dict: Union[dict, str, int, None], jwk_dict: dict, **kwargs
     logger.debug(f"Encrypting dict as JWE: " f"{plain_dict}")
     _key = key_from_jwk_dict(jwk_dict)
 
-    if isinstance(_key, cryptojwt.jwk.rsa.RSAKey):
-        JWE_CLASS = JWE_RSA
-    elif isinstance(_key, cryptojwt.jwk.ec.ECKey):
-        JWE_CLASS = JWE_EC
-
     if isinstance(plain_dict, dict):
         _payload = json.dumps(plain_dict).encode()
     elif not plain_dict:
@@ -58,15 +63,20 @@ def create_jwe(plain_dict: Union[dict, str, int, None], jwk_dict: dict, **kwargs
         logger.error("create_jwe with unsupported payload type!")
         _payload = ""
 
-    _keyobj = JWE_CLASS(
-        _payload,
-        alg=DEFAULT_JWE_ALG,
-        enc=DEFAULT_JWE_ENC,
-        kid=_key.kid,
-        **kwargs
-    )
-
-    jwe = _keyobj.encrypt(_key.public_key())
+    _alg = default_jwe_alg(jwk_dict)
+    if isinstance(_key, cryptojwt.jwk.ec.ECKey):
+        # the ephemeral key agreement of ECDH-ES is set up by the generic JWE
+        _keyobj = JWE(_payload, alg=_alg, enc=DEFAULT_JWE_ENC, kid=_key.kid, **kwargs)
+        jwe = _keyobj.encrypt(keys=[_key])
+    else:
+        _keyobj = JWE_RSA(
+            _payload,
+            alg=_alg,
+            enc=DEFAULT_JWE_ENC,
+            kid=_key.kid,
+            **kwargs
+        )
+        jwe = _keyobj.encrypt(_key.public_key())
     logger.debug(f"Encrypted dict as JWE: {jwe}")
     return jwe
 
@@ -101,21 +111,30 @@ def decrypt_jwe(jwe: str, jwk_dict: dict) -> dict:
     return msg_dict
 
 
-def create_jws(payload: dict, jwk_dict: dict, alg: str = "RS256", protected:dict = {}, **kwargs) -> str:
+def create_jws(payload: dict, jwk_dict: dict, alg: str = None, protected:dict = {}, **kwargs) -> str:
     _key = key_from_jwk_dict(jwk_dict)
+    alg = alg or default_jws_alg(jwk_dict)
     _signer = JWS(payload, alg=alg, **kwargs)
 
     signature = _signer.sign_compact([_key], protected=protected, **kwargs)
+    JWS_OPERATIONS.inc(operation="sign", alg=alg)
     return signature
 
 
 def verify_jws(jws: str, pub_jwk: dict, **kwargs) -> str:
     _key = key_from_jwk_dict(pub_jwk)
+    _key.kid = pub_jwk["kid"]
+    return verify_jws_with_key(jws, _key, **kwargs)
+
 
+def verify_jws_with_key(jws: str, key, **kwargs) -> str:
+    """
+    as verify_jws but with an already loaded key
+    """
     _head = unpad_jwt_head(jws)
-    if _head.get("kid") != pub_jwk["kid"]:  # pragma: no cover
+    if _head.get("kid") != key.kid:  # pragma: no cover
         raise Exception(
-            f"kid error: {_head.get('kid')} != {pub_jwk['kid']}"
+            f"kid error: {_head.get('kid')} != {key.kid}"
         )
 
     _alg = _head["alg"]
@@ -123,7 +142,9 @@ def verify_jws(jws: str, pub_jwk: dict, **kwargs) -> str:
         raise UnsupportedAlgorithm(f"{_alg} has beed disabled for security reason")
 
     verifier = JWS(alg=_head["alg"], **kwargs)
-    msg = verifier.verify_compact(jws, [_key])
+    with span("jws.verify", alg=_alg):
+        msg = verifier.verify_compact(jws, [key])
+    JWS_OPERATIONS.inc(operation="verify", alg=_alg)
     return msg
 
 
@@ -135,3 +156,256 @@ def verify_at_hash(id_token, access_token) -> bool:
             f"at_hash error: {at_hash} != {id_token_at_hash}"
         )
     return True
+
+
+@lru_cache(maxsize=128)
+def _key_from_jwk_json(jwk_json: str):
+    return key_from_jwk_dict(json.loads(jwk_json))
+
+
+def cached_key_from_jwk_dict(jwk_dict: dict):
+    """
+    parses a jwk once, the following calls with the same jwk
+    return the already loaded key
+    """
+    return _key_from_jwk_json(json.dumps(jwk_dict, sort_keys=True))
+
+
+def _sign_with_key(payload: dict, key, alg: str, protected: dict, **kwargs) -> str:
+    _signer = JWS(payload, alg=alg, **kwargs)
+    return _signer.sign_compact([key], protected=protected, **kwargs)
+
+
+def _count_signatures(requests: list) -> None:
+    for i in requests:
+        JWS_OPERATIONS.inc(
+            operation="sign", alg=i.get("alg", None) or default_jws_alg(i["jwk_dict"])
+        )
+
+
+class JwsSigner:
+    """
+    Signs in the calling process.
+    A sign request is a dict with the same arguments of create_jws:
+    payload, jwk_dict, alg, protected and any other JWS header.
+
+    The signatures are counted by the process that requests them,
+    the subclasses that sign elsewhere override _sign_many only.
+    """
+
+    def sign(
+        self, payload: dict, jwk_dict: dict, alg: str = None, protected: dict = {}, **kwargs
+    ) -> str:
+        return self.sign_many(
+            [dict(payload=payload, jwk_dict=jwk_dict, alg=alg, protected=protected, **kwargs)]
+        )[0]
+
+    def sign_many(self, requests: list) -> list:
+        res = self._sign_many(requests)
+        _count_signatures(requests)
+        return res
+
+    def _sign_many(self, requests: list) -> list:
+        res = []
+        for i in requests:
+            i = dict(i)
+            jwk_dict = i.pop("jwk_dict")
+            res.append(
+                _sign_with_key(
+                    i.pop("payload"),
+                    cached_key_from_jwk_dict(jwk_dict),
+                    i.pop("alg", None) or default_jws_alg(jwk_dict),
+                    i.pop("protected", {}),
+                    **i
+                )
+            )
+        return res
+
+
+# keys loaded once in each process of the pool
+_WORKER_KEYS = {}
+
+
+def _load_worker_keys(jwks: list) -> None:
+    for jwk_dict in jwks:
+        _WORKER_KEYS[jwk_dict["kid"]] = key_from_jwk_dict(jwk_dict)
+
+
+def _sign_in_worker(
+    payload: dict, kid: str, alg: str, protected: dict, kwargs: dict, jwk_dict: dict = None
+) -> str:
+    if jwk_dict:
+        _key = cached_key_from_jwk_dict(jwk_dict)
+    elif kid in _WORKER_KEYS:
+        _key = _WORKER_KEYS[kid]
+    else:
+        raise UnknownKid(f"{kid} not loaded in the signer")
+    return _sign_with_key(payload, _key, alg, protected, **kwargs)
+
+
+class ProcessPoolJwsSigner(JwsSigner):
+    """
+    Dispatches the signatures to a pool of processes.
+    The keys in jwks are loaded once by each process and then
+    only their kid is sent along with the payload.
+    """
+
+    def __init__(self, max_workers: int = None, jwks: list = []):
+        self.max_workers = max_workers
+        self.jwks = jwks
+        self.preloaded_kids = {i["kid"] for i in jwks}
+        self.executor = None
+
+    def get_executor(self) -> ProcessPoolExecutor:
+        # created on first use, after the fork of the application server
+        if not self.executor:
+            self.executor = ProcessPoolExecutor(
+                max_workers=self.max_workers,
+                initializer=_load_worker_keys,
+                initargs=(self.jwks,),
+            )
+        return self.executor
+
+    def submit(
+        self, payload: dict, jwk_dict: dict, alg: str = None, protected: dict = {}, **kwargs
+    ):
+        kid = jwk_dict.get("kid", None)
+        return self.get_executor().submit(
+            _sign_in_worker,
+            payload,
+            kid,
+            alg or default_jws_alg(jwk_dict),
+            protected,
+            kwargs,
+            None if kid in self.preloaded_kids else jwk_dict,
+        )
+
+    def _sign_many(self, requests: list) -> list:
+        futures = [self.submit(**i) for i in requests]
+        return [i.result() for i in futures]
+
+    def shutdown(self) -> None:
+        if self.executor:
+            self.executor.shutdown()
+            self.executor = None
+
+
+class UnixSocketJwsSigner(JwsSigner):
+    """
+    Client of a local JwsSignerServer.
+    Only the kid of the signing key is sent to the signer,
+    the private keys are held by the signer process.
+    """
+
+    def __init__(self, path: str, timeout: int = 4):
+        self.path = path
+        self.timeout = timeout
+
+    def _sign_many(self, requests: list) -> list:
+        msg = []
+        for i in requests:
+            i = dict(i)
+            jwk_dict = i.pop("jwk_dict")
+            msg.append(
+                dict(
+                    payload=i.pop("payload"),
+                    kid=jwk_dict["kid"],
+                    alg=i.pop("alg", None) or default_jws_alg(jwk_dict),
+                    protected=i.pop("protected", {}),
+                    kwargs=i,
+                )
+            )
+
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(self.timeout)
+            sock.connect(self.path)
+            sock.sendall(json.dumps(msg).encode() + b"\n")
+            res = json.loads(sock.makefile("rb").readline() or b"{}")
+
+        if "jws" not in res:
+            raise JwsSignerError(
+                f"Signer at {self.path} failed: {res.get('error', 'empty response')}"
+            )
+        return res["jws"]
+
+
+class JwsSignerRequestHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        try:
+            requests = []
+            for i in json.loads(self.rfile.readline()):
+                if i["kid"] not in self.server.jwks:
+                    raise UnknownKid(f"{i['kid']} not loaded in the signer")
+                requests.append(
+                    dict(
+                        payload=i["payload"],
+                        jwk_dict=self.server.jwks[i["kid"]],
+                        alg=i["alg"],
+                        protected=i["protected"],
+                        **i["kwargs"]
+                    )
+                )
+            # counted by the clients
+            res = {"jws": self.server.signer._sign_many(requests)}
+        except Exception as e:
+            logger.error(f"JWS signer request failed: {e}")
+            res = {"error": str(e)}
+        self.wfile.write(json.dumps(res).encode() + b"\n")
+
+
+class JwsSignerServer(socketserver.ThreadingUnixStreamServer):
+    """
+    Local signer daemon, listening on a Unix socket.
+    It loads the private keys once and signs with a pool of processes
+    if max_workers is configured.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, path: str, jwks: list, max_workers: int = 0):
+        self.jwks = {i["kid"]: i for i in jwks}
+        if max_workers:
+            self.signer = ProcessPoolJwsSigner(max_workers=max_workers, jwks=jwks)
+        else:
+            self.signer = JwsSigner()
+        super().__init__(path, JwsSignerRequestHandler)
+
+    def server_bind(self):
+        # the socket is created by bind, only for the owner and the group
+        # from the start and not after a chmod
+        umask = os.umask(0o117)
+        try:
+            super().server_bind()
+        finally:
+            os.umask(umask)
+
+    def server_close(self):
+        super().server_close()
+        if isinstance(self.signer, ProcessPoolJwsSigner):
+            self.signer.shutdown()
+
+
+_JWS_SIGNER = None
+
+
+def get_jws_signer() -> JwsSigner:
+    """
+    returns the signer configured in OIDCFED_JWS_SIGNER
+    """
+    global _JWS_SIGNER
+    if _JWS_SIGNER is None:
+        if OIDCFED_JWS_SIGNER:
+            _JWS_SIGNER = import_string(OIDCFED_JWS_SIGNER["class"])(
+                **OIDCFED_JWS_SIGNER.get("kwargs", {})
+            )
+        else:
+            _JWS_SIGNER = JwsSigner()
+    return _JWS_SIGNER
+
+
+def sign_jws(payload: dict, jwk_dict: dict, alg: str = None, **kwargs) -> str:
+    """
+    as create_jws but through the configured signing service
+    """
+    return get_jws_signer().sign(payload, jwk_dict, alg=alg, **kwargs)
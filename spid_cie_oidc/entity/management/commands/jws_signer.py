@@ -0,0 +1,66 @@
+import logging
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.translation import gettext as _
+
+from spid_cie_oidc.entity.jwtse import JwsSignerServer
+from spid_cie_oidc.entity.models import FederationEntityConfiguration
+
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = (
+        "Local JWS signer daemon listening on a Unix socket, "
+        "it holds the private keys of the active entity configurations"
+    )
+
+    def add_arguments(self, parser):
+        parser.epilog = (
+            "Example: ./manage.py jws_signer -s /run/spid-cie-oidc/signer.sock -w 4"
+        )
+        parser.add_argument(
+            "-s",
+            "--socket",
+            required=True,
+            help=_("Path of the Unix socket"),
+        )
+        parser.add_argument(
+            "-w",
+            "--workers",
+            type=int,
+            required=False,
+            default=os.cpu_count(),
+            help=_("Number of signing processes, 0 signs in the daemon process"),
+        )
+        parser.add_argument(
+            "-debug", required=False, action="store_true", help="see debug message"
+        )
+
+    def handle(self, *args, **options):
+        jwks = []
+        for conf in FederationEntityConfiguration.objects.filter(is_active=True):
+            jwks.extend(conf.jwks_fed)
+            jwks.extend(conf.jwks_core)
+
+        if not jwks:
+            raise CommandError(_("No active entity configuration found"))
+
+        if os.path.exists(options["socket"]):
+            os.unlink(options["socket"])
+
+        server = JwsSignerServer(
+            options["socket"], jwks=jwks, max_workers=options["workers"]
+        )
+        logger.info(
+            f"JWS signer listening on {options['socket']} with {len(jwks)} keys"
+        )
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt: # pragma: no cover
+            pass
+        finally:
+            server.server_close()
+            os.unlink(options["socket"])
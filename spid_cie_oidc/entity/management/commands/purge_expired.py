@@ -0,0 +1,70 @@
+import json
+import logging
+import time
+
+from django.core.management.base import BaseCommand
+from django.utils.translation import gettext as _
+
+from spid_cie_oidc.entity.purge import purge_expired
+from spid_cie_oidc.entity.settings import OIDCFED_PURGE_BATCH_SIZE
+
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = (
+        "Deletes the expired or revoked sessions, tokens, authorizations "
+        "and fetched entity statements according to OIDCFED_PURGE_RETENTION"
+    )
+
+    def add_arguments(self, parser):
+        parser.epilog = "Example: ./manage.py purge_expired --batch-size 1000"
+        parser.add_argument(
+            "-b",
+            "--batch-size",
+            type=int,
+            required=False,
+            default=OIDCFED_PURGE_BATCH_SIZE,
+            help=_("Maximum number of rows deleted in each transaction"),
+        )
+        parser.add_argument(
+            "-p",
+            "--pause",
+            type=float,
+            required=False,
+            default=0,
+            help=_("Seconds to wait between two batches"),
+        )
+        parser.add_argument(
+            "-e",
+            "--every",
+            type=int,
+            required=False,
+            default=0,
+            help=_("Runs the purge every given seconds, forever"),
+        )
+        parser.add_argument(
+            "-debug", required=False, action="store_true", help="see debug message"
+        )
+
+    def purge(self, options):
+        start = time.perf_counter()
+        deleted = purge_expired(
+            batch_size=options["batch_size"], pause=options["pause"]
+        )
+        self.stdout.write(
+            json.dumps(
+                {
+                    "deleted": deleted,
+                    "total": sum(deleted.values()),
+                    "seconds": round(time.perf_counter() - start, 3),
+                }
+            )
+        )
+
+    def handle(self, *args, **options):
+        self.purge(options)
+        while options["every"]:
+            time.sleep(options["every"])
+            self.purge(options)
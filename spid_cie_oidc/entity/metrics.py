@@ -0,0 +1,381 @@
+import atexit
+import contextlib
+import glob
+import json
+import logging
+import os
+import threading
+import time
+from urllib.parse import urlparse
+
+from .settings import OIDCFED_METRICS
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Metric:
+    type = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple, registry):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.registry = registry
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels.get(i, "")) for i in self.labelnames)
+
+    def reset(self) -> None:
+        with self._lock:
+            self._values = {}
+
+    def values(self) -> list:
+        with self._lock:
+            return [[list(k), v] for k, v in self._values.items()]
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+        self.registry.maybe_flush()
+
+
+class Histogram(Metric):
+    """
+    the observations are counted in cumulative buckets, as in Prometheus
+    """
+
+    type = "histogram"
+
+    def __init__(self, *args, buckets: tuple = DEFAULT_BUCKETS, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            # the counts of each bucket, then sum and count
+            _value = self._values.get(key)
+            if _value is None:
+                _value = self._values[key] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    _value[i] += 1
+            _value[-2] += value
+            _value[-1] += 1
+        self.registry.maybe_flush()
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def values(self) -> list:
+        with self._lock:
+            return [[list(k), list(v)] for k, v in self._values.items()]
+
+
+def _format_labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    _labels = ",".join(
+        '{}="{}"'.format(
+            k, str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        )
+        for k, v in labels.items()
+    )
+    return f"{{{_labels}}}"
+
+
+def get_host(url: str) -> str:
+    return urlparse(url).netloc
+
+
+def _merge_snapshot(res: dict, snapshot: dict) -> dict:
+    """
+    adds the values of a snapshot to the ones of res, by metric and labels
+    """
+    for name, metric in snapshot.items():
+        merged = res.setdefault(name, dict(metric, values=[]))
+        values = {tuple(k): v for k, v in merged["values"]}
+        for labels, value in metric["values"]:
+            labels = tuple(labels)
+            if labels not in values:
+                values[labels] = value
+            elif isinstance(value, list):
+                values[labels] = [a + b for a, b in zip(values[labels], value)]
+            else:
+                values[labels] += value
+        merged["values"] = [[list(k), v] for k, v in values.items()]
+    return res
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Registry:
+    """
+    The counters and histograms of a process.
+    With a directory each process writes its values in it,
+    at most every flush_interval seconds,
+    and the exposition sums the values of all of them.
+    When a process exits its values are merged in the ones of the dead processes,
+    so that its file is not summed forever, nor overwritten by a new process with its pid
+    """
+
+    def __init__(self, directory: str = None, flush_interval: float = 5):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.metrics = {}
+        self._lock = threading.Lock()
+        self._next_flush = 0
+        if hasattr(os, "register_at_fork"):
+            os.register_at_fork(after_in_child=self._after_fork)
+        if directory:
+            # left by a killed process with the same pid
+            self.mark_process_dead(os.getpid())
+            atexit.register(self.exit)
+
+    def _after_fork(self) -> None:
+        # the values of the parent must not be counted again by its workers
+        self.reset()
+        if self.directory:
+            self.mark_process_dead(os.getpid())
+
+    def _get(self, cls, name: str, documentation: str, labelnames: tuple, **kwargs):
+        metric = self.metrics.get(name)
+        if metric is None:
+            with self._lock:
+                metric = self.metrics.get(name)
+                if metric is None:
+                    metric = cls(name, documentation, labelnames, self, **kwargs)
+                    self.metrics[name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: tuple = ()) -> Counter:
+        return self._get(Counter, name, documentation, labelnames)
+
+    def histogram(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: tuple = (),
+        buckets: tuple = DEFAULT_BUCKETS
+    ) -> Histogram:
+        return self._get(Histogram, name, documentation, labelnames, buckets=buckets)
+
+    def reset(self) -> None:
+        for metric in list(self.metrics.values()):
+            metric.reset()
+        self._next_flush = 0
+
+    def snapshot(self) -> dict:
+        return {
+            name: {
+                "type": metric.type,
+                "help": metric.documentation,
+                "labelnames": list(metric.labelnames),
+                "buckets": list(getattr(metric, "buckets", [])),
+                "values": metric.values(),
+            }
+            for name, metric in list(self.metrics.items())
+        }
+
+    @property
+    def path(self) -> str:
+        return self.get_path(os.getpid())
+
+    def get_path(self, pid) -> str:
+        return os.path.join(self.directory, f"metrics_{pid}.json")
+
+    @contextlib.contextmanager
+    def _directory_lock(self):
+        """
+        serializes the merges of the dead processes and the reads of the directory
+        """
+        if not fcntl:  # pragma: no cover
+            yield
+            return
+        with open(os.path.join(self.directory, "metrics.lock"), "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _read(self, path: str) -> dict:
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:  # pragma: no cover
+            logger.warning(f"Metrics of {path} not readable: {e}")
+            return None
+
+    def _write(self, path: str, snapshot: dict) -> None:
+        tmp = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(snapshot, f)
+        os.replace(tmp, path)
+
+    def mark_process_dead(self, pid) -> None:
+        """
+        merges the values written by the process pid in the ones of the dead processes
+        and removes its file. Called at the exit of each process,
+        it can be called by the application server for the killed ones,
+        eg: the uwsgi worker recycled with its pid
+        """
+        path = self.get_path(pid)
+        if not os.path.exists(path):
+            return
+        with self._directory_lock():
+            snapshot = self._read(path)
+            if snapshot is None:
+                return
+            dead_path = self.get_path("dead")
+            self._write(dead_path, _merge_snapshot(self._read(dead_path) or {}, snapshot))
+            os.remove(path)
+
+    def exit(self) -> None:
+        self.flush()
+        self.mark_process_dead(os.getpid())
+
+    def maybe_flush(self) -> None:
+        if self.directory and time.monotonic() >= self._next_flush:
+            self.flush()
+
+    def flush(self) -> None:
+        self._next_flush = time.monotonic() + self.flush_interval
+        try:
+            self._write(self.path, self.snapshot())
+        except OSError as e:  # pragma: no cover
+            logger.error(f"Metrics flush to {self.directory} failed: {e}")
+
+    def collect(self) -> dict:
+        """
+        the values of this process or, with a directory, of all the processes
+        """
+        if not self.directory:
+            return self.snapshot()
+
+        self.flush()
+        res = {}
+        # the alive processes and the dead ones, metrics_dead.json
+        with self._directory_lock():
+            for path in glob.glob(os.path.join(self.directory, "metrics_*.json")):
+                snapshot = self._read(path)
+                if snapshot:
+                    _merge_snapshot(res, snapshot)
+        return res
+
+    def exposition(self) -> str:
+        """
+        the Prometheus text format (version 0.0.4)
+        """
+        lines = []
+        for name, metric in sorted(self.collect().items()):
+            lines.append(f"# HELP {name} {metric['help']}")
+            lines.append(f"# TYPE {name} {metric['type']}")
+            for label_values, value in sorted(metric["values"]):
+                labels = dict(zip(metric["labelnames"], label_values))
+                if metric["type"] != "histogram":
+                    lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+                    continue
+                for bound, count in zip(
+                    metric["buckets"] + [float("inf")], value[:-2] + [value[-1]]
+                ):
+                    _labels = dict(labels, le=_format_value(float(bound)))
+                    lines.append(f"{name}_bucket{_format_labels(_labels)} {count}")
+                lines.append(
+                    f"{name}_sum{_format_labels(labels)} {_format_value(value[-2])}"
+                )
+                lines.append(f"{name}_count{_format_labels(labels)} {value[-1]}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry(
+    directory=OIDCFED_METRICS["directory"],
+    flush_interval=OIDCFED_METRICS["flush_interval"],
+)
+
+TRUST_CHAIN_BUILDS = REGISTRY.counter(
+    "oidcfed_trust_chain_builds_total",
+    "Trust chains built, by trust anchor and result",
+    ("trust_anchor", "result"),
+)
+TRUST_CHAIN_BUILD_SECONDS = REGISTRY.histogram(
+    "oidcfed_trust_chain_build_seconds",
+    "Duration of the trust chain builds, by trust anchor",
+    ("trust_anchor",),
+)
+CACHE_REQUESTS = REGISTRY.counter(
+    "oidcfed_cache_requests_total",
+    "Lookups in the caches, by cache and result (hit or miss)",
+    ("cache", "result"),
+)
+HTTP_REQUEST_SECONDS = REGISTRY.histogram(
+    "oidcfed_http_request_seconds",
+    "Duration of the outgoing HTTP requests, by host",
+    ("host",),
+)
+JWS_OPERATIONS = REGISTRY.counter(
+    "oidcfed_jws_operations_total",
+    "JWS signatures and verifications, by operation and algorithm",
+    ("operation", "alg"),
+)
+TOKENS_ISSUED = REGISTRY.counter(
+    "oidcfed_provider_tokens_issued_total",
+    "Tokens issued by the provider, by grant type",
+    ("grant_type",),
+)
+USERINFO_SECONDS = REGISTRY.histogram(
+    "oidcfed_relying_party_userinfo_seconds",
+    "Duration of the userinfo requests of the relying party, by provider",
+    ("provider",),
+)
+FETCHED_STATEMENTS = REGISTRY.counter(
+    "oidcfed_authority_fetch_total",
+    "Requests to the fetch endpoint, by result (issued or not_found)",
+    ("result",),
+)
+REPLAY_REJECTIONS = REGISTRY.counter(
+    "oidcfed_replay_rejections_total",
+    "Requests rejected as replays, by kind",
+    ("kind",),
+)
+VIEW_QUERIES = REGISTRY.histogram(
+    "oidcfed_view_queries",
+    "DB queries of the sampled requests, by view",
+    ("view",),
+    buckets=(0, 1, 2, 5, 10, 20, 50, 100),
+)
+VIEW_QUERY_SECONDS = REGISTRY.histogram(
+    "oidcfed_view_query_seconds",
+    "Time spent in the DB queries of the sampled requests, by view",
+    ("view",),
+)
+QUERY_BUDGET_EXCEEDED = REGISTRY.counter(
+    "oidcfed_query_budget_exceeded_total",
+    "Sampled requests over the query budget of their view, by view",
+    ("view",),
+)
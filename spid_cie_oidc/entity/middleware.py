@@ -0,0 +1,92 @@
+import contextlib
+import logging
+import random
+import time
+from collections import Counter
+
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+
+from .metrics import QUERY_BUDGET_EXCEEDED, VIEW_QUERIES, VIEW_QUERY_SECONDS
+from .settings import OIDCFED_QUERY_BUDGET
+
+logger = logging.getLogger(__name__)
+
+
+def get_query_budget(view_name: str) -> int:
+    """
+    the maximum number of DB queries of a request to view_name
+    """
+    return OIDCFED_QUERY_BUDGET["views"].get(view_name, OIDCFED_QUERY_BUDGET["default"])
+
+
+class QueryProfile:
+    """
+    execute_wrapper that counts and times the DB queries of a request
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.elapsed = 0
+        self.statements = Counter()
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.elapsed += time.perf_counter() - start
+            self.count += 1
+            self.statements[sql] += 1
+
+    @contextlib.contextmanager
+    def profiling(self):
+        with contextlib.ExitStack() as stack:
+            for conn in connections.all():
+                stack.enter_context(conn.execute_wrapper(self))
+            yield self
+
+    def most_repeated(self) -> tuple:
+        """
+        the SQL executed most times and how many, a hint of an N+1
+        """
+        return self.statements.most_common(1)[0] if self.statements else ("", 0)
+
+
+class QueryBudgetMiddleware:
+    """
+    Counts and times the DB queries of a sample of the requests, by view,
+    and logs a warning when a view exceeds its budget in OIDCFED_QUERY_BUDGET
+    """
+
+    def __init__(self, get_response):
+        if not OIDCFED_QUERY_BUDGET["sample_rate"]:
+            raise MiddlewareNotUsed()
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if random.random() >= OIDCFED_QUERY_BUDGET["sample_rate"]:  # nosec B311
+            return self.get_response(request)
+
+        with QueryProfile().profiling() as profile:
+            response = self.get_response(request)
+
+        # the not resolved ones, 404, are not accounted
+        if not request.resolver_match:
+            return response
+
+        view_name = request.resolver_match.view_name
+        VIEW_QUERIES.observe(profile.count, view=view_name)
+        VIEW_QUERY_SECONDS.observe(profile.elapsed, view=view_name)
+
+        budget = get_query_budget(view_name)
+        if profile.count > budget:
+            QUERY_BUDGET_EXCEEDED.inc(view=view_name)
+            sql, repeated = profile.most_repeated()
+            logger.warning(
+                f"{request.method} {request.path} ({view_name}) executed "
+                f"{profile.count} DB queries in {profile.elapsed * 1000:.2f} ms, "
+                f"over its budget of {budget}. "
+                f"The most repeated one, {repeated} times: {sql}"
+            )
+        return response
@@ -0,0 +1,25 @@
+# Generated by Django 4.2.3 on 2026-10-19 04:56
+
+from django.db import migrations, models
+import spid_cie_oidc.entity.models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        (
+            "spid_cie_oidc_entity",
+            "0032_alter_fetchedentitystatement_jwt",
+        ),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="federationentityconfiguration",
+            name="default_signature_alg",
+            field=models.CharField(
+                default=spid_cie_oidc.entity.models.FederationEntityConfiguration._default_signature_alg,
+                help_text="default signature algorithm, eg: RS256, ES256",
+                max_length=16,
+            ),
+        ),
+    ]
@@ -1,29 +1,37 @@
 import json
 import logging
+import threading
+import time
 from typing import Union
 import uuid
 
 from cryptojwt.jwk.jwk import key_from_jwk_dict
 from django.contrib.auth import get_user_model
+from django.core.exceptions import ValidationError
 from django.db import models
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
 from django.utils import timezone
 from django.utils.translation import gettext as _
 from spid_cie_oidc.entity.abstract_models import TimeStampedModel
 from spid_cie_oidc.entity.jwks import (
     create_jwk,
-    private_pem_from_jwk,
-    public_pem_from_jwk,
-    serialize_rsa_key
+    pems_from_private_jwks,
+    public_jwks_from_private_jwks
 )
-from spid_cie_oidc.entity.jwtse import create_jws
+from spid_cie_oidc.entity.jwtse import sign_jws
+from spid_cie_oidc.entity.metrics import CACHE_REQUESTS
 from spid_cie_oidc.entity.settings import (
+    DEFAULT_JWS_ALG,
     ENTITY_STATUS,
     ENTITY_TYPE_LEAFS,
     ENTITY_TYPES,
-    FEDERATION_DEFAULT_EXP
+    FEDERATION_DEFAULT_EXP,
+    OIDCFED_ENTITY_CONF_CACHE_TTL,
+    OIDCFED_TRUST_CHAIN_CACHE_TTL
 )
 from spid_cie_oidc.entity.statements import EntityConfiguration
-from spid_cie_oidc.entity.utils import exp_from_now, iat_now, random_token
+from spid_cie_oidc.entity.utils import exp_from_now, get_jwks, iat_now, random_token
 from spid_cie_oidc.entity.validators import (
     validate_entity_metadata,
     validate_metadata_algs,
@@ -34,6 +42,17 @@ from .jwks import public_jwk_from_private_jwk
 
 logger = logging.getLogger(__name__)
 
+# process wide cache of the configurations of this entity
+# {lookup: (expiration, FederationEntityConfiguration or None)}
+_ENTITY_CONF_CACHE = {}
+
+# process wide cache of the deserialized trust chains
+# {(sub, trust anchors, entity_type, active only): TrustChainSnapshot}
+_TRUST_CHAIN_SNAPSHOTS = {}
+# shared by the request threads of the process, guards the changes
+_TRUST_CHAIN_SNAPSHOTS_LOCK = threading.Lock()
+TRUST_CHAIN_SNAPSHOTS_MAX_SIZE = 4096
+
 
 def is_leaf(statement_metadata):
     for _typ in ENTITY_TYPE_LEAFS:
@@ -49,6 +68,9 @@ class FederationEntityConfiguration(TimeStampedModel):
     def _create_jwks():
         return [create_jwk()]
 
+    def _default_signature_alg():
+        return DEFAULT_JWS_ALG
+
     uuid = models.UUIDField(
         blank=False, null=False, default=uuid.uuid4, unique=True, editable=False
     )
@@ -67,10 +89,10 @@ class FederationEntityConfiguration(TimeStampedModel):
     )
     default_signature_alg = models.CharField(
         max_length=16,
-        default="RS256",
+        default=_default_signature_alg,
         blank=False,
         null=False,
-        help_text=_("default signature algorithm, eg: RS256"),
+        help_text=_("default signature algorithm, eg: RS256, ES256"),
     )
     authority_hints = models.JSONField(
         blank=True,
@@ -171,26 +193,47 @@ class FederationEntityConfiguration(TimeStampedModel):
         """
         returns the first available active acsia engine configuration found
         """
-        return cls.objects.filter(is_active=True).first()
+        return cls.get_cached(is_active=True)
+
+    @classmethod
+    def get_cached(cls, **lookup):
+        """
+        returns the first configuration that matches the lookup,
+        reusing the one loaded by the previous calls.
+        The cache is cleared when a configuration is saved or deleted.
+        The returned instance is shared, it must not be changed without saving it.
+
+        Only for the fixed lookups of this entity: the ones built from the
+        request (sub, host, iss...) must query the DB, one entry is kept
+        for each lookup.
+        """
+        if not OIDCFED_ENTITY_CONF_CACHE_TTL:
+            return cls.objects.filter(**lookup).first()
+
+        key = tuple(
+            sorted(
+                (k, tuple(v) if isinstance(v, list) else v)
+                for k, v in lookup.items()
+            )
+        )
+        now = time.monotonic()
+        cached = _ENTITY_CONF_CACHE.get(key)
+        if cached and cached[0] > now:
+            CACHE_REQUESTS.inc(cache="entity_configuration", result="hit")
+            return cached[1]
+
+        CACHE_REQUESTS.inc(cache="entity_configuration", result="miss")
+        conf = cls.objects.filter(**lookup).first()
+        _ENTITY_CONF_CACHE[key] = (now + OIDCFED_ENTITY_CONF_CACHE_TTL, conf)
+        return conf
 
     @property
     def public_jwks(self):
-        res = []
-        for i in self.jwks_fed:
-            skey = serialize_rsa_key(key_from_jwk_dict(i).public_key())
-            skey["kid"] = i["kid"]
-            res.append(skey)
-        return res
+        return public_jwks_from_private_jwks(self.jwks_fed)
 
     @property
     def pems_as_dict(self):
-        res = {}
-        for i in self.jwks_fed:
-            res[i["kid"]] = {
-                "private": private_pem_from_jwk(i),
-                "public": public_pem_from_jwk(i),
-            }
-        return res
+        return pems_from_private_jwks(self.jwks_fed)
 
     @property
     def pems_as_json(self):
@@ -242,7 +285,7 @@ class FederationEntityConfiguration(TimeStampedModel):
 
     @property
     def entity_configuration_as_jws(self, **kwargs):
-        return create_jws(
+        return sign_jws(
             self.entity_configuration_as_dict,
             self.jwks_fed[0],
             alg=self.default_signature_alg,
@@ -262,6 +305,21 @@ class FederationEntityConfiguration(TimeStampedModel):
             if not isinstance(value, list):
                 setattr(self, i, [value])
 
+    def clean(self):
+        self.set_jwks_as_array()
+        if not self.jwks_fed:
+            return
+        kty = self.jwks_fed[0].get("kty")
+        if (kty == "EC") != self.default_signature_alg.startswith("ES"):
+            raise ValidationError(
+                {
+                    "default_signature_alg": _(
+                        f"{self.default_signature_alg} can't be used "
+                        f"with the {kty} key in jwks_fed"
+                    )
+                }
+            )
+
     def save(self, *args, **kwargs):
         self.set_jwks_as_array()
         super().save(*args, **kwargs)
@@ -308,6 +366,14 @@ class FetchedEntityStatement(TimeStampedModel):
     def is_expired(self):
         return self.exp <= timezone.localtime()
 
+    @classmethod
+    def get_purgeable(cls, before):
+        """
+        statements expired before the given datetime,
+        the ones still referenced by a trust chain are kept
+        """
+        return cls.objects.filter(exp__lt=before, trustchain__isnull=True)
+
     def __str__(self):
         return f"{self.sub} issued by {self.iss}"
 
@@ -403,6 +469,128 @@ class TrustChain(TimeStampedModel):
         )
 
 
+class TrustChainSnapshot:
+    """
+    Read only copy of a TrustChain, with its final metadata and its parsed keys,
+    shared by the requests of a worker process
+    """
+
+    def __init__(self, trust_chain: TrustChain):
+        self.pk = trust_chain.pk
+        self.sub = trust_chain.sub
+        self.trust_anchor = trust_chain.trust_anchor.sub
+        self.exp = trust_chain.exp
+        self.modified = trust_chain.modified
+        self.metadata = trust_chain.metadata
+        self.jwks = trust_chain.jwks
+        self.trust_marks = trust_chain.trust_marks
+        self.status = trust_chain.status
+        self.is_active = trust_chain.is_active
+        self.reload_at = time.monotonic() + OIDCFED_TRUST_CHAIN_CACHE_TTL
+        # {entity_type: [jwk, ...]}
+        self._jwks = {}
+        # {(entity_type, kid): parsed key}
+        self._keys = {}
+
+    @classmethod
+    def get(
+        cls, sub: str, entity_type: str, trust_anchors: list = (), active: bool = False
+    ):
+        """
+        returns the snapshot of the first trust chain of sub
+        with the metadata of entity_type, issued by one of the trust_anchors, by any if empty.
+        The active ones come first, with active=True they are the only ones returned.
+        The cached one is reused until OIDCFED_TRUST_CHAIN_CACHE_TTL,
+        then only if its version, the modified date of the chain, is still the one in the database.
+        The cache entries of a subject are dropped when one of its trust chains is saved or deleted.
+        """
+        key = (sub, tuple(trust_anchors), entity_type, active)
+        snapshot = _TRUST_CHAIN_SNAPSHOTS.get(key, None)
+        if snapshot and snapshot.is_current:
+            CACHE_REQUESTS.inc(cache="trust_chain_snapshot", result="hit")
+            return snapshot
+
+        CACHE_REQUESTS.inc(cache="trust_chain_snapshot", result="miss")
+        lookup = {
+            "sub": sub,
+            f"metadata__{entity_type}__isnull": False
+        }
+        if trust_anchors:
+            lookup["trust_anchor__sub__in"] = trust_anchors
+        if active:
+            lookup["is_active"] = True
+        trust_chain = TrustChain.objects.filter(
+            **lookup
+        ).select_related("trust_anchor").order_by("-is_active", "pk").first()
+        if not trust_chain:
+            with _TRUST_CHAIN_SNAPSHOTS_LOCK:
+                _TRUST_CHAIN_SNAPSHOTS.pop(key, None)
+            return None
+
+        snapshot = cls(trust_chain)
+        if OIDCFED_TRUST_CHAIN_CACHE_TTL:
+            with _TRUST_CHAIN_SNAPSHOTS_LOCK:
+                if len(_TRUST_CHAIN_SNAPSHOTS) >= TRUST_CHAIN_SNAPSHOTS_MAX_SIZE:
+                    # drops the oldest
+                    _TRUST_CHAIN_SNAPSHOTS.pop(next(iter(_TRUST_CHAIN_SNAPSHOTS)), None)
+                _TRUST_CHAIN_SNAPSHOTS[key] = snapshot
+        return snapshot
+
+    @property
+    def is_current(self) -> bool:
+        """
+        if the trust chain has not been changed since this snapshot.
+        After its TTL it's checked with the modified date in the database,
+        the one of an unchanged chain is then kept for another TTL
+        """
+        if self.reload_at > time.monotonic():
+            return True
+
+        modified = TrustChain.objects.filter(
+            pk=self.pk
+        ).values_list("modified", flat=True).first()
+        if modified != self.modified:
+            return False
+        self.reload_at = time.monotonic() + OIDCFED_TRUST_CHAIN_CACHE_TTL
+        return True
+
+    @property
+    def is_expired(self):
+        return self.exp <= timezone.localtime()
+
+    @property
+    def is_valid(self):
+        return self.is_active and ENTITY_STATUS[self.status]
+
+    def get_jwks(self, entity_type: str) -> list:
+        """
+        the keys of the metadata of entity_type, downloaded once if published by jwks_uri
+        """
+        jwks = self._jwks.get(entity_type, None)
+        if not jwks:
+            jwks = get_jwks(self.metadata[entity_type], federation_jwks=self.jwks)
+            self._jwks[entity_type] = jwks
+        return jwks
+
+    def get_key(self, entity_type: str, kid: str):
+        """
+        returns the parsed key with the given kid in the metadata of entity_type
+        """
+        if (entity_type, kid) not in self._keys:
+            for jwk in self.get_jwks(entity_type):
+                if kid and jwk.get("kid", None) == kid:
+                    self._keys[(entity_type, kid)] = key_from_jwk_dict(jwk)
+                    break
+            else:
+                raise KeyError(f"{self.sub}: unknown kid {kid} in {entity_type}")
+        return self._keys[(entity_type, kid)]
+
+    def __str__(self):
+        return "{} [{}] [{}]".format(
+            self.sub, self.trust_anchor, self.is_valid
+        )
+
+
 class StaffToken(TimeStampedModel):
     """
         Token provisioned to staffs operators for protected resources
@@ -528,5 +716,20 @@ def get_first_self_trust_anchor(
     """
     lk = dict(metadata__federation_entity__isnull=False, is_active=True)
     if sub:
-        lk["sub"] = sub
-    return FederationEntityConfiguration.objects.filter(**lk).first()
+        # requested by the clients, not cached
+        return FederationEntityConfiguration.objects.filter(sub=sub, **lk).first()
+    return FederationEntityConfiguration.get_cached(**lk)
+
+
+@receiver(post_save, sender=FederationEntityConfiguration)
+@receiver(post_delete, sender=FederationEntityConfiguration)
+def clear_entity_conf_cache(**kwargs):
+    _ENTITY_CONF_CACHE.clear()
+
+
+@receiver(post_save, sender=TrustChain)
+@receiver(post_delete, sender=TrustChain)
+def clear_trust_chain_snapshots(instance, **kwargs):
+    with _TRUST_CHAIN_SNAPSHOTS_LOCK:
+        for key in [i for i in _TRUST_CHAIN_SNAPSHOTS if i[0] == instance.sub]:
+            _TRUST_CHAIN_SNAPSHOTS.pop(key, None)
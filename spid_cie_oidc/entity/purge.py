@@ -0,0 +1,78 @@
+import logging
+import time
+
+from django.apps import apps
+from django.db import transaction
+from django.utils import timezone
+
+from .settings import OIDCFED_PURGE_BATCH_SIZE, OIDCFED_PURGE_RETENTION
+
+
+logger = logging.getLogger(__name__)
+
+
+def purge_queryset(
+    queryset, batch_size: int = OIDCFED_PURGE_BATCH_SIZE, pause: float = 0
+) -> dict:
+    """
+    deletes the rows of the queryset in ranges of at most batch_size
+    primary keys, each range in its own transaction.
+    Returns the number of deleted rows by model label, cascades included
+    """
+    pks = queryset.order_by("pk").values_list("pk", flat=True)
+    deleted = {}
+    last_pk = None
+    while True:
+        chunk = pks if last_pk is None else pks.filter(pk__gt=last_pk)
+        chunk = list(chunk[:batch_size])
+        if not chunk:
+            break
+        last_pk = chunk[-1]
+        with transaction.atomic():
+            _, per_model = queryset.filter(
+                pk__gte=chunk[0], pk__lte=last_pk
+            ).delete()
+        for label, rows in per_model.items():
+            deleted[label] = deleted.get(label, 0) + rows
+        if pause:
+            time.sleep(pause)
+    return deleted
+
+
+def purge_expired(
+    retention: dict = None,
+    batch_size: int = OIDCFED_PURGE_BATCH_SIZE,
+    pause: float = 0,
+) -> dict:
+    """
+    deletes the expired or revoked rows of the models in retention,
+    a dict of model labels and days to keep them, None skips the model.
+
+    It's the task to schedule periodically,
+    returns the number of deleted rows by model label
+    """
+    retention = retention or OIDCFED_PURGE_RETENTION
+    now = timezone.localtime()
+    deleted = {}
+    for label, days in retention.items():
+        if days is None:
+            continue
+        try:
+            model = apps.get_model(label)
+        except LookupError:
+            logger.debug(f"Purge of {label} skipped: app not installed")
+            continue
+
+        start = time.perf_counter()
+        per_model = purge_queryset(
+            model.get_purgeable(now - timezone.timedelta(days=days)),
+            batch_size=batch_size,
+            pause=pause,
+        )
+        for _label, rows in per_model.items():
+            deleted[_label] = deleted.get(_label, 0) + rows
+        logger.info(
+            f"Purged {per_model.get(label, 0)} rows of {label} "
+            f"older than {days} days in {time.perf_counter() - start:.3f}s"
+        )
+    return deleted
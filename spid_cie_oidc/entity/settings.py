@@ -14,8 +14,26 @@ ENCRYPTION_ENC_SUPPORTED = [
 
 DEFAULT_HASH_FUNC = "SHA-256"
 
-DEFAULT_JWS_ALG = getattr(settings, "DEFAULT_JWS_ALG", "RS256")
+# type of the keys created by default, "RSA" or "EC"
+DEFAULT_JWK_KTY = getattr(settings, "DEFAULT_JWK_KTY", "RSA")
+# curve of the EC keys created by default: "P-256", "P-384" or "P-521"
+DEFAULT_JWK_CRV = getattr(settings, "DEFAULT_JWK_CRV", "P-256")
+
+# JWS algorithm to use for each EC curve
+EC_CRV_JWS_ALG = {
+    "P-256": "ES256",
+    "P-384": "ES384",
+    "P-521": "ES512",
+}
+DEFAULT_RSA_JWS_ALG = getattr(settings, "DEFAULT_RSA_JWS_ALG", "RS256")
+DEFAULT_JWS_ALG = getattr(
+    settings,
+    "DEFAULT_JWS_ALG",
+    EC_CRV_JWS_ALG[DEFAULT_JWK_CRV] if DEFAULT_JWK_KTY == "EC" else DEFAULT_RSA_JWS_ALG
+)
 DEFAULT_JWE_ALG = getattr(settings, "DEFAULT_JWE_ALG", "RSA-OAEP")
+# JWE key management algorithm used with the EC keys
+DEFAULT_EC_JWE_ALG = getattr(settings, "DEFAULT_EC_JWE_ALG", "ECDH-ES+A256KW")
 DEFAULT_JWE_ENC = getattr(settings, "DEFAULT_JWE_ENC", "A256CBC-HS512")
 SIGNING_ALG_VALUES_SUPPORTED = getattr(
     settings,
@@ -61,9 +79,117 @@ HTTPC_PARAMS = getattr(
     },
 )
 
+# connection pools of the back-channel requests (token, userinfo, revocation...),
+# kept alive and shared by all the requests of a process
+HTTPC_POOL = {
+    # connections kept alive for each host
+    "maxsize": 10,
+    # hosts with a pool
+    "hosts": 32,
+    # waits for a free connection instead of opening more than maxsize
+    "block": False,
+    # retries of the failed connections, a request already sent is never retried
+    "retries": 2,
+    "backoff_factor": 0.1,
+}
+HTTPC_POOL.update(getattr(settings, "HTTPC_POOL", {}))
+
+# routes the resolve endpoint, the OP authorization endpoint and the RP
+# begin and callback views to their async variants, for the ASGI deployments.
+# Their trust chains and back-channel requests are made with the AsyncHttpClient
+OIDCFED_ASYNC_VIEWS = getattr(settings, "OIDCFED_ASYNC_VIEWS", False)
+
+# django cache where the signed responses of the resolve endpoint are kept
+# until the expiration of their trust chain, by subject, trust anchor
+# and version of the chain. None disables it
+OIDCFED_RESOLVE_CACHE = getattr(settings, "OIDCFED_RESOLVE_CACHE", "default")
+
 # in minutes
 MAX_ACCEPTED_TIMEDIFF = 5
 
+# in seconds, how long a worker process reuses the entity configurations
+# of this entity before reloading them, 0 disables the cache.
+# Changes made by the same process are applied immediately
+OIDCFED_ENTITY_CONF_CACHE_TTL = getattr(settings, "OIDCFED_ENTITY_CONF_CACHE_TTL", 60)
+
+# in seconds, how long a worker process reuses the deserialized trust chains
+# (TrustChainSnapshot) before checking their version in the database, 0 disables the cache.
+# Changes made by the same process are applied immediately
+OIDCFED_TRUST_CHAIN_CACHE_TTL = getattr(settings, "OIDCFED_TRUST_CHAIN_CACHE_TTL", 60)
+
+# JWS signing service used on the hot paths, None signs in the request thread
+# eg: {
+#   "class": "spid_cie_oidc.entity.jwtse.ProcessPoolJwsSigner",
+#   "kwargs": {"max_workers": 4}
+# }
+# or: {
+#   "class": "spid_cie_oidc.entity.jwtse.UnixSocketJwsSigner",
+#   "kwargs": {"path": "/run/spid-cie-oidc/signer.sock"}
+# }
+OIDCFED_JWS_SIGNER = getattr(settings, "OIDCFED_JWS_SIGNER", None)
+
+# receives the timing spans of the trust chain operations, None discards them
+# eg: {"class": "spid_cie_oidc.entity.tracing.OpenTelemetryTracer"}
+OIDCFED_TRACER = getattr(settings, "OIDCFED_TRACER", None)
+
+# counters and histograms of the hot paths
+OIDCFED_METRICS = {
+    # exposes them at /metrics
+    "view": False,
+    # the view requires a valid StaffToken in the Authorization header
+    "staff_token": False,  # nosec B105
+    # shared by the processes of a multi-process deployment (uwsgi),
+    # each process writes its values in it. None keeps them in memory
+    "directory": None,
+    # in seconds, how often a process writes its values in the directory
+    "flush_interval": 5,
+}
+OIDCFED_METRICS.update(getattr(settings, "OIDCFED_METRICS", {}))
+
+# DB queries of the requests, counted by
+# spid_cie_oidc.entity.middleware.QueryBudgetMiddleware
+OIDCFED_QUERY_BUDGET = {
+    # share of the requests profiled, eg: 0.01 in production, 0 disables it
+    "sample_rate": 1,
+    # maximum number of queries of the views not listed in "views"
+    "default": 20,
+    # by view name, asserted by the tests of each endpoint
+    "views": {
+        "entity_configuration": 1,
+        "oidcfed_resolve": 5,
+        "oidcfed_fetch": 4,
+        "oidcfed_list": 1,
+        "oidcfed_trust_mark_status": 1,
+        "oidcfed_advanced_entity_listing": 2,
+        "oidc_provider_authnrequest": 14,
+        "oidc_provider_consent": 6,
+        "oidc_provider_token_endpoint": 3,  # nosec B105
+        "oidc_provider_userinfo_endpoint": 4,
+        "oidc_provider_introspection_endpoint": 3,
+        "oidc_provider_end_session_endpoint": 6,
+        "spid_cie_rp_begin": 7,
+        "spid_cie_rp_callback": 18,
+    },
+}
+_QUERY_BUDGET = getattr(settings, "OIDCFED_QUERY_BUDGET", {})
+OIDCFED_QUERY_BUDGET["views"].update(_QUERY_BUDGET.get("views", {}))
+OIDCFED_QUERY_BUDGET.update({k: v for k, v in _QUERY_BUDGET.items() if k != "views"})
+
+# in days, how long the expired or revoked rows are kept
+# before being deleted by the purge_expired command.
+# Models of the apps not installed are skipped
+OIDCFED_PURGE_RETENTION = {
+    "spid_cie_oidc_provider.IssuedToken": 1,
+    "spid_cie_oidc_provider.OidcSession": 30,
+    "spid_cie_oidc_relying_party.OidcAuthenticationToken": 30,
+    "spid_cie_oidc_relying_party.OidcAuthentication": 1,
+    "spid_cie_oidc_relying_party.OidcProviderMetadata": 30,
+    "spid_cie_oidc_entity.FetchedEntityStatement": 7,
+}
+OIDCFED_PURGE_RETENTION.update(getattr(settings, "OIDCFED_PURGE_RETENTION", {}))
+# rows deleted in each transaction
+OIDCFED_PURGE_BATCH_SIZE = getattr(settings, "OIDCFED_PURGE_BATCH_SIZE", 500)
+
 
 OIDCFED_MAXIMUM_AUTHORITY_HINTS = getattr(
     settings,
@@ -5,8 +5,10 @@ from .exceptions import (
     MissingTrustMark,
     TrustAnchorNeeded,
 )
-from .http_client import http_get
+from .http_client import get_async_http_client, http_get
 from .jwtse import verify_jws, unpad_jwt_head, unpad_jwt_payload
+from .metrics import get_host, HTTP_REQUEST_SECONDS
+from .tracing import span
 
 import asyncio
 import json
@@ -38,25 +40,50 @@ def get_http_url(urls: list, httpc_params: dict = {}) -> list:
     if getattr(settings, "HTTP_CLIENT_SYNC", False):
         responses = []
         for i in urls:
-            res = requests.get(i, **httpc_params) # nosec - B113
+            with span("http.fetch", url=i), HTTP_REQUEST_SECONDS.time(host=get_host(i)):
+                res = requests.get(i, **httpc_params) # nosec - B113
             responses.append(res.content.decode())
     else:
         responses = asyncio.run(http_get(urls, httpc_params)) # pragma: no cover
     return responses
 
 
-def get_entity_statements(urls: list, httpc_params: dict = {}) -> list:
+async def aget_http_url(urls: list, httpc_params: dict = {}) -> list:
     """
-    Fetches an entity statement/configuration
+    as get_http_url, with the AsyncHttpClient of the running event loop
     """
+    client = get_async_http_client()
+
+    async def _get(url):
+        with span("http.fetch", url=url):
+            response = await client.get(url, **httpc_params.get("connection", {}))
+        if response.status_code != 200: # pragma: no cover
+            return ""
+        return response.content.decode()
+
+    return list(await asyncio.gather(*[_get(i) for i in urls]))
+
+
+def _entity_statements_urls(urls: list) -> list:
     if isinstance(urls, str):
         urls = [urls] # pragma: no cover
     for url in urls:
         logger.debug(f"Starting Entity Statement Request to {url}")
-    return get_http_url(urls, httpc_params)
+    return urls
 
 
-def get_entity_configurations(subjects: list, httpc_params: dict = {}):
+def get_entity_statements(urls: list, httpc_params: dict = {}) -> list:
+    """
+    Fetches an entity statement/configuration
+    """
+    return get_http_url(_entity_statements_urls(urls), httpc_params)
+
+
+async def aget_entity_statements(urls: list, httpc_params: dict = {}) -> list:
+    return await aget_http_url(_entity_statements_urls(urls), httpc_params)
+
+
+def _entity_configurations_urls(subjects: list) -> list:
     if isinstance(subjects, str):
         subjects = [subjects]
     urls = []
@@ -66,7 +93,15 @@ def get_entity_configurations(subjects: list, httpc_params: dict = {}):
         url = f"{subject}{OIDCFED_FEDERATION_WELLKNOWN_URL}"
         urls.append(url)
         logger.info(f"Starting Entity Configuration Request for {url}")
-    return get_http_url(urls, httpc_params)
+    return urls
+
+
+def get_entity_configurations(subjects: list, httpc_params: dict = {}):
+    return get_http_url(_entity_configurations_urls(subjects), httpc_params)
+
+
+async def aget_entity_configurations(subjects: list, httpc_params: dict = {}) -> list:
+    return await aget_http_url(_entity_configurations_urls(subjects), httpc_params)
 
 
 class TrustMark:
@@ -141,7 +176,7 @@ class EntityConfiguration:
         httpc_params: dict = {},
         filter_by_allowed_trust_marks: list = [],
         trust_anchor_entity_conf=None,
-        trust_mark_issuers_entity_confs: dict = [],
+        trust_mark_issuers_entity_confs: dict = {},
     ):
         self.jwt = jwt
         self.header = unpad_jwt_head(jwt)
@@ -270,6 +305,10 @@ class EntityConfiguration:
         # self.trust_mark_issuers_entity_confs.append(ec)
 
         for trust_mark in trust_marks:
+            # fetched in advance by aget_trust_mark_issuers_entity_confs, if any
+            trust_mark.issuer_entity_configuration = (
+                self.trust_mark_issuers_entity_confs.get(trust_mark.iss, None)
+            )
             id_issuers = trust_mark_issuers_by_id.get(trust_mark.id, None)
             if id_issuers and trust_mark.iss not in id_issuers:
                 is_valid = False
@@ -289,14 +328,49 @@ class EntityConfiguration:
 
         return is_valid
 
-    def get_superiors(
+    async def aget_trust_mark_issuers_entity_confs(self) -> dict:
+        """
+        fetches the entity configurations of the issuers of the allowed trust marks,
+        then used by validate_by_allowed_trust_marks instead of fetching them one by one
+        """
+        trust_mark_issuers_by_id = {}
+        if self.trust_anchor_entity_conf:
+            trust_mark_issuers_by_id = self.trust_anchor_entity_conf.payload.get(
+                "trust_mark_issuers", {}
+            )
+
+        issuers = []
+        for tm in self.payload.get("trust_marks", []):
+            if tm.get("id", None) not in self.filter_by_allowed_trust_marks:
+                continue
+            try:
+                payload = unpad_jwt_payload(tm["trust_mark"])
+            except Exception:
+                # warned by validate_by_allowed_trust_marks
+                logger.debug(f"Trust Mark decoding failed on [{tm}]")
+                continue
+            if (
+                payload.get("iss") in trust_mark_issuers_by_id.get(payload.get("id"), [])
+                and payload["iss"] not in issuers
+            ):
+                issuers.append(payload["iss"])
+
+        if issuers:
+            jwts = await aget_entity_configurations(issuers, self.httpc_params)
+            self.trust_mark_issuers_entity_confs = dict(
+                self.trust_mark_issuers_entity_confs,
+                **{iss: [jwt] for iss, jwt in zip(issuers, jwts)}
+            )
+        return self.trust_mark_issuers_entity_confs
+
+    def _get_authority_hints(
         self,
         authority_hints: list = [],
         max_authority_hints: int = 0,
         superiors_hints: list = [],
-    ) -> dict:
+    ) -> list:
         """
-        get superiors entity configurations
+        the authority hints whose entity configurations have to be fetched
         """
         # apply limits if defined
         authority_hints = authority_hints or deepcopy(self.payload.get("authority_hints", []))
@@ -322,8 +396,9 @@ class EntityConfiguration:
                 self.verified_superiors[sup.sub] = sup
 
         logger.debug(f"Getting Entity Configurations for {authority_hints}")
+        return authority_hints
 
-        jwts = get_entity_configurations(authority_hints, self.httpc_params)
+    def _add_superiors(self, authority_hints: list, jwts: list) -> dict:
         for jwt in jwts:
             try:
                 ec = self.__class__(jwt, httpc_params=self.httpc_params)
@@ -347,6 +422,36 @@ class EntityConfiguration:
 
         return self.verified_superiors
 
+    def get_superiors(
+        self,
+        authority_hints: list = [],
+        max_authority_hints: int = 0,
+        superiors_hints: list = [],
+    ) -> dict:
+        """
+        get superiors entity configurations
+        """
+        authority_hints = self._get_authority_hints(
+            authority_hints, max_authority_hints, superiors_hints
+        )
+        jwts = get_entity_configurations(authority_hints, self.httpc_params)
+        return self._add_superiors(authority_hints, jwts)
+
+    async def aget_superiors(
+        self,
+        authority_hints: list = [],
+        max_authority_hints: int = 0,
+        superiors_hints: list = [],
+    ) -> dict:
+        """
+        as get_superiors, the entity configurations are fetched concurrently
+        """
+        authority_hints = self._get_authority_hints(
+            authority_hints, max_authority_hints, superiors_hints
+        )
+        jwts = await aget_entity_configurations(authority_hints, self.httpc_params)
+        return self._add_superiors(authority_hints, jwts)
+
     def validate_descendant_statement(self, jwt: str) -> bool:
         """
         jwt is a descendant entity statement issued by self
@@ -413,6 +518,33 @@ class EntityConfiguration:
         this methods create self.verified_superiors and failed ones
         and self.verified_by_superiors and failed ones
         """
+        for ec, _url in self._get_fetch_urls(superiors_entity_configurations):
+            jwts = get_entity_statements([_url], self.httpc_params)
+            self._validate_by_superior_response(jwts[0], ec, _url)
+
+        return self.verified_by_superiors
+
+    async def avalidate_by_superiors(
+        self,
+        superiors_entity_configurations: dict = {},
+    ):
+        """
+        as validate_by_superiors, the entity statements are fetched concurrently
+        """
+        fetch_urls = self._get_fetch_urls(superiors_entity_configurations)
+        jwts = await aget_entity_statements(
+            [_url for ec, _url in fetch_urls], self.httpc_params
+        )
+        for (ec, _url), jwt in zip(fetch_urls, jwts):
+            self._validate_by_superior_response(jwt, ec, _url)
+
+        return self.verified_by_superiors
+
+    def _get_fetch_urls(self, superiors_entity_configurations) -> list:
+        """
+        the superiors and the urls of their fetch endpoint for self
+        """
+        res = []
         for ec in superiors_entity_configurations:
             if ec.sub in ec.verified_by_superiors:
                 # already fetched and cached
@@ -431,19 +563,18 @@ class EntityConfiguration:
                 self.failed_superiors[ec.sub] = None
                 continue
 
-            else:
-                _url = f"{fetch_api_url}?sub={self.sub}"
-                logger.info(f"Getting entity statements from {_url}")
-                jwts = get_entity_statements([_url], self.httpc_params)
-                jwt = jwts[0]
-                if jwt:
-                    self.validate_by_superior_statement(jwt, ec)
-                else:
-                    logger.error(
-                        f"Empty response for {_url}"
-                    )
+            _url = f"{fetch_api_url}?sub={self.sub}"
+            logger.info(f"Getting entity statements from {_url}")
+            res.append((ec, _url))
+        return res
 
-        return self.verified_by_superiors
+    def _validate_by_superior_response(self, jwt: str, ec, url: str) -> None:
+        if jwt:
+            self.validate_by_superior_statement(jwt, ec)
+        else:
+            logger.error(
+                f"Empty response for {url}"
+            )
 
     def __repr__(self) -> str:
         return f"{self.sub} valid {self.is_valid}"
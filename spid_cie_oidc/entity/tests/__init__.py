@@ -1,8 +1,61 @@
+import contextlib
+
+from asgiref.sync import sync_to_async
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 
+from spid_cie_oidc.entity.http_client import AsyncHttpResponse
+from spid_cie_oidc.entity.middleware import get_query_budget
+
 
 def get_admin_change_view_url(obj: object) -> str:
     return reverse(
         "admin:{}_{}_change".format(obj._meta.app_label, type(obj).__name__.lower()),
         args=(obj.pk,),
     )
+
+
+class QueryBudgetTestMixin:
+    """
+    fails the tests of the views that exceed their budget in OIDCFED_QUERY_BUDGET
+    """
+
+    @contextlib.contextmanager
+    def assertQueryBudget(self, view_name: str):
+        budget = get_query_budget(view_name)
+        with CaptureQueriesContext(connection) as ctx:
+            yield ctx
+        self.assertLessEqual(
+            len(ctx),
+            budget,
+            f"{view_name} executed {len(ctx)} queries, over its budget of {budget}:\n"
+            + "\n".join(i["sql"] for i in ctx.captured_queries)
+        )
+
+
+class AsyncHttpClientMock:
+    """
+    AsyncHttpClient that serves the mocked responses of the sync tests,
+    or the ones of a callable by url.
+    Their content is computed in the test thread, where they can query the DB
+    """
+
+    def __init__(self, response):
+        self.response = response
+        self.requests = []
+
+    async def request(self, method: str, url: str, **kwargs) -> AsyncHttpResponse:
+        self.requests.append((method, url))
+        response = self.response
+        if callable(response):
+            # routed by url, eg: EntityResponseRouter
+            response = await sync_to_async(response)(url)
+        content = await sync_to_async(lambda: response.content)()
+        return AsyncHttpResponse(response.status_code, content, {})
+
+    async def get(self, url: str, **kwargs) -> AsyncHttpResponse:
+        return await self.request("GET", url, **kwargs)
+
+    async def post(self, url: str, **kwargs) -> AsyncHttpResponse:
+        return await self.request("POST", url, **kwargs)
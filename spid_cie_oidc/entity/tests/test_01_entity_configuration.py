@@ -1,15 +1,20 @@
+from cryptojwt.jwk.jwk import key_from_jwk_dict
 from django.contrib.auth import get_user_model
 from django.test import TestCase, Client
 from django.urls import reverse
+from django.utils import timezone
+from unittest.mock import patch
 
 from spid_cie_oidc.entity.models import *
+from spid_cie_oidc.entity.models import _ENTITY_CONF_CACHE
+from spid_cie_oidc.entity.jwks import create_jwk
 from spid_cie_oidc.entity.jwtse import verify_jws
 
-from . import get_admin_change_view_url
+from . import QueryBudgetTestMixin, get_admin_change_view_url
 from .settings import *
 
 
-class EntityConfigurationTest(TestCase):
+class EntityConfigurationTest(QueryBudgetTestMixin, TestCase):
     def setUp(self):
         self.ta_conf = FederationEntityConfiguration.objects.create(**ta_conf_data)
         self.admin_user = get_user_model().objects.create_superuser(
@@ -51,5 +56,64 @@ class EntityConfigurationTest(TestCase):
         # dulcis in fundo -> test the .well-knwon/openid-federation
         wk_url = reverse("entity_configuration")
         c = Client()
-        res = c.get(wk_url)
+        with self.assertQueryBudget("entity_configuration"):
+            res = c.get(wk_url)
         verify_jws(res.content.decode(), self.ta_conf.jwks_fed[0])
+
+    def test_public_jwks_cache(self):
+        new_jwk = create_jwk()
+        self.ta_conf.jwks_fed.append(new_jwk)
+        self.ta_conf.save()
+        old_kid = self.ta_conf.jwks_fed[0]["kid"]
+
+        with patch(
+            "spid_cie_oidc.entity.jwks.key_from_jwk_dict", wraps=key_from_jwk_dict
+        ) as parser:
+            public_jwks = self.ta_conf.public_jwks
+            self.assertEqual(self.ta_conf.public_jwks, public_jwks)
+            self.assertEqual(parser.call_count, 2)
+
+        # the returned keys are copies
+        public_jwks[0]["kid"] = "tampered"
+        self.assertEqual(self.ta_conf.public_jwks[0]["kid"], old_kid)
+
+        # key rotation
+        FederationHistoricalKey.objects.create(
+            entity=self.ta_conf, kid=old_kid, inactive_from=timezone.now()
+        )
+        self.ta_conf.refresh_from_db()
+        self.assertEqual(
+            [i["kid"] for i in self.ta_conf.public_jwks], [new_jwk["kid"]]
+        )
+        self.assertEqual(list(self.ta_conf.pems_as_dict.keys()), [new_jwk["kid"]])
+
+    def test_entity_configuration_cache(self):
+        conf = FederationEntityConfiguration.get_active_conf()
+        self.assertEqual(conf, self.ta_conf)
+        ta = get_first_self_trust_anchor()
+        with self.assertNumQueries(0):
+            self.assertIs(FederationEntityConfiguration.get_active_conf(), conf)
+            self.assertIs(get_first_self_trust_anchor(), ta)
+
+        # any change clears the cache
+        self.ta_conf.is_active = False
+        self.ta_conf.save()
+        self.assertIsNone(FederationEntityConfiguration.get_active_conf())
+
+        self.ta_conf.is_active = True
+        self.ta_conf.save()
+        self.assertEqual(FederationEntityConfiguration.get_active_conf(), self.ta_conf)
+        self.ta_conf.delete()
+        self.assertIsNone(get_first_self_trust_anchor())
+
+    def test_entity_configuration_cache_requested_lookups(self):
+        get_first_self_trust_anchor()
+        cached = len(_ENTITY_CONF_CACHE)
+        # the lookups built from the requests are never cached
+        for i in range(3):
+            self.assertIsNone(get_first_self_trust_anchor(f"http://unknown-{i}.org"))
+            Client().get(reverse("entity_configuration"), HTTP_HOST=f"unknown-{i}.org")
+        self.assertEqual(
+            get_first_self_trust_anchor(self.ta_conf.sub), self.ta_conf
+        )
+        self.assertEqual(len(_ENTITY_CONF_CACHE), cached)
@@ -1,5 +1,24 @@
+from django.core.exceptions import ValidationError as DjangoValidationError
 from django.test import TestCase
 from pydantic import ValidationError
+from spid_cie_oidc.entity.jwks import (
+    create_jwk,
+    default_jws_alg,
+    private_jwk_from_pem,
+    private_pem_from_jwk,
+    public_jwk_from_pem,
+    public_jwk_from_private_jwk,
+    public_pem_from_jwk
+)
+from spid_cie_oidc.entity.jwtse import (
+    create_jwe,
+    create_jws,
+    decrypt_jwe,
+    sign_jws,
+    unpad_jwt_head,
+    verify_jws
+)
+from spid_cie_oidc.entity.models import FederationEntityConfiguration
 from spid_cie_oidc.entity.schemas.jwks import JwksCie, JwksSpid
 from spid_cie_oidc.entity.tests.jwks_settings import (
     JWKS,
@@ -22,3 +41,56 @@ class JwksTest(TestCase):
     def test_jwks_with_e_and_rsa_no_correct(self):
         with self.assertRaises(ValidationError):
             JwksCie(**JWKS_WITH_X_AND_RSA_NO_CORRECT)
+
+
+class EcJwksTest(TestCase):
+
+    def test_ec_jwk(self):
+        for crv, alg in (("P-256", "ES256"), ("P-384", "ES384")):
+            jwk = create_jwk(kty="EC", crv=crv)
+            self.assertEqual(jwk["kty"], "EC")
+            self.assertEqual(jwk["crv"], crv)
+            self.assertIn("d", jwk)
+            self.assertEqual(default_jws_alg(jwk), alg)
+
+            public_jwk = public_jwk_from_private_jwk(jwk)
+            self.assertNotIn("d", public_jwk)
+
+            jws = create_jws({"iss": "me"}, jwk)
+            self.assertEqual(unpad_jwt_head(jws)["alg"], alg)
+            self.assertEqual(verify_jws(jws, public_jwk), {"iss": "me"})
+            self.assertEqual(unpad_jwt_head(sign_jws({"iss": "me"}, jwk))["alg"], alg)
+
+    def test_ec_jwe(self):
+        for kty, alg in (("EC", "ECDH-ES+A256KW"), ("RSA", "RSA-OAEP")):
+            jwk = create_jwk(kty=kty)
+            # encrypted with the public key, as done for the userinfo
+            jws = create_jws({"sub": "me"}, jwk)
+            jwe = create_jwe(jws, public_jwk_from_private_jwk(jwk), cty="JWT")
+            self.assertEqual(unpad_jwt_head(jwe)["alg"], alg)
+            self.assertEqual(decrypt_jwe(jwe, jwk).decode(), jws)
+
+    def test_ec_pem(self):
+        jwk = create_jwk(kty="EC")
+        self.assertEqual(private_jwk_from_pem(private_pem_from_jwk(jwk)), jwk)
+        self.assertEqual(
+            public_jwk_from_pem(public_pem_from_jwk(jwk)),
+            public_jwk_from_private_jwk(jwk)
+        )
+
+    def test_ec_entity_configuration(self):
+        conf = FederationEntityConfiguration(
+            sub="http://127.0.0.1:8000/",
+            metadata={"federation_entity": {}},
+            jwks_fed=[create_jwk(kty="EC")],
+            default_signature_alg="ES256",
+        )
+        conf.clean()
+        self.assertEqual(conf.public_jwks[0]["kid"], conf.jwks_fed[0]["kid"])
+        self.assertNotIn("d", conf.public_jwks[0])
+        jws = conf.entity_configuration_as_jws
+        verify_jws(jws, conf.public_jwks[0])
+
+        conf.default_signature_alg = "RS256"
+        with self.assertRaises(DjangoValidationError):
+            conf.clean()
@@ -1,6 +1,10 @@
 import asyncio
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
 from django.test import TestCase
+from spid_cie_oidc.entity import http_client
 from spid_cie_oidc.entity.http_client import http_get
 
 
@@ -10,3 +14,67 @@ class HttpClient(TestCase):
         get = http_get([url], {})
         value = asyncio.run(get)
         self.assertFalse(len(value) == 0)
+
+
+class KeepAliveHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    connections = 0
+
+    def setup(self):
+        super().setup()
+        KeepAliveHandler.connections += 1
+
+    def do_GET(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        body = json.dumps({"path": self.path}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_POST = do_GET
+
+    def log_message(self, *args):
+        pass
+
+
+class PooledHttpClient(TestCase):
+
+    def setUp(self):
+        KeepAliveHandler.connections = 0
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), KeepAliveHandler)
+        self.url = f"http://127.0.0.1:{self.server.server_port}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_http_client_keep_alive(self):
+        client = http_client.HttpClient()
+        res = client.post(f"{self.url}/token", data={"code": "code"})
+        self.assertEqual(res.json(), {"path": "/token"})
+        res = client.get(f"{self.url}/userinfo")
+        self.assertEqual(res.status_code, 200)
+        client.close()
+        self.assertEqual(KeepAliveHandler.connections, 1)
+
+    def test_async_http_client_keep_alive(self):
+        client = http_client.AsyncHttpClient()
+
+        async def requests():
+            res = await client.post(f"{self.url}/token", data={"code": "code"})
+            self.assertEqual(res.json(), {"path": "/token"})
+            res = await client.get(f"{self.url}/userinfo")
+            self.assertEqual(res.status_code, 200)
+            await client.close()
+
+        asyncio.run(requests())
+        self.assertEqual(KeepAliveHandler.connections, 1)
+
+    def test_shared_http_client(self):
+        self.assertIs(http_client.get_http_client(), http_client.get_http_client())
+        self.assertIs(
+            http_client.get_async_http_client(), http_client.get_async_http_client()
+        )
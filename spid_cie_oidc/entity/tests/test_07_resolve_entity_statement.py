@@ -10,6 +10,7 @@ from django.test import (
     override_settings
 )
 from django.urls import reverse
+from spid_cie_oidc.entity.tests import QueryBudgetTestMixin
 from spid_cie_oidc.entity.tests.rp_metadata_settings import rp_conf
 from spid_cie_oidc.entity.views import resolve_entity_statement
 from spid_cie_oidc.entity.models import (
@@ -45,7 +46,7 @@ def create_tc():
         is_active=True,
     )
 
-class ResolveEntityStatementTest(TestCase):
+class ResolveEntityStatementTest(QueryBudgetTestMixin, TestCase):
 
     def setUp(self):
         self.factory = RequestFactory()
@@ -86,7 +87,8 @@ class ResolveEntityStatementTest(TestCase):
             return_value = create_tc()
         )
         self.patcher.start()
-        res = resolve_entity_statement(request, format='json')
+        with self.assertQueryBudget("oidcfed_resolve"):
+            res = resolve_entity_statement(request, format='json')
         self.patcher.stop()
         _json = json.loads(res.content.decode())
         self.assertTrue(_json.get("iss") == ta_conf_data["sub"])
@@ -1,4 +1,5 @@
 
+from types import SimpleNamespace
 from unittest.mock import patch
 
 from django.test import TestCase
@@ -15,7 +16,7 @@ from spid_cie_oidc.entity.tests.settings import (
     ta_conf_data,
     ta_conf_data_as_json
 )
-from spid_cie_oidc.entity.trust_chain import TrustChainBuilder
+from spid_cie_oidc.entity.trust_chain import TrustChainBuilder, TrustGraph
 from spid_cie_oidc.entity.utils import (
     datetime_from_timestamp, 
     exp_from_now,
@@ -57,3 +58,60 @@ class TrustChainTest(TestCase):
         with self.assertRaises(InvalidEntityConfiguration):
             TrustChainBuilder.get_subject_configuration(self.tcb)
         self.patcher.stop()
+
+
+def wide_graph(width: int) -> TrustGraph:
+    """
+    a leaf with width intermediaries, each one subordinate
+    of all the width intermediaries of the level above the trust anchor
+    """
+    graph = TrustGraph()
+    ta = SimpleNamespace(sub="ta")
+    upper = [SimpleNamespace(sub=f"up-{i}") for i in range(width)]
+    lower = [SimpleNamespace(sub=f"low-{i}") for i in range(width)]
+    graph.add(SimpleNamespace(sub="leaf", verified_by_superiors={i.sub: i for i in lower}))
+    for i in lower:
+        graph.add(SimpleNamespace(sub=i.sub, verified_by_superiors={j.sub: j for j in upper}))
+    for i in upper:
+        graph.add(SimpleNamespace(sub=i.sub, verified_by_superiors={"ta": ta}))
+    return graph
+
+
+class TrustGraphTest(TestCase):
+
+    def test_get_path(self):
+        graph = wide_graph(50)
+        self.assertEqual(graph.get_path("leaf", "ta", 2), ["leaf", "low-0", "up-0", "ta"])
+        # each entity once
+        self.assertLessEqual(graph.visited, 102)
+        self.assertEqual(graph.get_path("leaf", "ta", 1), [])
+        self.assertEqual(graph.get_path("leaf", "another-ta", 5), [])
+
+    def test_get_path_shortest(self):
+        graph = wide_graph(3)
+        graph.add(SimpleNamespace(sub="low-2", verified_by_superiors={"ta": None}))
+        self.assertEqual(graph.get_path("leaf", "ta", 2), ["leaf", "low-2", "ta"])
+        self.assertEqual(graph.get_path("leaf", "ta", 0), [])
+
+    def test_get_path_loop(self):
+        graph = TrustGraph()
+        graph.add(SimpleNamespace(sub="leaf", verified_by_superiors={"a": None}))
+        graph.add(SimpleNamespace(sub="a", verified_by_superiors={"b": None}))
+        graph.add(SimpleNamespace(sub="b", verified_by_superiors={"a": None, "ta": None}))
+        self.assertEqual(graph.get_path("leaf", "ta", 5), ["leaf", "a", "b", "ta"])
+        self.assertEqual(graph.get_paths("leaf", "ta", 5), [["leaf", "a", "b", "ta"]])
+        self.assertEqual(graph.get_path("leaf", "unknown", 5), [])
+
+    def test_get_paths(self):
+        graph = wide_graph(10)
+        paths = graph.get_paths("leaf", "ta", 2)
+        self.assertEqual(len(paths), 100)
+        self.assertEqual(paths[0], ["leaf", "low-0", "up-0", "ta"])
+        # the paths from each upper intermediary are searched once
+        self.assertLessEqual(graph.visited, 21)
+
+        graph.add(SimpleNamespace(sub="low-2", verified_by_superiors={"ta": None}))
+        paths = graph.get_paths("leaf", "ta", 2)
+        self.assertEqual(len(paths), 101)
+        self.assertEqual(paths[0], ["leaf", "low-2", "ta"])
+        self.assertEqual(graph.get_paths("leaf", "ta", 0), [])
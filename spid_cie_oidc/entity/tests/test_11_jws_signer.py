@@ -0,0 +1,97 @@
+import os
+import stat
+import tempfile
+import threading
+
+from django.test import TestCase
+
+from spid_cie_oidc.entity.exceptions import JwsSignerError
+from spid_cie_oidc.entity.jwks import create_jwk
+from spid_cie_oidc.entity.jwtse import (
+    JwsSigner,
+    JwsSignerServer,
+    ProcessPoolJwsSigner,
+    UnixSocketJwsSigner,
+    get_jws_signer,
+    sign_jws,
+    unpad_jwt_head,
+    verify_jws
+)
+from spid_cie_oidc.entity.metrics import JWS_OPERATIONS
+from spid_cie_oidc.entity.tests.settings import TA_JWK_PRIVATE, TA_JWK_PUBLIC
+
+
+PAYLOAD = {"iss": "http://testserver/", "sub": "http://testserver/"}
+
+
+class JwsSignerTest(TestCase):
+
+    def _check_signer(self, signer):
+        jws = signer.sign(PAYLOAD, TA_JWK_PRIVATE, typ="entity-statement+jwt")
+        self.assertEqual(verify_jws(jws, TA_JWK_PUBLIC), PAYLOAD)
+        self.assertEqual(unpad_jwt_head(jws)["typ"], "entity-statement+jwt")
+
+        jwss = signer.sign_many(
+            [
+                dict(payload=dict(PAYLOAD, jti=str(i)), jwk_dict=TA_JWK_PRIVATE)
+                for i in range(4)
+            ]
+        )
+        self.assertEqual(len(jwss), 4)
+        for i, jws in enumerate(jwss):
+            self.assertEqual(verify_jws(jws, TA_JWK_PUBLIC)["jti"], str(i))
+
+    def test_inline_signer(self):
+        self._check_signer(JwsSigner())
+        self.assertTrue(isinstance(get_jws_signer(), JwsSigner))
+        self.assertEqual(
+            verify_jws(sign_jws(PAYLOAD, TA_JWK_PRIVATE), TA_JWK_PUBLIC), PAYLOAD
+        )
+
+    def test_process_pool_signer(self):
+        signer = ProcessPoolJwsSigner(max_workers=2, jwks=[TA_JWK_PRIVATE])
+        try:
+            # counted by this process, not by the ones of the pool
+            before = JWS_OPERATIONS._values.get(("sign", "RS256"), 0)
+            signer.sign(PAYLOAD, TA_JWK_PRIVATE)
+            self.assertEqual(JWS_OPERATIONS._values[("sign", "RS256")], before + 1)
+            self._check_signer(signer)
+            # not preloaded keys are sent along with the payload
+            jwk = create_jwk()
+            jws = signer.sign(PAYLOAD, jwk)
+            self.assertEqual(unpad_jwt_head(jws)["kid"], jwk["kid"])
+        finally:
+            signer.shutdown()
+
+    def test_unix_socket_signer(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "signer.sock")
+            server = JwsSignerServer(path, jwks=[TA_JWK_PRIVATE])
+            thread = threading.Thread(target=server.serve_forever)
+            thread.start()
+            try:
+                signer = UnixSocketJwsSigner(path)
+                self._check_signer(signer)
+                # the signer holds only its own keys
+                with self.assertRaises(JwsSignerError):
+                    signer.sign(PAYLOAD, create_jwk())
+            finally:
+                server.shutdown()
+                server.server_close()
+                thread.join()
+
+    def test_unix_socket_permissions(self):
+        umask = os.umask(0)
+        try:
+            with tempfile.TemporaryDirectory() as tmpdir:
+                path = os.path.join(tmpdir, "signer.sock")
+                server = JwsSignerServer(path, jwks=[TA_JWK_PRIVATE])
+                try:
+                    mode = stat.S_IMODE(os.stat(path).st_mode)
+                    self.assertEqual(mode, 0o660)
+                    # the umask of the process is restored
+                    self.assertEqual(os.umask(0), 0)
+                finally:
+                    server.server_close()
+        finally:
+            os.umask(umask)
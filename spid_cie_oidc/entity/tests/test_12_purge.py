@@ -0,0 +1,154 @@
+import json
+from io import StringIO
+
+from django.core.management import call_command
+from django.test import TestCase
+from django.utils import timezone
+from spid_cie_oidc.entity.models import FetchedEntityStatement, TrustChain
+from spid_cie_oidc.entity.purge import purge_expired, purge_queryset
+from spid_cie_oidc.entity.tests.settings import TA_SUB
+from spid_cie_oidc.provider.models import IssuedToken, OidcSession
+from spid_cie_oidc.relying_party.models import (
+    OidcAuthentication,
+    OidcAuthenticationToken
+)
+
+NOW = timezone.localtime()
+OLD = NOW - timezone.timedelta(days=60)
+
+
+def create_session(nonce, revoked=False, created=NOW, expires=NOW):
+    session = OidcSession.objects.create(
+        user_uid="user",
+        nonce=nonce,
+        authz_request={"scope": "openid"},
+        client_id="http://rp.example.org/",
+        revoked=revoked,
+    )
+    IssuedToken.objects.create(
+        session=session,
+        access_token=f"access_token-{nonce}",
+        id_token="id_token",
+        expires=expires,
+        revoked=revoked,
+    )
+    OidcSession.objects.filter(pk=session.pk).update(created=created, modified=created)
+    IssuedToken.objects.filter(session=session).update(created=created, modified=created)
+    return session
+
+
+class PurgeTest(TestCase):
+
+    def setUp(self):
+        # old and revoked
+        create_session("revoked", revoked=True, created=OLD, expires=OLD)
+        # old and expired
+        create_session("expired", created=OLD, expires=OLD)
+        # old but still refreshable
+        self.live = create_session(
+            "live", created=OLD, expires=NOW + timezone.timedelta(minutes=5)
+        )
+        # recent
+        create_session("recent")
+
+        for i, created in enumerate((OLD, OLD, NOW)):
+            authz = OidcAuthentication.objects.create(client_id=f"client-{i}")
+            if i == 0:
+                token = OidcAuthenticationToken.objects.create(authz_request=authz)
+                OidcAuthenticationToken.objects.filter(pk=token.pk).update(
+                    created=created, modified=created
+                )
+            OidcAuthentication.objects.filter(pk=authz.pk).update(created=created)
+
+        # tokens of a recent authorization:
+        # old and revoked, old but refreshable, recent and not expired
+        for revoked, refresh_token, modified in (
+            (OLD, "refresh_token", OLD),
+            (None, "refresh_token", OLD),
+            (None, None, NOW),
+        ):
+            token = OidcAuthenticationToken.objects.create(
+                authz_request=authz,
+                refresh_token=refresh_token,
+                expires_in=3600,
+                revoked=revoked,
+            )
+            OidcAuthenticationToken.objects.filter(pk=token.pk).update(
+                created=modified, modified=modified
+            )
+
+        ta_fes = FetchedEntityStatement.objects.create(
+            sub=TA_SUB, iss=TA_SUB, exp=OLD, iat=OLD
+        )
+        FetchedEntityStatement.objects.create(
+            sub="http://rp.example.org/", iss=TA_SUB, exp=OLD, iat=OLD
+        )
+        TrustChain.objects.create(
+            sub="http://op.example.org/",
+            exp=NOW,
+            jwks=[],
+            metadata={},
+            trust_anchor=ta_fes,
+        )
+
+    def test_purge_expired(self):
+        deleted = purge_expired(batch_size=1)
+        self.assertEqual(
+            deleted,
+            {
+                "spid_cie_oidc_provider.IssuedToken": 2,
+                "spid_cie_oidc_provider.OidcSession": 2,
+                "spid_cie_oidc_relying_party.OidcAuthenticationToken": 2,
+                "spid_cie_oidc_relying_party.OidcAuthentication": 2,
+                "spid_cie_oidc_entity.FetchedEntityStatement": 1,
+            }
+        )
+        self.assertEqual(
+            set(OidcSession.objects.values_list("nonce", flat=True)),
+            {"live", "recent"}
+        )
+        self.assertEqual(IssuedToken.objects.count(), 2)
+        self.assertEqual(
+            list(OidcAuthentication.objects.values_list("client_id", flat=True)),
+            ["client-2"]
+        )
+        self.assertEqual(
+            list(
+                OidcAuthenticationToken.objects.values_list("refresh_token", flat=True)
+            ),
+            ["refresh_token", None]
+        )
+        self.assertEqual(FetchedEntityStatement.objects.get().sub, TA_SUB)
+        self.assertEqual(TrustChain.objects.count(), 1)
+
+        # nothing left to purge
+        self.assertEqual(purge_expired(), {})
+
+    def test_purge_retention(self):
+        deleted = purge_expired(
+            retention={
+                "spid_cie_oidc_provider.OidcSession": 90,
+                "spid_cie_oidc_entity.FetchedEntityStatement": None,
+                "missing_app.Model": 1,
+            }
+        )
+        self.assertEqual(deleted, {})
+        self.assertEqual(OidcSession.objects.count(), 4)
+
+    def test_purge_queryset_batches(self):
+        qs = OidcSession.objects.all()
+        with self.assertNumQueries(6 * 4 + 1):
+            # for each batch: the range, the savepoint, the cascade,
+            # the deletion of the tokens and of the sessions, the release;
+            # then the empty range
+            deleted = purge_queryset(qs, batch_size=1)
+        self.assertEqual(deleted["spid_cie_oidc_provider.OidcSession"], 4)
+
+    def test_purge_command(self):
+        out = StringIO()
+        call_command("purge_expired", "--batch-size", "2", stdout=out)
+        metrics = json.loads(out.getvalue())
+        self.assertEqual(metrics["total"], 9)
+        self.assertEqual(
+            metrics["deleted"]["spid_cie_oidc_provider.OidcSession"], 2
+        )
@@ -0,0 +1,156 @@
+import json
+import os
+import tempfile
+from unittest.mock import patch
+
+from django.contrib.auth import get_user_model
+from django.test import RequestFactory, TestCase
+
+from spid_cie_oidc.entity.jwtse import create_jws, verify_jws
+from spid_cie_oidc.entity.metrics import JWS_OPERATIONS, Registry
+from spid_cie_oidc.entity.models import StaffToken
+from spid_cie_oidc.entity.tests.settings import TA_JWK_PRIVATE, TA_JWK_PUBLIC
+from spid_cie_oidc.entity.views import metrics
+
+
+class MetricsTest(TestCase):
+
+    def test_exposition(self):
+        registry = Registry()
+        counter = registry.counter("test_total", "A counter", ("result",))
+        histogram = registry.histogram(
+            "test_seconds", "A histogram", ("host",), buckets=(0.1, 1)
+        )
+        self.assertIs(registry.counter("test_total", "A counter", ("result",)), counter)
+
+        counter.inc(result="ok")
+        counter.inc(2, result="ok")
+        counter.inc(result='fa"iled')
+        histogram.observe(0.05, host="op.example.org")
+        histogram.observe(0.5, host="op.example.org")
+        histogram.observe(3, host="op.example.org")
+
+        lines = registry.exposition().splitlines()
+        self.assertIn("# TYPE test_total counter", lines)
+        self.assertIn('test_total{result="ok"} 3', lines)
+        self.assertIn('test_total{result="fa\\"iled"} 1', lines)
+        self.assertIn("# TYPE test_seconds histogram", lines)
+        self.assertIn('test_seconds_bucket{host="op.example.org",le="0.1"} 1', lines)
+        self.assertIn('test_seconds_bucket{host="op.example.org",le="1.0"} 2', lines)
+        self.assertIn('test_seconds_bucket{host="op.example.org",le="+Inf"} 3', lines)
+        self.assertIn('test_seconds_sum{host="op.example.org"} 3.55', lines)
+        self.assertIn('test_seconds_count{host="op.example.org"} 3', lines)
+
+        registry.reset()
+        self.assertNotIn('test_total{result="ok"} 3', registry.exposition())
+
+    def test_directory(self):
+        with tempfile.TemporaryDirectory() as directory:
+            registry = Registry(directory=directory, flush_interval=60)
+            counter = registry.counter("test_total", "A counter", ("result",))
+            histogram = registry.histogram("test_seconds", "", buckets=(1,))
+            counter.inc(result="ok")
+            histogram.observe(0.5)
+            # written by the first update, then every flush_interval
+            counter.inc(result="ok")
+            with open(registry.path) as f:
+                self.assertEqual(
+                    json.load(f)["test_total"]["values"], [[["ok"], 1]]
+                )
+
+            # the values of another worker
+            with open(os.path.join(directory, "metrics_1.json"), "w") as f:
+                json.dump(
+                    {
+                        "test_total": {
+                            "type": "counter",
+                            "help": "A counter",
+                            "labelnames": ["result"],
+                            "buckets": [],
+                            "values": [[["ok"], 5], [["failed"], 1]],
+                        },
+                        "test_seconds": {
+                            "type": "histogram",
+                            "help": "",
+                            "labelnames": [],
+                            "buckets": [1],
+                            "values": [[[], [0, 2, 1]]],
+                        },
+                    },
+                    f,
+                )
+            lines = registry.exposition().splitlines()
+            self.assertIn('test_total{result="ok"} 7', lines)
+            self.assertIn('test_total{result="failed"} 1', lines)
+            self.assertIn('test_seconds_bucket{le="1.0"} 1', lines)
+            self.assertIn('test_seconds_bucket{le="+Inf"} 2', lines)
+            self.assertIn("test_seconds_sum 2.5", lines)
+
+    def test_dead_processes(self):
+        def counter_snapshot(value):
+            return {
+                "test_total": {
+                    "type": "counter",
+                    "help": "A counter",
+                    "labelnames": [],
+                    "buckets": [],
+                    "values": [[[], value]],
+                }
+            }
+
+        with tempfile.TemporaryDirectory() as directory:
+            # left by a killed process with the pid of this one
+            with open(os.path.join(directory, f"metrics_{os.getpid()}.json"), "w") as f:
+                json.dump(counter_snapshot(1), f)
+            registry = Registry(directory=directory, flush_interval=60)
+            counter = registry.counter("test_total", "A counter")
+            counter.inc(2)
+            self.assertIn("test_total 3", registry.exposition().splitlines())
+
+            # a worker recycled, then a new one with the same pid
+            path = os.path.join(directory, "metrics_1.json")
+            with open(path, "w") as f:
+                json.dump(counter_snapshot(5), f)
+            registry.mark_process_dead(1)
+            self.assertFalse(os.path.exists(path))
+            with open(path, "w") as f:
+                json.dump(counter_snapshot(1), f)
+            self.assertIn("test_total 9", registry.exposition().splitlines())
+
+            # the values of this process are kept after its exit
+            registry.exit()
+            self.assertEqual(
+                sorted(os.listdir(directory)),
+                ["metrics.lock", "metrics_1.json", "metrics_dead.json"]
+            )
+            with open(os.path.join(directory, "metrics_dead.json")) as f:
+                self.assertEqual(json.load(f)["test_total"]["values"], [[[], 8]])
+
+    def test_jws_operations(self):
+        before = dict(JWS_OPERATIONS._values)
+        jws = create_jws({"sub": "test"}, TA_JWK_PRIVATE)
+        verify_jws(jws, TA_JWK_PUBLIC)
+        for op in ("sign", "verify"):
+            key = (op, "RS256")
+            self.assertEqual(JWS_OPERATIONS._values[key], before.get(key, 0) + 1)
+
+    def test_metrics_view(self):
+        factory = RequestFactory()
+        create_jws({"sub": "test"}, TA_JWK_PRIVATE)
+        res = metrics(factory.get("/metrics"))
+        self.assertEqual(res.status_code, 200)
+        self.assertIn(
+            'oidcfed_jws_operations_total{operation="sign",alg="RS256"}',
+            res.content.decode()
+        )
+
+        user = get_user_model().objects.create(username="staff", is_staff=True)
+        StaffToken.objects.create(user=user, token="secret-token", is_active=True)
+        with patch.dict(
+            "spid_cie_oidc.entity.views.OIDCFED_METRICS", {"staff_token": True}
+        ):
+            self.assertEqual(metrics(factory.get("/metrics")).status_code, 401)
+            res = metrics(
+                factory.get("/metrics", HTTP_AUTHORIZATION="secret-token")
+            )
+            self.assertEqual(res.status_code, 200)
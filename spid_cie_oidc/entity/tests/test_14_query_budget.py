@@ -0,0 +1,52 @@
+from unittest.mock import patch
+
+from django.conf import settings
+from django.test import Client, TestCase, override_settings
+from django.urls import reverse
+
+from spid_cie_oidc.entity.metrics import QUERY_BUDGET_EXCEEDED, VIEW_QUERIES
+from spid_cie_oidc.entity.models import FederationEntityConfiguration
+from spid_cie_oidc.entity.tests.settings import ta_conf_data
+
+from . import QueryBudgetTestMixin
+
+
+@override_settings(
+    MIDDLEWARE=settings.MIDDLEWARE + ["spid_cie_oidc.entity.middleware.QueryBudgetMiddleware"]
+)
+class QueryBudgetMiddlewareTest(QueryBudgetTestMixin, TestCase):
+
+    def setUp(self):
+        self.ta_conf = FederationEntityConfiguration.objects.create(**ta_conf_data)
+        self.url = reverse("oidcfed_list")
+
+    def test_within_budget(self):
+        before = dict(VIEW_QUERIES._values).get(("oidcfed_list",), [0])[-1]
+        with patch("spid_cie_oidc.entity.middleware.logger") as logger:
+            with self.assertQueryBudget("oidcfed_list"):
+                res = Client().get(self.url)
+        self.assertEqual(res.status_code, 200)
+        logger.warning.assert_not_called()
+        self.assertEqual(VIEW_QUERIES._values[("oidcfed_list",)][-1], before + 1)
+
+    def test_over_budget(self):
+        before = QUERY_BUDGET_EXCEEDED._values.get(("oidcfed_list",), 0)
+        with patch.dict(
+            "spid_cie_oidc.entity.middleware.OIDCFED_QUERY_BUDGET",
+            {"views": {"oidcfed_list": 0}},
+        ), patch("spid_cie_oidc.entity.middleware.logger") as logger:
+            Client().get(self.url)
+        message = logger.warning.call_args[0][0]
+        self.assertIn("over its budget of 0", message)
+        self.assertIn("spid_cie_oidc_authority_federationdescendant", message)
+        self.assertEqual(QUERY_BUDGET_EXCEEDED._values[("oidcfed_list",)], before + 1)
+
+    def test_not_sampled(self):
+        before = dict(VIEW_QUERIES._values).get(("oidcfed_list",), [0])[-1]
+        with patch.dict(
+            "spid_cie_oidc.entity.middleware.OIDCFED_QUERY_BUDGET", {"sample_rate": 0.5}
+        ), patch("spid_cie_oidc.entity.middleware.random.random", return_value=0.7):
+            Client().get(self.url)
+        self.assertEqual(
+            dict(VIEW_QUERIES._values).get(("oidcfed_list",), [0])[-1], before
+        )
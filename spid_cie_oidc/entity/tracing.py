@@ -0,0 +1,132 @@
+import contextlib
+import contextvars
+import logging
+import time
+
+from django.utils.module_loading import import_string
+
+from .settings import OIDCFED_TRACER
+
+logger = logging.getLogger(__name__)
+
+
+class Tracer:
+    """
+    Receives the spans of the trust chain operations.
+    This default one does nothing, subclasses override span()
+    """
+
+    def span(self, name: str, attributes: dict):
+        return contextlib.nullcontext()
+
+
+class OpenTelemetryTracer(Tracer):
+    """
+    Sends the spans to the OpenTelemetry tracer provider of the process,
+    opentelemetry-api must be installed
+    """
+
+    def __init__(self, name: str = "spid_cie_oidc"):
+        from opentelemetry import trace
+
+        self.tracer = trace.get_tracer(name)
+
+    def span(self, name: str, attributes: dict):
+        return self.tracer.start_as_current_span(name, attributes=attributes)
+
+
+class SpanRecorder:
+    """
+    Collects the durations of the spans of a trust chain build,
+    summarized in TrustChain.log
+    """
+
+    def __init__(self):
+        self.spans = []
+
+    def record(self, name: str, elapsed: float) -> None:
+        self.spans.append((name, elapsed))
+
+    def copy(self) -> "SpanRecorder":
+        """
+        a recorder with the spans recorded so far,
+        the ones recorded after are not shared
+        """
+        res = SpanRecorder()
+        res.spans = list(self.spans)
+        return res
+
+    def summary(self) -> dict:
+        res = {}
+        for name, elapsed in self.spans:
+            _span = res.setdefault(name, {"count": 0, "total_ms": 0, "max_ms": 0})
+            _span["count"] += 1
+            _span["total_ms"] += elapsed * 1000
+            _span["max_ms"] = max(_span["max_ms"], elapsed * 1000)
+        return res
+
+    def as_log(self) -> str:
+        return "\n".join(
+            f"{name} count={i['count']} total_ms={i['total_ms']:.2f} max_ms={i['max_ms']:.2f}"
+            for name, i in self.summary().items()
+        )
+
+
+_TRACER = None
+_RECORDER = contextvars.ContextVar("spid_cie_oidc_span_recorder", default=None)
+
+
+def get_tracer() -> Tracer:
+    """
+    returns the tracer configured in OIDCFED_TRACER
+    """
+    global _TRACER
+    if _TRACER is None:
+        if OIDCFED_TRACER:
+            _TRACER = import_string(OIDCFED_TRACER["class"])(
+                **OIDCFED_TRACER.get("kwargs", {})
+            )
+        else:
+            _TRACER = Tracer()
+    return _TRACER
+
+
+def get_recorder() -> SpanRecorder:
+    """
+    the SpanRecorder of the current context, if any
+    """
+    return _RECORDER.get()
+
+
+@contextlib.contextmanager
+def recording(recorder: SpanRecorder):
+    """
+    the spans opened in this context, async tasks included, are recorded by recorder
+    """
+    token = _RECORDER.set(recorder)
+    try:
+        yield recorder
+    finally:
+        _RECORDER.reset(token)
+
+
+@contextlib.contextmanager
+def span(name: str, **attributes):
+    """
+    times the enclosed block, sends it to the tracer
+    and to the recorder of the current context
+    """
+    recorder = _RECORDER.get()
+    tracer = get_tracer()
+    if recorder is None and type(tracer) is Tracer:
+        # nothing to record, the hot paths don't pay for the timing
+        yield
+        return
+
+    start = time.perf_counter()
+    try:
+        with tracer.span(name, attributes):
+            yield
+    finally:
+        if recorder is not None:
+            recorder.record(name, time.perf_counter() - start)
@@ -1,10 +1,11 @@
+import copy
 import datetime
 import logging
 
-from collections import OrderedDict
+from collections import deque, OrderedDict
 from typing import Union
 
-from spid_cie_oidc.entity.policy import apply_policy
+from spid_cie_oidc.entity.policy import apply_policy, gather_policies
 
 from .exceptions import (
     InvalidEntityConfiguration,
@@ -13,15 +14,98 @@ from .exceptions import (
 )
 
 from .statements import (
+    aget_entity_configurations,
     get_entity_configurations,
     EntityConfiguration,
 )
+from .tracing import get_recorder, recording, span, SpanRecorder
 from .utils import datetime_from_timestamp
 
 
 logger = logging.getLogger(__name__)
 
 
+class TrustGraph:
+    """
+    The verified edges collected by a metadata discovery, from each entity
+    to the superiors that issued a valid statement about it.
+    The searches visit each entity once, O(V+E), whatever the width of the federation
+    """
+
+    def __init__(self):
+        # {sub: {superior sub: superior EntityConfiguration}}
+        self.superiors = {}
+        # entities visited by the last search
+        self.visited = 0
+
+    @classmethod
+    def from_tree_of_trust(cls, tree_of_trust: dict) -> "TrustGraph":
+        graph = cls()
+        for ecs in tree_of_trust.values():
+            for ec in ecs:
+                graph.add(ec)
+        return graph
+
+    def add(self, ec: EntityConfiguration) -> None:
+        self.superiors.setdefault(ec.sub, {}).update(ec.verified_by_superiors)
+
+    def get_path(self, subject: str, trust_anchor: str, max_path_len: int) -> list:
+        """
+        the shortest path of subjects from subject to trust_anchor,
+        with max_path_len intermediaries at most. Empty if there isn't any
+        """
+        self.visited = 0
+        previous = {subject: None}
+        queue = deque([(subject, 0)])
+        while queue:
+            sub, hops = queue.popleft()
+            self.visited += 1
+            if sub == trust_anchor:
+                path = []
+                while sub:
+                    path.append(sub)
+                    sub = previous[sub]
+                return path[::-1]
+
+            # the trust anchor must be the next hop
+            if hops > max_path_len:
+                continue
+            for sup in self.superiors.get(sub, {}):
+                if sup not in previous:
+                    previous[sup] = sub
+                    queue.append((sup, hops + 1))
+        return []
+
+    def get_paths(self, subject: str, trust_anchor: str, max_path_len: int) -> list:
+        """
+        all the loop-free paths of subjects from subject to trust_anchor,
+        with max_path_len intermediaries at most, the shortest first.
+        The paths from each entity with the same remaining hops are searched once
+        """
+        self.visited = 0
+        # {(sub, remaining hops): [path, ...]}
+        memo = {}
+
+        def _paths(sub: str, hops: int) -> list:
+            if sub == trust_anchor:
+                return [[sub]]
+            if (sub, hops) in memo:
+                return memo[(sub, hops)]
+
+            self.visited += 1
+            res = []
+            if hops:
+                for sup in self.superiors.get(sub, {}):
+                    res.extend(
+                        [sub] + path for path in _paths(sup, hops - 1)
+                        if sub not in path
+                    )
+            memo[(sub, hops)] = res
+            return res
+
+        return sorted(_paths(subject, max_path_len + 1), key=len)
+
+
 class TrustChainBuilder:
     """
     A trust walker that fetches statements and evaluate the evaluables
@@ -60,6 +144,8 @@ class TrustChainBuilder:
         self.is_valid = False
 
         self.tree_of_trust = OrderedDict()
+        # the verified edges of the tree of trust
+        self.trust_graph = None
         self.trust_path = []  # list of valid subjects up to trust anchor
 
         self.max_authority_hints = max_authority_hints
@@ -70,67 +156,83 @@ class TrustChainBuilder:
         self.verified_trust_marks = []
         self.exp = 0
 
+        # timings of the phases, shared with the caller if it's recording
+        self.recorder = get_recorder() or SpanRecorder()
+
+    @property
+    def superiors_hints(self) -> list:
+        """
+        the entity configurations already available, not fetched by the discovery
+        """
+        return [self.trust_anchor_configuration]
+
+    def get_trust_paths(self) -> list:
+        """
+        all the valid trust paths from subject to trust anchor,
+        as lists of entity configurations, the shortest first
+        """
+        graph = self.get_trust_graph()
+        return [
+            self._get_path_configurations(graph, path)
+            for path in graph.get_paths(
+                self.subject, self.trust_anchor_configuration.sub, self.max_path_len
+            )
+        ]
+
+    def get_trust_graph(self) -> "TrustGraph":
+        if not self.trust_graph:
+            self.trust_graph = TrustGraph.from_tree_of_trust(self.tree_of_trust)
+        return self.trust_graph
+
+    def _get_path_configurations(self, graph: "TrustGraph", path: list) -> list:
+        """
+        the entity configurations of a path of subjects, each superior is
+        the one that holds the statement about the previous subject
+        """
+        res = [self.subject_configuration]
+        for sub, sup in zip(path, path[1:]):
+            res.append(graph.superiors[sub][sup])
+        return res
+
     def apply_metadata_policy(self) -> dict:
         """
-        filters the trust path from subject to trust anchor
+        finds the shortest trust path from subject to trust anchor,
         apply the metadata policies along the path and
         returns the final metadata
         """
-        # find the path of trust
         if not self.trust_path:
-            self.trust_path = [self.subject_configuration]
-        elif self.trust_path[-1].sub == self.trust_anchor_configuration.sub:
-            # ok trust path completed, I just have to return over all the parent calls
-            return
-
-        logger.info(
-            f"Applying metadata policy for {self.subject} over "
-            f"{self.trust_anchor_configuration.sub} starting from "
-            f"{self.trust_path[-1]}"
-        )
-        last_path = self.tree_of_trust[len(self.trust_path) - 1]
-
-        path_found = False
-        for ec in last_path:
-            for sup_ec in ec.verified_by_superiors.values():
-                while len(self.trust_path) - 2 < self.max_path_len:
-                    if sup_ec.sub == self.trust_anchor_configuration.sub:
-                        self.trust_path.append(sup_ec)
-                        path_found = True
-                        break
-                    if sup_ec.verified_by_superiors:
-                        self.trust_path.append(sup_ec)
-                        self.apply_metadata_policy()
-                    else:
-                        logger.info(
-                            f"'Cul de sac' in {sup_ec.sub} for {self.subject} "
-                            f"to {self.trust_anchor_configuration.sub}"
-                        )
-                        self.trust_path = [self.subject_configuration]
-                        break
-
-        # once I filtered a concrete and unique trust path I can apply the metadata policy
-        if path_found:
-            logger.info(f"Found a trust path: {self.trust_path}")
-            self.final_metadata = self.subject_configuration.payload.get("metadata", {})
-            if not self.final_metadata:
-                logger.error(
-                    f"Missing metadata in {self.subject_configuration.payload['metadata']}"
+            graph = self.get_trust_graph()
+            path = graph.get_path(
+                self.subject, self.trust_anchor_configuration.sub, self.max_path_len
+            )
+            if not path:
+                logger.info(
+                    f"No trust path for {self.subject} "
+                    f"to {self.trust_anchor_configuration.sub}"
                 )
-                return
-
-            for i in range(len(self.trust_path))[::-1]:
-                self.trust_path[i - 1].sub
-                _pol = (
-                    self.trust_path[i]
-                    .verified_descendant_statements.get("metadata_policy", {})
+                return self.final_metadata
+            self.trust_path = self._get_path_configurations(graph, path)
+
+        logger.info(f"Found a trust path: {self.trust_path}")
+        metadata = self.subject_configuration.payload.get("metadata", {})
+        if not metadata:
+            logger.error(
+                f"Missing metadata in {self.subject_configuration.payload}"
+            )
+            return self.final_metadata
+
+        # the statements issued by each superior, from the trust anchor down
+        statements = [
+            sup.verified_descendant_statements[sub.sub]
+            for sub, sup in zip(self.trust_path, self.trust_path[1:])
+        ][::-1]
+        self.final_metadata = copy.deepcopy(metadata)
+        for md_type in self.final_metadata:
+            policy = gather_policies(statements, md_type)
+            if policy:
+                self.final_metadata[md_type] = apply_policy(
+                    self.final_metadata[md_type], policy
                 )
-                for md_type, md in _pol.items():
-                    if not self.final_metadata.get(md_type):
-                        continue
-                    self.final_metadata[md_type] = apply_policy(
-                        self.final_metadata[md_type], _pol[md_type]
-                    )
 
         # set exp
         self.set_exp()
@@ -161,23 +263,25 @@ class TrustChainBuilder:
 
             sup_ecs = []
             for last_ec in last_ecs:
-                # Metadata discovery loop prevention
-                if last_ec.sub in ecs_history:
-                    logger.warning(
-                        f"Metadata discovery loop detection for {last_ec.sub}. "
-                        f"Already present in {ecs_history}. "
-                        "Discovery blocked for this path."
-                    )
+                if self._is_discovery_loop(last_ec, ecs_history):
                     continue
 
                 try:
-                    superiors = last_ec.get_superiors(
-                        max_authority_hints=self.max_authority_hints,
-                        superiors_hints=[self.trust_anchor_configuration],
-                    )
-                    validated_by = last_ec.validate_by_superiors(
-                        superiors_entity_configurations=superiors.values()
-                    )
+                    with span(
+                        "trust_chain.get_superiors", sub=last_ec.sub, hop=last_path_n
+                    ):
+                        superiors = last_ec.get_superiors(
+                            max_authority_hints=self.max_authority_hints,
+                            superiors_hints=self.superiors_hints,
+                        )
+                    with span(
+                        "trust_chain.validate_by_superiors",
+                        sub=last_ec.sub,
+                        hop=last_path_n
+                    ):
+                        validated_by = last_ec.validate_by_superiors(
+                            superiors_entity_configurations=superiors.values()
+                        )
                     vbv = list(validated_by.values())
                     sup_ecs.extend(vbv)
                     ecs_history.append(last_ec)
@@ -191,13 +295,75 @@ class TrustChainBuilder:
             else:
                 break
 
+        return self._validate_tree_of_trust()
+
+    async def adiscovery(self) -> bool:
+        """
+        as discovery, the statements of each hop are fetched concurrently
+        """
+        logger.info(f"Starting a Walk into Metadata Discovery for {self.subject}")
+        self.tree_of_trust[0] = [self.subject_configuration]
+
+        ecs_history = []
+        while (len(self.tree_of_trust) - 2) < self.max_path_len:
+            last_path_n = list(self.tree_of_trust.keys())[-1]
+            last_ecs = self.tree_of_trust[last_path_n]
+
+            sup_ecs = []
+            for last_ec in last_ecs:
+                if self._is_discovery_loop(last_ec, ecs_history):
+                    continue
+
+                try:
+                    with span(
+                        "trust_chain.get_superiors", sub=last_ec.sub, hop=last_path_n
+                    ):
+                        superiors = await last_ec.aget_superiors(
+                            max_authority_hints=self.max_authority_hints,
+                            superiors_hints=self.superiors_hints,
+                        )
+                    with span(
+                        "trust_chain.validate_by_superiors",
+                        sub=last_ec.sub,
+                        hop=last_path_n
+                    ):
+                        validated_by = await last_ec.avalidate_by_superiors(
+                            superiors_entity_configurations=superiors.values()
+                        )
+                    sup_ecs.extend(validated_by.values())
+                    ecs_history.append(last_ec)
+                except MetadataDiscoveryException as e:
+                    logger.exception(
+                        f"Metadata discovery exception for {last_ec.sub}: {e}"
+                    )
+
+            if sup_ecs:
+                self.tree_of_trust[last_path_n + 1] = sup_ecs
+            else:
+                break
+
+        return self._validate_tree_of_trust()
+
+    def _is_discovery_loop(self, ec: EntityConfiguration, ecs_history: list) -> bool:
+        # Metadata discovery loop prevention
+        if ec.sub in ecs_history:
+            logger.warning(
+                f"Metadata discovery loop detection for {ec.sub}. "
+                f"Already present in {ecs_history}. "
+                "Discovery blocked for this path."
+            )
+            return True
+        return False
+
+    def _validate_tree_of_trust(self) -> bool:
         last_path = list(self.tree_of_trust.keys())[-1]
         if (
             self.tree_of_trust[0][0].is_valid
             and self.tree_of_trust[last_path][0].is_valid
         ):
             self.is_valid = True
-            self.apply_metadata_policy()
+            with span("trust_chain.apply_metadata_policy", sub=self.subject):
+                self.apply_metadata_policy()
 
         return self.is_valid
 
@@ -212,6 +378,24 @@ class TrustChainBuilder:
             )[0]
             self.trust_anchor_configuration = EntityConfiguration(ta_jwt)
 
+        self._validate_trust_anchor_configuration()
+
+    async def aget_trust_anchor_configuration(self) -> None:
+        if isinstance(self.trust_anchor, EntityConfiguration):
+            self.trust_anchor_configuration = self.trust_anchor
+
+        elif not self.trust_anchor_configuration and isinstance(self.trust_anchor, str):
+            logger.info(f"Starting Metadata Discovery for {self.subject}")
+            ta_jwt = (
+                await aget_entity_configurations(
+                    self.trust_anchor, httpc_params=self.httpc_params
+                )
+            )[0]
+            self.trust_anchor_configuration = EntityConfiguration(ta_jwt)
+
+        self._validate_trust_anchor_configuration()
+
+    def _validate_trust_anchor_configuration(self) -> None:
         try:
             self.trust_anchor_configuration.validate_by_itself()
         except Exception as e: # pragma: no cover
@@ -237,10 +421,26 @@ class TrustChainBuilder:
                 jwt = get_entity_configurations(
                     self.subject, httpc_params=self.httpc_params
                 )
-                self.subject_configuration = EntityConfiguration(
-                    jwt[0], trust_anchor_entity_conf=self.trust_anchor_configuration
+                self._set_subject_configuration(jwt[0])
+            except Exception as e:
+                _msg = f"Entity Configuration for {self.subject} failed: {e}"
+                logger.error(_msg)
+                raise InvalidEntityConfiguration(_msg)
+
+            # Trust Mark filter
+            if self.required_trust_marks:
+                self.subject_configuration.filter_by_allowed_trust_marks = (
+                    self.required_trust_marks
                 )
-                self.subject_configuration.validate_by_itself()
+                self._validate_required_trust_marks()
+
+    async def aget_subject_configuration(self) -> None:
+        if not self.subject_configuration:
+            try:
+                jwt = await aget_entity_configurations(
+                    self.subject, httpc_params=self.httpc_params
+                )
+                self._set_subject_configuration(jwt[0])
             except Exception as e:
                 _msg = f"Entity Configuration for {self.subject} failed: {e}"
                 logger.error(_msg)
@@ -248,37 +448,43 @@ class TrustChainBuilder:
 
             # Trust Mark filter
             if self.required_trust_marks:
-                sc = self.subject_configuration
-                sc.filter_by_allowed_trust_marks = self.required_trust_marks
-
-                # TODO: create a proxy function that gets tm issuers ec from
-                # a previously populated cache
-                # sc.trust_mark_issuers_entity_confs = [
-                # trust_mark_issuers_entity_confs
-                # ]
-                if not sc.validate_by_allowed_trust_marks():
-                    raise InvalidRequiredTrustMark(
-                        "The required Trust Marks are not valid"
-                    )
-                else:
-                    self.verified_trust_marks.extend(sc.verified_trust_marks)
+                self.subject_configuration.filter_by_allowed_trust_marks = (
+                    self.required_trust_marks
+                )
+                # the issuers of the trust marks, all at once
+                await self.subject_configuration.aget_trust_mark_issuers_entity_confs()
+                self._validate_required_trust_marks()
+
+    def _set_subject_configuration(self, jwt: str) -> None:
+        self.subject_configuration = EntityConfiguration(
+            jwt, trust_anchor_entity_conf=self.trust_anchor_configuration
+        )
+        self.subject_configuration.validate_by_itself()
+
+    def _validate_required_trust_marks(self) -> None:
+        sc = self.subject_configuration
+        if not sc.validate_by_allowed_trust_marks():
+            raise InvalidRequiredTrustMark(
+                "The required Trust Marks are not valid"
+            )
+        else:
+            self.verified_trust_marks.extend(sc.verified_trust_marks)
 
     def serialize(self):
         res = []
         # we have only the leaf's and TA's EC, all the intermediate EC will be dropped
         ta_ec:str = ""
-        for stat in self.trust_path:
+        for n, stat in enumerate(self.trust_path):
             if not isinstance(self.trust_anchor, str):
                 if (self.subject == stat.sub == stat.iss):
                     res.append(stat.jwt)
                 elif (self.trust_anchor.sub == stat.sub == stat.iss):
                     ta_ec = stat.jwt
 
-            if stat.verified_descendant_statements:
-                res.extend(
-                    [
-                        i for i in stat.verified_descendant_statements_as_jwt.values()
-                    ]
+            # the statement about the previous subject of the path
+            if n:
+                res.append(
+                    stat.verified_descendant_statements_as_jwt[self.trust_path[n - 1].sub]
                 )
         if ta_ec:
             res.append(ta_ec)
@@ -286,10 +492,161 @@ class TrustChainBuilder:
 
     def start(self):
         try:
-            self.get_trust_anchor_configuration()
-            self.get_subject_configuration()
-            self.discovery()
+            with recording(self.recorder), span(
+                "trust_chain.start", sub=self.subject
+            ):
+                with span("trust_chain.get_trust_anchor_configuration"):
+                    self.get_trust_anchor_configuration()
+                with span("trust_chain.get_subject_configuration", sub=self.subject):
+                    self.get_subject_configuration()
+                with span("trust_chain.discovery", sub=self.subject):
+                    self.discovery()
+        except Exception as e:
+            self.is_valid = False
+            logger.error(f"{e}")
+            raise e
+
+    async def astart(self):
+        """
+        as start, the HTTP requests are made with the AsyncHttpClient
+        without blocking the event loop
+        """
+        try:
+            with recording(self.recorder), span(
+                "trust_chain.start", sub=self.subject
+            ):
+                with span("trust_chain.get_trust_anchor_configuration"):
+                    await self.aget_trust_anchor_configuration()
+                with span("trust_chain.get_subject_configuration", sub=self.subject):
+                    await self.aget_subject_configuration()
+                with span("trust_chain.discovery", sub=self.subject):
+                    await self.adiscovery()
         except Exception as e:
             self.is_valid = False
             logger.error(f"{e}")
             raise e
+
+
+class MultiTrustChainBuilder(TrustChainBuilder):
+    """
+    Builds the trust chains of a subject to many trust anchors with a single
+    metadata discovery: the entity configurations and the statements
+    of the subject and of its intermediaries are fetched once, then the trust path
+    and the final metadata of each trust anchor are taken from the same TrustGraph.
+
+    trust_chains is {trust anchor sub: TrustChainBuilder},
+    errors is {trust anchor sub: the exception that excluded it}
+    """
+
+    def __init__(
+        self,
+        subject: str,
+        trust_anchors: list,
+        httpc_params: dict = {},
+        max_authority_hints: int = 10,
+        required_trust_marks: list = [],
+        **kwargs,
+    ) -> None:
+        super().__init__(
+            subject,
+            trust_anchor=None,
+            httpc_params=httpc_params,
+            max_authority_hints=max_authority_hints,
+            required_trust_marks=required_trust_marks,
+            **kwargs,
+        )
+        self.trust_anchors = trust_anchors
+        self.trust_chains = {}
+        self.errors = {}
+
+    @property
+    def superiors_hints(self) -> list:
+        return [i.trust_anchor_configuration for i in self.trust_chains.values()]
+
+    def get_trust_anchor_configuration(self) -> None:
+        urls = [i for i in self.trust_anchors if isinstance(i, str)]
+        jwts = get_entity_configurations(urls, httpc_params=self.httpc_params) if urls else []
+        self._set_trust_anchor_configurations(dict(zip(urls, jwts)))
+
+    async def aget_trust_anchor_configuration(self) -> None:
+        urls = [i for i in self.trust_anchors if isinstance(i, str)]
+        jwts = (
+            await aget_entity_configurations(urls, httpc_params=self.httpc_params)
+            if urls else []
+        )
+        self._set_trust_anchor_configurations(dict(zip(urls, jwts)))
+
+    def _set_trust_anchor_configurations(self, jwts: dict) -> None:
+        """
+        a builder for each trust anchor, jwts are the fetched entity configurations by url
+        """
+        for trust_anchor in self.trust_anchors:
+            sub = getattr(trust_anchor, "sub", trust_anchor)
+            try:
+                if isinstance(trust_anchor, str):
+                    trust_anchor = EntityConfiguration(
+                        jwts[trust_anchor], httpc_params=self.httpc_params
+                    )
+                tc = TrustChainBuilder(
+                    self.subject,
+                    trust_anchor=trust_anchor,
+                    httpc_params=self.httpc_params,
+                    max_authority_hints=self.max_authority_hints,
+                    required_trust_marks=self.required_trust_marks,
+                )
+                tc.get_trust_anchor_configuration()
+            except Exception as e:
+                logger.error(f"Trust Anchor {sub} excluded: {e}")
+                self.errors[sub] = e
+                continue
+            tc.recorder = self.recorder
+            self.trust_chains[sub] = tc
+
+        if not self.trust_chains:
+            raise MetadataDiscoveryException(
+                f"None of the Trust Anchors {list(self.errors)} is valid"
+            )
+        # the discovery goes up to the farthest one
+        self.trust_anchor_configuration = self.superiors_hints[0]
+        self.max_path_len = max(i.max_path_len for i in self.trust_chains.values())
+
+    async def aget_subject_configuration(self) -> None:
+        await super().aget_subject_configuration()
+        if self.required_trust_marks:
+            # the issuers of the trust marks allowed by each trust anchor
+            sc = self.subject_configuration
+            for tc in self.trust_chains.values():
+                sc.trust_anchor_entity_conf = tc.trust_anchor_configuration
+                await sc.aget_trust_mark_issuers_entity_confs()
+
+    def _validate_required_trust_marks(self) -> None:
+        # by each trust anchor, that lists its own trust mark issuers
+        return
+
+    def _validate_tree_of_trust(self) -> bool:
+        graph = self.get_trust_graph()
+        sc = self.subject_configuration
+        for sub, tc in list(self.trust_chains.items()):
+            tc.subject_configuration = sc
+            tc.tree_of_trust = self.tree_of_trust
+            tc.trust_graph = graph
+            try:
+                if self.required_trust_marks:
+                    sc.trust_anchor_entity_conf = tc.trust_anchor_configuration
+                    sc.verified_trust_marks = []
+                    tc._validate_required_trust_marks()
+                with span(
+                    "trust_chain.apply_metadata_policy",
+                    sub=self.subject,
+                    trust_anchor=sub
+                ):
+                    tc.apply_metadata_policy()
+            except Exception as e:
+                logger.error(f"Trust chain for {self.subject} to {sub} failed: {e}")
+                self.errors[sub] = e
+                del self.trust_chains[sub]
+                continue
+            tc.is_valid = bool(tc.trust_path)
+
+        self.is_valid = any(i.is_valid for i in self.trust_chains.values())
+        return self.is_valid
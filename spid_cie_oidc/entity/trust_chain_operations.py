@@ -1,13 +1,22 @@
 import logging
 
+from asgiref.sync import sync_to_async
+from django.db import transaction
+from django.db.models.signals import post_save
 from django.utils import timezone
 from typing import Union
 
 from .exceptions import InvalidTrustchain, TrustchainMissingMetadata
 from .models import FetchedEntityStatement, TrustChain
-from .statements import EntityConfiguration, get_entity_configurations
+from .statements import (
+    aget_entity_configurations,
+    EntityConfiguration,
+    get_entity_configurations,
+)
 from .settings import HTTPC_PARAMS
-from .trust_chain import TrustChainBuilder
+from .metrics import CACHE_REQUESTS, TRUST_CHAIN_BUILD_SECONDS, TRUST_CHAIN_BUILDS
+from .tracing import recording, span, SpanRecorder
+from .trust_chain import MultiTrustChainBuilder, TrustChainBuilder
 from .utils import datetime_from_timestamp
 
 logger = logging.getLogger(__name__)
@@ -40,6 +49,33 @@ def trust_chain_builder(
         return tc
 
 
+async def atrust_chain_builder(
+    subject: str,
+    trust_anchor: EntityConfiguration,
+    httpc_params: dict = HTTPC_PARAMS,
+    required_trust_marks: list = []
+) -> Union[TrustChainBuilder, bool]:
+    """
+        as trust_chain_builder, with TrustChainBuilder.astart
+    """
+    tc = TrustChainBuilder(
+        subject,
+        trust_anchor=trust_anchor,
+        required_trust_marks=required_trust_marks,
+        httpc_params=httpc_params
+    )
+    await tc.astart()
+
+    if not tc.is_valid:
+        logger.error(
+            "The tree of trust cannot be validated for "
+            f"{tc.subject}: {tc.tree_of_trust}"
+        )
+        return False
+    else:
+        return tc
+
+
 def dumps_statements_from_trust_chain_to_db(trust_chain: TrustChainBuilder) -> list:
 
     entity_statements = []
@@ -93,6 +129,97 @@ def dumps_statements_from_trust_chain_to_db(trust_chain: TrustChainBuilder) -> l
     return entity_statements
 
 
+def _store_trust_anchor(
+    fetched_trust_anchor, ta_conf: EntityConfiguration
+) -> FetchedEntityStatement:
+    data = dict(
+        exp=datetime_from_timestamp(ta_conf.payload["exp"]),
+        iat=datetime_from_timestamp(ta_conf.payload["iat"]),
+        statement=ta_conf.payload,
+        jwt=ta_conf.jwt,
+    )
+
+    if not fetched_trust_anchor:
+        # trust to the anchor should be absolute trusted!
+        # ta_conf.validate_by_itself()
+        return FetchedEntityStatement.objects.create(
+            sub=ta_conf.sub, iss=ta_conf.iss, **data
+        )
+
+    FetchedEntityStatement.objects.filter(pk=fetched_trust_anchor.pk).update(**data)
+    fetched_trust_anchor.refresh_from_db()
+    return fetched_trust_anchor
+
+
+def _check_trust_chain(trust_chain, subject: str, trust_anchor: str) -> None:
+    TRUST_CHAIN_BUILDS.inc(
+        trust_anchor=trust_anchor,
+        result="ok" if trust_chain and trust_chain.is_valid else "failed"
+    )
+    if not trust_chain:
+        raise InvalidTrustchain(
+            f"Trust chain for subject {subject} and "
+            f"trust_anchor {trust_anchor} is not found"
+        )
+    elif not trust_chain.is_valid:
+        raise InvalidTrustchain(
+            f"Trust chain for subject {subject} and "
+            f"trust_anchor {trust_anchor} is not valid"
+        )
+    elif not trust_chain.final_metadata:
+        raise TrustchainMissingMetadata(
+            f"Trust chain for subject {subject} and "
+            f"trust_anchor {trust_anchor} doesn't have any metadata"
+        )
+
+
+def _store_trust_chain(
+    trust_chain: TrustChainBuilder,
+    fetched_trust_anchor: FetchedEntityStatement,
+    recorder: SpanRecorder,
+) -> TrustChain:
+    subject = trust_chain.subject
+    with recording(recorder), span(
+        "trust_chain.dumps_statements_to_db", sub=subject
+    ):
+        dumps_statements_from_trust_chain_to_db(trust_chain)
+
+    tc = TrustChain.objects.filter(
+        sub=subject, trust_anchor__sub=fetched_trust_anchor.sub
+    )
+    now = timezone.localtime()
+    data = dict(
+        exp=trust_chain.exp_datetime,
+        processing_start = now,
+        # update() doesn't set it, the signed resolve responses are cached by it
+        modified=now,
+        chain=trust_chain.serialize(),
+        jwks = trust_chain.subject_configuration.jwks,
+        metadata=trust_chain.final_metadata,
+        parties_involved=[i.sub for i in trust_chain.trust_path],
+        status="valid",
+        log=recorder.as_log(),
+        trust_marks=[
+            {"id": i.id, "trust_mark": i.jwt}
+            for i in trust_chain.verified_trust_marks
+        ],
+        is_active=True,
+    )
+
+    if tc:
+        tc.update(**data)
+        tc = tc.first()
+        # update() doesn't send it, the caches built over the chain need it
+        post_save.send(sender=TrustChain, instance=tc, created=False)
+    else:
+        tc = TrustChain.objects.create(
+            sub=subject,
+            trust_anchor=fetched_trust_anchor,
+            **data,
+        )
+    return tc
+
+
 def get_or_create_trust_chain(
     subject: str,
     trust_anchor: str,
@@ -110,38 +237,19 @@ def get_or_create_trust_chain(
     return the updated one
 
     """
+    # the timings of each phase are summarized in TrustChain.log
+    recorder = SpanRecorder()
     fetched_trust_anchor = FetchedEntityStatement.objects.filter(
         sub=trust_anchor, iss=trust_anchor
-    )
-    if not fetched_trust_anchor or fetched_trust_anchor.first().is_expired or force:
+    ).first()
+    if not fetched_trust_anchor or fetched_trust_anchor.is_expired or force:
 
-        jwts = get_entity_configurations([trust_anchor], httpc_params=httpc_params)
-        ta_conf = EntityConfiguration(jwts[0], httpc_params=httpc_params)
-
-        data = dict(
-            exp=datetime_from_timestamp(ta_conf.payload["exp"]),
-            iat=datetime_from_timestamp(ta_conf.payload["iat"]),
-            statement=ta_conf.payload,
-            jwt=ta_conf.jwt,
-        )
-
-        if not fetched_trust_anchor:
-            # trust to the anchor should be absolute trusted!
-            # ta_conf.validate_by_itself()
-            fetched_trust_anchor = FetchedEntityStatement.objects.create(
-                sub=ta_conf.sub, iss=ta_conf.iss, **data
-            )
-        else:
-            fetched_trust_anchor.update(
-                exp=datetime_from_timestamp(ta_conf.payload["exp"]),
-                iat=datetime_from_timestamp(ta_conf.payload["iat"]),
-                statement=ta_conf.payload,
-                jwt=ta_conf.jwt,
-            )
-            fetched_trust_anchor = fetched_trust_anchor.first()
+        with recording(recorder), span("trust_chain.fetch_trust_anchor"):
+            jwts = get_entity_configurations([trust_anchor], httpc_params=httpc_params)
+            ta_conf = EntityConfiguration(jwts[0], httpc_params=httpc_params)
 
+        fetched_trust_anchor = _store_trust_anchor(fetched_trust_anchor, ta_conf)
     else:
-        fetched_trust_anchor = fetched_trust_anchor.first()
         ta_conf = fetched_trust_anchor.get_entity_configuration_as_obj()
 
     tc = TrustChain.objects.filter(sub=subject, trust_anchor__sub=trust_anchor).first()
@@ -150,54 +258,248 @@ def get_or_create_trust_chain(
         # if manualy disabled by staff
         return None
     elif force or not tc or tc.is_expired:
-        trust_chain = trust_chain_builder(
-            subject=subject,
-            trust_anchor=ta_conf,
-            required_trust_marks=required_trust_marks
-        )
-        if not trust_chain:
-            raise InvalidTrustchain(
-                f"Trust chain for subject {subject} and "
-                f"trust_anchor {trust_anchor} is not found"
-            )
-        elif not trust_chain.is_valid:
-            raise InvalidTrustchain(
-                f"Trust chain for subject {subject} and "
-                f"trust_anchor {trust_anchor} is not valid"
-            )
-        elif not trust_chain.final_metadata:
-            raise TrustchainMissingMetadata(
-                f"Trust chain for subject {subject} and "
-                f"trust_anchor {trust_anchor} doesn't have any metadata"
+        CACHE_REQUESTS.inc(cache="trust_chain", result="miss")
+        try:
+            with recording(recorder), TRUST_CHAIN_BUILD_SECONDS.time(
+                trust_anchor=trust_anchor
+            ):
+                trust_chain = trust_chain_builder(
+                    subject=subject,
+                    trust_anchor=ta_conf,
+                    required_trust_marks=required_trust_marks
+                )
+        except Exception:
+            TRUST_CHAIN_BUILDS.inc(trust_anchor=trust_anchor, result="failed")
+            raise
+        _check_trust_chain(trust_chain, subject, trust_anchor)
+        tc = _store_trust_chain(trust_chain, fetched_trust_anchor, recorder)
+    else:
+        CACHE_REQUESTS.inc(cache="trust_chain", result="hit")
+
+    return tc
+
+
+async def aget_or_create_trust_chain(
+    subject: str,
+    trust_anchor: str,
+    httpc_params: dict = HTTPC_PARAMS,
+    required_trust_marks: list = [],
+    force: bool = False,
+) -> Union[TrustChain, None]:
+    """
+    as get_or_create_trust_chain, for the async views.
+    The statements are fetched with the AsyncHttpClient,
+    without holding a thread while waiting for them
+    """
+    recorder = SpanRecorder()
+    fetched_trust_anchor = await FetchedEntityStatement.objects.filter(
+        sub=trust_anchor, iss=trust_anchor
+    ).afirst()
+    if not fetched_trust_anchor or fetched_trust_anchor.is_expired or force:
+
+        with recording(recorder), span("trust_chain.fetch_trust_anchor"):
+            jwts = await aget_entity_configurations(
+                [trust_anchor], httpc_params=httpc_params
             )
-        dumps_statements_from_trust_chain_to_db(trust_chain)
+            ta_conf = EntityConfiguration(jwts[0], httpc_params=httpc_params)
 
-        tc = TrustChain.objects.filter(
-            sub=subject, trust_anchor__sub=trust_anchor
+        fetched_trust_anchor = await sync_to_async(_store_trust_anchor)(
+            fetched_trust_anchor, ta_conf
         )
-        data = dict(
-            exp=trust_chain.exp_datetime,
-            processing_start = timezone.localtime(),
-            chain=trust_chain.serialize(),
-            jwks = trust_chain.subject_configuration.jwks,
-            metadata=trust_chain.final_metadata,
-            parties_involved=[i.sub for i in trust_chain.trust_path],
-            status="valid",
-            trust_marks=[
-                {"id": i.id, "trust_mark": i.jwt}
-                for i in trust_chain.verified_trust_marks
-            ],
-            is_active=True,
+    else:
+        ta_conf = fetched_trust_anchor.get_entity_configuration_as_obj()
+
+    tc = await TrustChain.objects.filter(
+        sub=subject, trust_anchor__sub=trust_anchor
+    ).afirst()
+
+    if tc and not tc.is_active:
+        # if manualy disabled by staff
+        return None
+    elif force or not tc or tc.is_expired:
+        CACHE_REQUESTS.inc(cache="trust_chain", result="miss")
+        try:
+            with recording(recorder), TRUST_CHAIN_BUILD_SECONDS.time(
+                trust_anchor=trust_anchor
+            ):
+                trust_chain = await atrust_chain_builder(
+                    subject=subject,
+                    trust_anchor=ta_conf,
+                    required_trust_marks=required_trust_marks
+                )
+        except Exception:
+            TRUST_CHAIN_BUILDS.inc(trust_anchor=trust_anchor, result="failed")
+            raise
+        _check_trust_chain(trust_chain, subject, trust_anchor)
+        tc = await sync_to_async(_store_trust_chain)(
+            trust_chain, fetched_trust_anchor, recorder
         )
+    else:
+        CACHE_REQUESTS.inc(cache="trust_chain", result="hit")
+
+    return tc
+
+
+def _get_trust_chains_to_build(
+    subject: str, trust_anchors: list, force: bool
+) -> tuple:
+    """
+    the fetched trust anchors by sub, the trust anchors whose trust chain
+    has to be built and the trust chains to return as they are
+    """
+    fetched_trust_anchors = {
+        i.sub: i for i in FetchedEntityStatement.objects.filter(
+            sub__in=trust_anchors, iss__in=trust_anchors
+        ) if i.sub == i.iss
+    }
+    trust_chains = {
+        i.trust_anchor.sub: i for i in TrustChain.objects.filter(
+            sub=subject, trust_anchor__sub__in=trust_anchors
+        ).select_related("trust_anchor")
+    }
+
+    to_build = []
+    res = {}
+    for trust_anchor in trust_anchors:
+        tc = trust_chains.get(trust_anchor, None)
+        if tc and not tc.is_active:
+            # if manualy disabled by staff
+            res[trust_anchor] = None
+        elif force or not tc or tc.is_expired:
+            CACHE_REQUESTS.inc(cache="trust_chain", result="miss")
+            to_build.append(trust_anchor)
+        else:
+            CACHE_REQUESTS.inc(cache="trust_chain", result="hit")
+            res[trust_anchor] = tc
+    return fetched_trust_anchors, to_build, res
 
-        if tc:
-            tc.update(**data)
-            tc = tc.first()
+
+def _get_multi_trust_chain_builder(
+    subject: str,
+    to_build: list,
+    fetched_trust_anchors: dict,
+    force: bool,
+    **kwargs
+) -> MultiTrustChainBuilder:
+    trust_anchors = []
+    for trust_anchor in to_build:
+        fetched = fetched_trust_anchors.get(trust_anchor, None)
+        if not fetched or fetched.is_expired or force:
+            # fetched by the builder, with the others
+            trust_anchors.append(trust_anchor)
         else:
-            tc = TrustChain.objects.create(
-                sub=subject,
-                trust_anchor=fetched_trust_anchor,
-                **data,
+            trust_anchors.append(fetched.get_entity_configuration_as_obj())
+    return MultiTrustChainBuilder(subject, trust_anchors=trust_anchors, **kwargs)
+
+
+def _store_trust_chains(
+    builder: MultiTrustChainBuilder, to_build: list, recorder: SpanRecorder
+) -> dict:
+    """
+    stores the valid trust chains of the builder, and their trust anchors,
+    in one transaction. The others are returned as the exception that excluded them.
+    The log of each trust chain has the spans of the shared discovery and its own
+    """
+    res = {}
+    with transaction.atomic():
+        for trust_anchor in to_build:
+            if trust_anchor in builder.errors:
+                TRUST_CHAIN_BUILDS.inc(trust_anchor=trust_anchor, result="failed")
+                res[trust_anchor] = builder.errors[trust_anchor]
+                continue
+
+            trust_chain = builder.trust_chains[trust_anchor]
+            try:
+                _check_trust_chain(trust_chain, builder.subject, trust_anchor)
+            except Exception as e:
+                res[trust_anchor] = e
+                continue
+
+            # the ones stored before may have stored it as an intermediary
+            fetched = FetchedEntityStatement.objects.filter(
+                sub=trust_anchor, iss=trust_anchor
+            ).first()
+            ta_conf = trust_chain.trust_anchor_configuration
+            if not fetched or fetched.jwt != ta_conf.jwt:
+                fetched = _store_trust_anchor(fetched, ta_conf)
+            res[trust_anchor] = _store_trust_chain(
+                trust_chain, fetched, recorder.copy()
             )
+    return res
 
-    return tc
+
+def get_or_create_trust_chains(
+    subject: str,
+    trust_anchors: list,
+    httpc_params: dict = HTTPC_PARAMS,
+    required_trust_marks: list = [],
+    force: bool = False,
+) -> dict:
+    """
+    as get_or_create_trust_chain, for many trust anchors.
+    The missing or expired trust chains are built by a single discovery,
+    see MultiTrustChainBuilder, and stored in one transaction.
+
+    returns {trust anchor: TrustChain, None if disabled by staff
+    or the exception raised by its build}
+    """
+    recorder = SpanRecorder()
+    fetched_trust_anchors, to_build, res = _get_trust_chains_to_build(
+        subject, trust_anchors, force
+    )
+    if to_build:
+        with recording(recorder):
+            builder = _get_multi_trust_chain_builder(
+                subject,
+                to_build,
+                fetched_trust_anchors,
+                force,
+                httpc_params=httpc_params,
+                required_trust_marks=required_trust_marks,
+            )
+            try:
+                builder.start()
+            except Exception:
+                for trust_anchor in to_build:
+                    TRUST_CHAIN_BUILDS.inc(trust_anchor=trust_anchor, result="failed")
+                raise
+        res.update(
+            _store_trust_chains(builder, to_build, recorder)
+        )
+    return {i: res[i] for i in trust_anchors}
+
+
+async def aget_or_create_trust_chains(
+    subject: str,
+    trust_anchors: list,
+    httpc_params: dict = HTTPC_PARAMS,
+    required_trust_marks: list = [],
+    force: bool = False,
+) -> dict:
+    """
+    as get_or_create_trust_chains, with MultiTrustChainBuilder.astart
+    """
+    recorder = SpanRecorder()
+    fetched_trust_anchors, to_build, res = await sync_to_async(
+        _get_trust_chains_to_build
+    )(subject, trust_anchors, force)
+    if to_build:
+        with recording(recorder):
+            builder = _get_multi_trust_chain_builder(
+                subject,
+                to_build,
+                fetched_trust_anchors,
+                force,
+                httpc_params=httpc_params,
+                required_trust_marks=required_trust_marks,
+            )
+            try:
+                await builder.astart()
+            except Exception:
+                for trust_anchor in to_build:
+                    TRUST_CHAIN_BUILDS.inc(trust_anchor=trust_anchor, result="failed")
+                raise
+        res.update(
+            await sync_to_async(_store_trust_chains)(builder, to_build, recorder)
+        )
+    return {i: res[i] for i in trust_anchors}
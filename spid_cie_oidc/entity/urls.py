@@ -16,9 +16,12 @@ Including another URLconf
 from django.conf import settings
 from django.urls import path
 
+from .settings import OIDCFED_ASYNC_VIEWS, OIDCFED_METRICS
 from .views import (
+    aresolve_entity_statement,
     entity_configuration,
     historical_keys,
+    metrics,
     resolve_entity_statement
 )
 
@@ -30,10 +33,17 @@ urlpatterns = [
         entity_configuration,
         name="entity_configuration",
     ),
-    path(f"{_PREF}resolve", resolve_entity_statement, name="oidcfed_resolve"),
+    path(
+        f"{_PREF}resolve",
+        aresolve_entity_statement if OIDCFED_ASYNC_VIEWS else resolve_entity_statement,
+        name="oidcfed_resolve"
+    ),
     path(
         f"{_PREF}.well-known/openid-federation-historical-jwks",
         historical_keys,
         name="oidcfed_historical_keys"
     )
 ]
+
+if OIDCFED_METRICS["view"]:
+    urlpatterns.append(path(f"{_PREF}metrics", metrics, name="oidcfed_metrics"))
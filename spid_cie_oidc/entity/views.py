@@ -1,16 +1,26 @@
+import hashlib
+import json
 import logging
 
+from asgiref.sync import sync_to_async
 from django.conf import settings
+from django.core.cache import caches
+from django.core.serializers.json import DjangoJSONEncoder
 from djagger.decorators import schema
 from django.http import Http404
 from django.http import HttpResponse
 from django.http import JsonResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
 
 from spid_cie_oidc.entity.jwtse import create_jws
 from spid_cie_oidc.entity.schemas.resolve_endpoint import (
     ResolveRequest, ResolveResponse, ResolveErrorResponse
 )
-from spid_cie_oidc.entity.trust_chain_operations import get_or_create_trust_chain
+from spid_cie_oidc.entity.trust_chain_operations import (
+    aget_or_create_trust_chain,
+    get_or_create_trust_chain,
+)
 
 from .models import (
     FederationEntityConfiguration,
@@ -18,7 +28,8 @@ from .models import (
     TrustChain,
     StaffToken
 )
-from .settings import HTTPC_PARAMS
+from .metrics import CACHE_REQUESTS, REGISTRY
+from .settings import HTTPC_PARAMS, OIDCFED_METRICS, OIDCFED_RESOLVE_CACHE
 from .statements import OIDCFED_FEDERATION_WELLKNOWN_URL
 from .utils import iat_now
 
@@ -60,7 +71,7 @@ def entity_configuration(request):
         )
 
 
-@schema(
+_RESOLVE_SCHEMA = dict(
     methods=['GET'],
     get_request_schema = {
         "application/x-www-form-urlencoded": ResolveRequest
@@ -72,25 +83,113 @@ def entity_configuration(request):
     },
     tags = ['Federation API']
 )
-def resolve_entity_statement(request, format: str = "jose"):
-    """
-    resolves the final metadata of its descendants
 
-    In this implementation we only returns a preexisting
-    Metadata if it's valid
-    we avoid any possibility to trigger a new Metadata discovery if
-    """
+
+def _get_resolve_query(request) -> dict:
     if not all((request.GET.get("sub", None), request.GET.get("anchor", None))):
         raise Http404("sub and anchor parameters are REQUIRED.")
 
-    iss = FederationEntityConfiguration.objects.filter(is_active=True).first()
-
-    _q = dict(
+    return dict(
         sub=request.GET["sub"],
         trust_anchor__sub=request.GET["anchor"],
         is_active=True
     )
 
+
+def _get_resolve_trust_chain_kwargs(_q: dict) -> dict:
+    # a staff token get a fresh trust chain on each call
+    return dict(
+        httpc_params=HTTPC_PARAMS,
+        required_trust_marks = getattr(
+            settings, "OIDCFED_REQUIRED_TRUST_MARKS", []
+        ),
+        subject=_q["sub"],
+        trust_anchor=_q["trust_anchor__sub"],
+        force = True
+    )
+
+
+def get_resolve_cache_key(entity: TrustChain, iss, format: str) -> str:
+    """
+    identifies a version of the resolve response of a trust chain,
+    signed by the current key of the resolver
+    """
+    _key = "|".join(
+        (
+            entity.sub,
+            str(entity.trust_anchor_id),
+            entity.modified.isoformat(),
+            iss.sub,
+            iss.jwks_fed[0].get("kid", ""),
+            format,
+        )
+    )
+    return f"oidcfed-resolve-{hashlib.sha256(_key.encode()).hexdigest()}"
+
+
+def _resolve_response(request, entity: TrustChain, format: str) -> HttpResponse:
+    if not entity:
+        raise Http404("entity not found.")
+
+    iss = FederationEntityConfiguration.get_active_conf()
+    if request.GET.get("format") == "json" or format == "json":
+        format, content_type = "json", "application/json"
+    else:
+        format, content_type = "jose", "application/jose"
+
+    # the response changes only with the trust chain or the signing key
+    cache_key = get_resolve_cache_key(entity, iss, format)
+    etag = quote_etag(cache_key.rsplit("-", 1)[-1])
+    # a rotation of the signing key is a change of the resolver configuration
+    last_modified = int(max(entity.modified, iss.modified).timestamp())
+    not_modified = get_conditional_response(
+        request, etag=etag, last_modified=last_modified
+    )
+    if not_modified:
+        return not_modified
+
+    cache = caches[OIDCFED_RESOLVE_CACHE] if OIDCFED_RESOLVE_CACHE else None
+    content = cache.get(cache_key) if cache else None
+    if content is None:
+        CACHE_REQUESTS.inc(cache="resolve", result="miss")
+        res = {
+            "iss": iss.sub,
+            "sub": request.GET["sub"],
+            # "aud": [],
+            "iat": entity.iat_as_timestamp,
+            "exp": entity.exp_as_timestamp,
+            "trust_marks": entity.trust_marks,
+            "metadata": entity.metadata,
+            "trust_chain": entity.chain
+        }
+        if format == "json":
+            content = json.dumps(res, cls=DjangoJSONEncoder)
+        else:
+            content = create_jws(res, iss.jwks_fed[0])
+
+        timeout = entity.exp_as_timestamp - iat_now()
+        if cache and timeout > 0:
+            cache.set(cache_key, content, timeout)
+    else:
+        CACHE_REQUESTS.inc(cache="resolve", result="hit")
+
+    response = HttpResponse(content, content_type=content_type)
+    response["ETag"] = etag
+    response["Last-Modified"] = http_date(last_modified)
+    return response
+
+
+@schema(**_RESOLVE_SCHEMA)
+def resolve_entity_statement(request, format: str = "jose"):
+    """
+    resolves the final metadata of its descendants
+
+    In this implementation we only returns a preexisting
+    Metadata if it's valid
+    we avoid any possibility to trigger a new Metadata discovery if
+    """
+    _q = _get_resolve_query(request)
+
     # gets the cached one
     entity = TrustChain.objects.filter(**_q).first()
 
@@ -100,44 +199,48 @@ def resolve_entity_statement(request, format: str = "jose"):
         staff_token = StaffToken.objects.filter(
             token = staff_token_head
         ).first()
-        if staff_token.is_valid:
+        if staff_token and staff_token.is_valid:
             try:
-                # a staff token get a fresh trust chain on each call
                 entity = get_or_create_trust_chain(
-                    httpc_params=HTTPC_PARAMS,
-                    required_trust_marks = getattr(
-                        settings, "OIDCFED_REQUIRED_TRUST_MARKS", []
-                    ),
-                    subject=_q["sub"],
-                    trust_anchor=_q["trust_anchor__sub"],
-                    force = True
+                    **_get_resolve_trust_chain_kwargs(_q)
                 )
             except Exception as e:
                 logger.error(
                     f"Failed privileged Trust Chain creation for {_q['sub']}: {e}"
                 )
 
-    if not entity:
-        raise Http404("entity not found.")
+    return _resolve_response(request, entity, format)
 
-    res = {
-        "iss": iss.sub,
-        "sub": request.GET["sub"],
-        # "aud": [],
-        "iat": entity.iat_as_timestamp,
-        "exp": entity.exp_as_timestamp,
-        "trust_marks": entity.trust_marks,
-        "metadata": entity.metadata,
-        "trust_chain": entity.chain
-    }
 
-    if request.GET.get("format") == "json" or format == "json":
-        return JsonResponse(res, safe=False)
-    else:
-        return HttpResponse(
-            create_jws(res, iss.jwks_fed[0]),
-            content_type="application/jose",
-        )
+@schema(**_RESOLVE_SCHEMA)
+async def aresolve_entity_statement(request, format: str = "jose"):
+    """
+    as resolve_entity_statement, for the ASGI deployments.
+    The trust chain requested with a staff token is built
+    without holding a thread while its statements are fetched
+    """
+    _q = _get_resolve_query(request)
+
+    # gets the cached one
+    entity = await TrustChain.objects.filter(**_q).afirst()
+
+    # only with privileged actors with staff token can triggers a new trust chain
+    staff_token_head = request.headers.get("Authorization", None)
+    if staff_token_head:
+        staff_token = await StaffToken.objects.filter(
+            token = staff_token_head
+        ).afirst()
+        if staff_token and staff_token.is_valid:
+            try:
+                entity = await aget_or_create_trust_chain(
+                    **_get_resolve_trust_chain_kwargs(_q)
+                )
+            except Exception as e:
+                logger.error(
+                    f"Failed privileged Trust Chain creation for {_q['sub']}: {e}"
+                )
+
+    return await sync_to_async(_resolve_response)(request, entity, format)
 
 
 def openid_jwks(request, metadata_type:str, resource_type:str):
@@ -218,3 +321,19 @@ def historical_keys(request):
         return HttpResponse(
             res, content_type="application/jwk-set+jwt"
         )
+
+
+def metrics(request):
+    """
+    the counters and histograms of the hot paths, in the Prometheus text format
+    """
+    if OIDCFED_METRICS["staff_token"]:
+        staff_token = StaffToken.objects.filter(
+            token=request.headers.get("Authorization", None)
+        ).first()
+        if not staff_token or not staff_token.is_valid:
+            return HttpResponse(status=401)
+
+    return HttpResponse(
+        REGISTRY.exposition(), content_type="text/plain; version=0.0.4; charset=utf-8"
+    )
@@ -50,6 +50,10 @@ class ToolsTests(TestCase):
         self.assertEqual(res.status_code, 200)
         self.assertIsNotNone(res.context['private_jwk'])
 
+        res = self.client.get(url, {"kty": "EC", "crv": "P-384"})
+        self.assertEqual(res.status_code, 200)
+        self.assertIn('"crv": "P-384"', res.context['public_jwk'])
+
     def test_convert_jwk_to_pem(self):
         url = reverse("oidc_onboarding_convert_jwk")
         res = self.client.get(url)
@@ -21,8 +21,8 @@ from .models import OnBoardingRegistration
 from spid_cie_oidc.entity.jwks import (
     private_pem_from_jwk,
     public_pem_from_jwk,
-    new_rsa_key,
-    serialize_rsa_key,
+    new_key,
+    serialize_key,
     private_jwk_from_pem,
     public_jwk_from_pem
 )
@@ -86,12 +86,20 @@ def onboarding_entities(request):
 
 
 def onboarding_create_jwk(request):
-    _rsa_key = new_rsa_key()
-    private_jwk = serialize_rsa_key(_rsa_key.priv_key, 'private')
-    public_jwk = serialize_rsa_key(_rsa_key.pub_key)
+    kty = request.GET.get('kty', 'RSA')
+    crv = request.GET.get('crv', 'P-256')
+    try:
+        _key = new_key(kty, crv)
+    except (ValueError, KeyError):
+        kty, crv = 'RSA', 'P-256'
+        _key = new_key(kty)
+    private_jwk = serialize_key(_key.priv_key, 'private')
+    public_jwk = serialize_key(_key.pub_key)
     context = {
         "private_jwk": json.dumps(private_jwk, indent=4),
-        "public_jwk": json.dumps(public_jwk, indent=4)
+        "public_jwk": json.dumps(public_jwk, indent=4),
+        "kty": kty,
+        "crv": crv,
     }
     return render(request, 'onboarding_jwk.html', context)
 
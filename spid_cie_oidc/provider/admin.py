@@ -31,6 +31,11 @@ class IssuedTokenAdmin(admin.ModelAdmin):
         "access_token",
         "id_token",
         "refresh_token",
+        "jti",
+        "access_token_hash",
+        "refresh_token_hash",
+        "expires",
+        "expires_in",
         "created",
         "session",
     )
@@ -0,0 +1,24 @@
+# Generated by Django 4.2.3 on 2026-10-19 05:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        (
+            "spid_cie_oidc_provider",
+            "0008_alter_oidcsession_authz_request",
+        ),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="issuedtoken",
+            name="expires_in",
+            field=models.PositiveIntegerField(
+                blank=True,
+                help_text="lifetime of the access token, in seconds",
+                null=True,
+            ),
+        ),
+    ]
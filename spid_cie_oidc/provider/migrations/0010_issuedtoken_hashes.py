@@ -0,0 +1,71 @@
+# Generated by Django 4.2.3 on 2026-10-19 05:20
+
+import base64
+import hashlib
+import json
+
+from django.db import migrations, models
+
+
+def _hash(token):
+    return hashlib.sha256(token.encode()).hexdigest() if token else ""
+
+
+def _jti(token):
+    try:
+        b = token.split(".")[1]
+        return json.loads(base64.urlsafe_b64decode(f"{b}{'=' * divmod(len(b), 4)[1]}"))["jti"]
+    except Exception:
+        return ""
+
+
+def hash_issued_tokens(apps, schema_editor):
+    IssuedToken = apps.get_model("spid_cie_oidc_provider", "IssuedToken")
+    batch = []
+    for token in IssuedToken.objects.filter(access_token_hash="").iterator():  # nosec B106
+        token.access_token_hash = _hash(token.access_token)
+        token.refresh_token_hash = _hash(token.refresh_token)
+        token.jti = _jti(token.access_token) if token.access_token else ""
+        batch.append(token)
+        if len(batch) >= 1000:
+            IssuedToken.objects.bulk_update(
+                batch, ["access_token_hash", "refresh_token_hash", "jti"]
+            )
+            batch = []
+    if batch:
+        IssuedToken.objects.bulk_update(
+            batch, ["access_token_hash", "refresh_token_hash", "jti"]
+        )
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        (
+            "spid_cie_oidc_provider",
+            "0009_issuedtoken_expires_in",
+        ),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="issuedtoken",
+            name="access_token_hash",
+            field=models.CharField(blank=True, db_index=True, default="", max_length=64),
+        ),
+        migrations.AddField(
+            model_name="issuedtoken",
+            name="jti",
+            field=models.CharField(
+                blank=True,
+                default="",
+                help_text="jti of the access token",
+                max_length=64,
+            ),
+        ),
+        migrations.AddField(
+            model_name="issuedtoken",
+            name="refresh_token_hash",
+            field=models.CharField(blank=True, db_index=True, default="", max_length=64),
+        ),
+        migrations.RunPython(hash_issued_tokens, migrations.RunPython.noop),
+    ]
@@ -3,11 +3,17 @@ import logging
 
 from django.contrib.auth import get_user_model
 from django.contrib.sessions.models import Session
+from django.core.cache import caches
 from django.db import models
 from django.utils import timezone
 from django.utils.translation import gettext as _
 from spid_cie_oidc.entity.abstract_models import TimeStampedModel
-from spid_cie_oidc.provider.settings import OIDCFED_PROVIDER_SALT
+from spid_cie_oidc.provider.settings import (
+    OIDCFED_PROVIDER_AUTH_CODE_MAX_AGE,
+    OIDCFED_PROVIDER_COMPACT_TOKENS,
+    OIDCFED_PROVIDER_SALT,
+    OIDCFED_PROVIDER_TOKEN_CACHE
+)
 
 logger = logging.getLogger(__name__)
 
@@ -65,6 +71,17 @@ class OidcSession(TimeStampedModel):
             f"{self.user_uid}{OIDCFED_PROVIDER_SALT}".encode()
         ).hexdigest()
 
+    @classmethod
+    def get_purgeable(cls, before):
+        """
+        sessions revoked before the given datetime
+        or created before it and without any unexpired token
+        """
+        return cls.objects.filter(
+            models.Q(revoked=True, modified__lt=before)
+            | models.Q(created__lt=before)
+        ).exclude(issuedtoken__expires__gte=timezone.localtime())
+
     def __str__(self):
         return "{} {}".format(self.user_uid, self.auth_code)
 
@@ -75,18 +92,115 @@ class OidcSession(TimeStampedModel):
         ordering = ["-created"]
 
 
+def token_hash(token: str) -> str:
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
 class IssuedToken(TimeStampedModel):
     session = models.ForeignKey(OidcSession, on_delete=models.CASCADE)
+    # the JWTs are not stored if OIDCFED_PROVIDER_COMPACT_TOKENS is enabled
     access_token = models.TextField(blank=True, null=True)
     id_token = models.TextField(blank=True, null=True)
     refresh_token = models.TextField(blank=True, null=True)
+    jti = models.CharField(
+        max_length=64, blank=True, default="", help_text=_("jti of the access token")
+    )
+    access_token_hash = models.CharField(
+        max_length=64, blank=True, default="", db_index=True
+    )
+    refresh_token_hash = models.CharField(
+        max_length=64, blank=True, default="", db_index=True
+    )
     expires = models.DateTimeField()
+    expires_in = models.PositiveIntegerField(
+        blank=True, null=True, help_text=_("lifetime of the access token, in seconds")
+    )
     revoked = models.BooleanField(default=False)
 
     class Meta:
         verbose_name = "Issued Token"
         verbose_name_plural = "Issued Tokens"
 
+    @classmethod
+    def issue(
+        cls,
+        access_token: str,
+        id_token: str,
+        refresh_token: str = None,
+        redeemable: bool = True,
+        **kwargs
+    ):
+        """
+        stores the tokens issued for a session.
+        With compact tokens the JWTs are kept in the token cache
+        if they have to be returned later by the token endpoint (redeemable)
+        """
+        token = cls(
+            access_token_hash=token_hash(access_token),
+            refresh_token_hash=token_hash(refresh_token) if refresh_token else "",
+            **kwargs
+        )
+        if not OIDCFED_PROVIDER_COMPACT_TOKENS:
+            token.access_token = access_token
+            token.id_token = id_token
+            token.refresh_token = refresh_token
+        token.save()
+
+        if OIDCFED_PROVIDER_COMPACT_TOKENS and redeemable:
+            caches[OIDCFED_PROVIDER_TOKEN_CACHE].set(
+                token.cache_key,
+                dict(
+                    access_token=access_token,
+                    id_token=id_token,
+                    refresh_token=refresh_token
+                ),
+                OIDCFED_PROVIDER_AUTH_CODE_MAX_AGE * 60
+            )
+        return token
+
+    @classmethod
+    def get_by_access_token(cls, access_token: str):
+        return cls.objects.select_related("session").filter(
+            access_token_hash=token_hash(access_token)
+        )
+
+    @classmethod
+    def get_by_refresh_token(cls, refresh_token: str):
+        return cls.objects.select_related("session").filter(
+            refresh_token_hash=token_hash(refresh_token)
+        )
+
+    @property
+    def cache_key(self) -> str:
+        return f"oidcfed-issued-token-{self.pk}"
+
+    def pop_jwts(self) -> dict:
+        """
+        returns the issued JWTs, from the token cache if they are not stored.
+        With compact tokens they can be taken only once
+        """
+        if self.access_token:
+            return dict(
+                access_token=self.access_token,
+                id_token=self.id_token,
+                refresh_token=self.refresh_token
+            )
+        cache = caches[OIDCFED_PROVIDER_TOKEN_CACHE]
+        jwts = cache.get(self.cache_key)
+        # only the request that deletes them can return them
+        if not jwts or not cache.delete(self.cache_key):
+            return {}
+        return jwts
+
+    @classmethod
+    def get_purgeable(cls, before):
+        """
+        tokens of the sessions revoked before the given datetime.
+        The expired tokens of a live session are kept
+        because they count for the refresh token policies
+        """
+        return cls.objects.filter(session__revoked=True, modified__lt=before)
+
     @property
     def client_id(self):
         return self.session.client_id
@@ -103,5 +217,12 @@ class IssuedToken(TimeStampedModel):
     def is_revoked(self):
         return self.session.revoked or self.revoked
 
+    def save(self, *args, **kwargs):
+        if self.access_token and not self.access_token_hash:
+            self.access_token_hash = token_hash(self.access_token)
+        if self.refresh_token and not self.refresh_token_hash:
+            self.refresh_token_hash = token_hash(self.refresh_token)
+        super().save(*args, **kwargs)
+
     def __str__(self):
         return "{} @ {}".format(self.session.user_uid, self.session.client_id)
@@ -144,6 +144,29 @@ OIDCFED_PROVIDER_AUTH_CODE_MAX_AGE = getattr(
     10
 )
 
+# django cache where the jti of the client assertions and of the
+# request objects are kept until their expiration, to detect replays.
+# Multiple processes or hosts need a shared cache, eg: redis or memcached
+OIDCFED_PROVIDER_REPLAY_CACHE = getattr(
+    settings,
+    "OIDCFED_PROVIDER_REPLAY_CACHE",
+    "default"
+)
+
+# if True the issued tokens are stored only by jti, hashes and expiration,
+# the JWTs are kept in OIDCFED_PROVIDER_TOKEN_CACHE until the auth code
+# is redeemed, for OIDCFED_PROVIDER_AUTH_CODE_MAX_AGE minutes at most
+OIDCFED_PROVIDER_COMPACT_TOKENS = getattr(
+    settings,
+    "OIDCFED_PROVIDER_COMPACT_TOKENS",
+    False
+)
+OIDCFED_PROVIDER_TOKEN_CACHE = getattr(
+    settings,
+    "OIDCFED_PROVIDER_TOKEN_CACHE",
+    "default"
+)
+
 OIDCFED_PROVIDER_MAX_CONSENT_TIMEFRAME = getattr(
     settings,
     "OIDCFED_PROVIDER_MAX_CONSENT_TIMEFRAME",
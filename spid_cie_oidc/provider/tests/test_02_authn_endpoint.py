@@ -1,27 +1,41 @@
 from copy import deepcopy
+from unittest.mock import AsyncMock, patch
+
+from asgiref.sync import async_to_sync
 from django.contrib.auth import get_user_model
-from django.test import Client, TestCase, override_settings
+from django.contrib.auth.models import AnonymousUser
+from django.core.cache import cache
+from django.test import Client, RequestFactory, TestCase, override_settings
 from django.urls import reverse
 from spid_cie_oidc.authority.tests.settings import RP_METADATA, RP_METADATA_JWK1, rp_onboarding_data
 from django.utils import timezone
 
+from spid_cie_oidc.entity.exceptions import InvalidTrustchain
 from spid_cie_oidc.entity.jwtse import create_jws, unpad_jwt_payload, verify_jws
 from spid_cie_oidc.entity.models import (
     FederationEntityConfiguration,
     FetchedEntityStatement,
     TrustChain,
 )
+from spid_cie_oidc.entity.tests import QueryBudgetTestMixin
 from spid_cie_oidc.entity.tests.settings import TA_SUB
 from spid_cie_oidc.entity.utils import datetime_from_timestamp, exp_from_now, iat_now
 from spid_cie_oidc.entity.utils import get_jwks
+from spid_cie_oidc.provider.exceptions import AuthzRequestReplay
 from spid_cie_oidc.provider.models import IssuedToken, OidcSession
 from spid_cie_oidc.provider.tests.settings import op_conf, op_conf_priv_jwk
+from spid_cie_oidc.provider.views.authz_request_view import (
+    AsyncAuthzRequestView,
+    AuthzRequestView,
+)
 from spid_cie_oidc.relying_party.utils import random_string
 
 RP_SUB = rp_onboarding_data["sub"]
 
-class AuthnRequestTest(TestCase):
+class AuthnRequestTest(QueryBudgetTestMixin, TestCase):
     def setUp(self):
+        # jti and nonce of the fixtures are the same in each test
+        cache.clear()
 
         self.REQUEST_OBJECT_PAYLOAD = {
             "client_id": RP_SUB,
@@ -78,6 +92,56 @@ class AuthnRequestTest(TestCase):
             is_active=True,
         )
 
+    def _async_auth_request(self, jws):
+        request = RequestFactory().get(
+            reverse("oidc_provider_authnrequest"), {"request": jws}
+        )
+        request.user = AnonymousUser()
+        return async_to_sync(AsyncAuthzRequestView.as_view())(request)
+
+    @override_settings(OIDCFED_TRUST_ANCHORS=[TA_SUB])
+    def test_async_auth_request(self):
+        jws = create_jws(self.REQUEST_OBJECT_PAYLOAD, RP_METADATA_JWK1)
+        with patch(
+            "spid_cie_oidc.provider.views.aget_or_create_trust_chain"
+        ) as discovery:
+            res = self._async_auth_request(jws)
+        self.assertEqual(res.status_code, 200)
+        self.assertIn("username", res.content.decode())
+        # the trust chain in the DB is valid
+        discovery.assert_not_called()
+
+    @override_settings(OIDCFED_TRUST_ANCHORS=[TA_SUB])
+    def test_async_auth_request_discovery(self):
+        jws = create_jws(self.REQUEST_OBJECT_PAYLOAD, RP_METADATA_JWK1)
+        TrustChain.objects.all().delete()
+        with patch(
+            "spid_cie_oidc.provider.views.aget_or_create_trust_chain",
+            AsyncMock(return_value=self.trust_chain)
+        ) as discovery, patch(
+            "spid_cie_oidc.provider.views.get_or_create_trust_chain"
+        ) as sync_discovery:
+            res = self._async_auth_request(jws)
+        self.assertEqual(res.status_code, 200)
+        discovery.assert_awaited_once()
+        sync_discovery.assert_not_called()
+
+    @override_settings(OIDCFED_TRUST_ANCHORS=[TA_SUB])
+    def test_async_auth_request_discovery_failed(self):
+        jws = create_jws(self.REQUEST_OBJECT_PAYLOAD, RP_METADATA_JWK1)
+        TrustChain.objects.all().delete()
+        with patch(
+            "spid_cie_oidc.provider.views.aget_or_create_trust_chain",
+            AsyncMock(side_effect=InvalidTrustchain("not valid"))
+        ), patch(
+            "spid_cie_oidc.provider.views.get_or_create_trust_chain"
+        ) as sync_discovery:
+            res = self._async_auth_request(jws)
+        self.assertEqual(res.status_code, 302)
+        self.assertIn("error=invalid_request", res.url)
+        # not retried in the sync thread
+        sync_discovery.assert_not_called()
+
     @override_settings(OIDCFED_TRUST_ANCHORS=[TA_SUB])
     def test_auth_request_unknown_error(self):
         jws = create_jws(self.REQUEST_OBJECT_PAYLOAD, RP_METADATA_JWK1)
@@ -114,6 +178,27 @@ class AuthnRequestTest(TestCase):
         self.assertEqual(id_token.get("family_name"), "rossi")
         self.assertEqual(id_token.get("email"), "test@test.it")
 
+    @override_settings(OIDCFED_TRUST_ANCHORS=[TA_SUB])
+    def test_auth_request_query_budget(self):
+        jws = create_jws(self.REQUEST_OBJECT_PAYLOAD, RP_METADATA_JWK1)
+        client = Client()
+        url = reverse("oidc_provider_authnrequest")
+        with self.assertQueryBudget("oidc_provider_authnrequest"):
+            res = client.get(url, {"request": jws})
+        self.assertEqual(res.status_code, 200)
+        with self.assertQueryBudget("oidc_provider_authnrequest"):
+            res = client.post(
+                url, {"username": "test", "password": "test", "authz_request_object": jws}
+            )
+        self.assertEqual(res.status_code, 302)
+        consent_page_url = res.url
+        with self.assertQueryBudget("oidc_provider_consent"):
+            res = client.get(consent_page_url)
+        self.assertEqual(res.status_code, 200)
+        with self.assertQueryBudget("oidc_provider_consent"):
+            res = client.post(consent_page_url, {"agree": True})
+        self.assertEqual(res.status_code, 302)
+        self.assertIn("code=", res.url)
 
     @override_settings(OIDCFED_TRUST_ANCHORS=[TA_SUB])
     def test_auth_no_request(self):
@@ -246,6 +331,11 @@ class AuthnRequestTest(TestCase):
             url, {"username": "notest", "password": "test", "authz_request_object": jws}
         )
         self.assertIn("error", res.content.decode())
+        # the request object is not consumed by a failed login
+        res = client.post(
+            url, {"username": "test", "password": "test", "authz_request_object": jws}
+        )
+        self.assertEqual(res.status_code, 302)
 
     @override_settings(OIDCFED_TRUST_ANCHORS=[TA_SUB])
     def test_auth_request_preexistent_authz(self):
@@ -264,6 +354,27 @@ class AuthnRequestTest(TestCase):
         self.assertIn("error=invalid_request", res.url)
         self.assertIn("state", res.url)
 
+        # detected by the replay cache, without the stored sessions
+        OidcSession.objects.all().delete()
+        with self.assertNumQueries(0):
+            with self.assertRaises(AuthzRequestReplay):
+                view = AuthzRequestView()
+                view.payload = unpad_jwt_payload(jws)
+                view.is_a_replay_authz()
+        res = client.post(
+            url, {"username": "test", "password": "test", "authz_request_object": jws}
+        )
+        self.assertEqual(res.status_code, 403)
+        # a concurrent replay, validated before the request object is consumed,
+        # does not log the user in
+        client = Client()
+        with patch.object(AuthzRequestView, "is_a_replay_authz"):
+            res = client.post(
+                url, {"username": "test", "password": "test", "authz_request_object": jws}
+            )
+        self.assertEqual(res.status_code, 403)
+        self.assertNotIn("_auth_user_id", client.session)
+
     @override_settings(OIDCFED_TRUST_ANCHORS=[TA_SUB])
     def test_auth_request_trust_chain_no_active(self):
         self.trust_chain.is_active = False
@@ -1,6 +1,7 @@
 from copy import deepcopy
 import time
 from cryptojwt.jws.utils import left_hash
+from django.core.cache import cache
 from django.test import Client, TestCase, override_settings
 from django.urls import reverse
 from django.utils import timezone
@@ -29,9 +30,12 @@ RP_SUB = rp_conf["sub"]
 RP_CLIENT_ID = rp_conf["metadata"]["openid_relying_party"]["client_id"]
 
 
+@override_settings(OIDCFED_TRUST_ANCHORS=[TA_SUB])
 class RefreshTokenTest(TestCase):
 
     def setUp(self):
+        # jti and nonce of the fixtures are the same in each test
+        cache.clear()
         self.op_local_conf = deepcopy(op_conf)
         FederationEntityConfiguration.objects.create(**self.op_local_conf)
         self.ta_fes = FetchedEntityStatement.objects.create(
@@ -59,6 +63,8 @@ class RefreshTokenTest(TestCase):
             "jti": "jti",
         }
         self.ca_jws = create_jws(CLIENT_ASSERTION, RP_METADATA_JWK1)
+        # a client assertion can be used only once
+        self.ca_jws_2 = create_jws(dict(CLIENT_ASSERTION, jti="jti-2"), RP_METADATA_JWK1)
         refresh_token = {
             "iss": self.op_local_conf["sub"],
             "sub": RP_SUB,
@@ -158,7 +164,7 @@ class RefreshTokenTest(TestCase):
             self.assertTrue(res.status_code == 200)
             request = dict(
                 client_id=RP_CLIENT_ID,
-                client_assertion=self.ca_jws,
+                client_assertion=self.ca_jws_2,
                 client_assertion_type="urn:ietf:params:oauth:client-assertion-type:jwt-bearer",
                 refresh_token=res.json()["refresh_token"],
                 grant_type="refresh_token"
@@ -181,7 +187,7 @@ class RefreshTokenTest(TestCase):
         self.assertTrue(res.status_code == 200)
         request = dict(
             client_id=RP_CLIENT_ID,
-            client_assertion=self.ca_jws,
+            client_assertion=self.ca_jws_2,
             client_assertion_type="urn:ietf:params:oauth:client-assertion-type:jwt-bearer",
             refresh_token=res.json()["refresh_token"],
             grant_type="refresh_token"
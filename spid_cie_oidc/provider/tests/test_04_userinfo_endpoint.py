@@ -9,10 +9,12 @@ from spid_cie_oidc.authority.tests.settings import (
 )
 from spid_cie_oidc.entity.jwtse import create_jws
 from spid_cie_oidc.entity.models import (
+    _TRUST_CHAIN_SNAPSHOTS,
     FederationEntityConfiguration,
     FetchedEntityStatement, 
     TrustChain
 )
+from spid_cie_oidc.entity.tests import QueryBudgetTestMixin
 from spid_cie_oidc.entity.tests.settings import TA_SUB
 from spid_cie_oidc.entity.utils import (
     datetime_from_timestamp,
@@ -23,9 +25,11 @@ from spid_cie_oidc.provider.models import IssuedToken, OidcSession
 from spid_cie_oidc.provider.tests.settings import op_conf, op_conf_priv_jwk
 
 
-class UserInfoEndpointTest(TestCase):
+class UserInfoEndpointTest(QueryBudgetTestMixin, TestCase):
 
     def setUp(self):
+        # the trust chains of the previous tests are rolled back without post_delete
+        _TRUST_CHAIN_SNAPSHOTS.clear()
         self.RP_SUB = rp_onboarding_data["sub"]
         self.op_local_conf = deepcopy(op_conf)
         FederationEntityConfiguration.objects.create(**self.op_local_conf)
@@ -106,6 +110,7 @@ class UserInfoEndpointTest(TestCase):
         )
         client = Client()
         url = reverse("oidc_provider_userinfo_endpoint")
-        res = client.get(url, data  = {}, **headers)
+        with self.assertQueryBudget("oidc_provider_userinfo_endpoint"):
+            res = client.get(url, data  = {}, **headers)
         self.assertTrue(res.status_code == 200)
 
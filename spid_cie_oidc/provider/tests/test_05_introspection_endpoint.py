@@ -1,6 +1,7 @@
 from copy import deepcopy
 
-from django.test import Client, TestCase
+from django.core.cache import cache
+from django.test import Client, TestCase, override_settings
 from django.urls import reverse
 from spid_cie_oidc.accounts.models import User
 from spid_cie_oidc.authority.tests.settings import (
@@ -13,6 +14,7 @@ from spid_cie_oidc.entity.models import (
     FetchedEntityStatement, 
     TrustChain
 )
+from spid_cie_oidc.entity.tests import QueryBudgetTestMixin
 from spid_cie_oidc.entity.tests.settings import TA_SUB
 from spid_cie_oidc.entity.utils import (
     datetime_from_timestamp, 
@@ -26,9 +28,12 @@ from spid_cie_oidc.provider.tests.settings import (
 )
 
 
-class IntrospectionEndpointTest(TestCase):
+@override_settings(OIDCFED_TRUST_ANCHORS=[TA_SUB])
+class IntrospectionEndpointTest(QueryBudgetTestMixin, TestCase):
 
     def setUp(self):
+        # jti and nonce of the fixtures are the same in each test
+        cache.clear()
         self.RP_SUB = rp_conf["sub"]
         self.RP_CLIENT_ID = rp_conf["metadata"]["openid_relying_party"]["client_id"]
         self.jwt_auds = [op_conf["sub"], "http://testserver/oidc/op/", "http://testserver/oidc/op/introspection"]
@@ -93,7 +98,8 @@ class IntrospectionEndpointTest(TestCase):
 
         }
         
-        res = client.post(url, request)
+        with self.assertQueryBudget("oidc_provider_introspection_endpoint"):
+            res = client.post(url, request)
         self.assertTrue(res.status_code == 200)
         self.assertTrue("openid" in res.content.decode())
 
@@ -1,6 +1,8 @@
 from copy import deepcopy
+from unittest.mock import patch
 
-from django.test import Client, TestCase
+from django.core.cache import cache, caches
+from django.test import Client, TestCase, override_settings
 from django.urls import reverse
 from django.utils import timezone
 from spid_cie_oidc.accounts.models import User
@@ -9,12 +11,14 @@ from spid_cie_oidc.authority.tests.settings import (
     RP_METADATA_JWK1,
     rp_conf
 )
-from spid_cie_oidc.entity.jwtse import create_jws
+from spid_cie_oidc.entity.jwtse import create_jws, unpad_jwt_payload
 from spid_cie_oidc.entity.models import (
     FederationEntityConfiguration,
     FetchedEntityStatement, 
-    TrustChain
+    TrustChain,
+    TrustChainSnapshot
 )
+from spid_cie_oidc.entity.tests import QueryBudgetTestMixin
 from spid_cie_oidc.entity.tests.settings import TA_SUB
 from spid_cie_oidc.entity.utils import (
     datetime_from_timestamp, 
@@ -22,6 +26,7 @@ from spid_cie_oidc.entity.utils import (
     iat_now
 )
 from spid_cie_oidc.provider.models import IssuedToken, OidcSession
+from spid_cie_oidc.provider.settings import OIDCFED_PROVIDER_TOKEN_CACHE
 from spid_cie_oidc.provider.tests.settings import op_conf, op_conf_priv_jwk
 from spid_cie_oidc.relying_party.utils import get_pkce
 
@@ -30,9 +35,12 @@ RP_SUB = rp_conf["sub"]
 RP_CLIENT_ID = rp_conf["metadata"]["openid_relying_party"]["client_id"]
 PKCE = get_pkce()
 
-class RefreshTokenTest(TestCase):
+@override_settings(OIDCFED_TRUST_ANCHORS=[TA_SUB])
+class RefreshTokenTest(QueryBudgetTestMixin, TestCase):
 
-    def setUp(self): 
+    def setUp(self):
+        # jti and nonce of the fixtures are the same in each test
+        cache.clear()
         self.op_local_conf = deepcopy(op_conf)
         FederationEntityConfiguration.objects.create(**self.op_local_conf)
         self.ta_fes = FetchedEntityStatement.objects.create(
@@ -143,3 +151,192 @@ class RefreshTokenTest(TestCase):
         )
         res = client.post(url, request)
         self.assertTrue(res.status_code == 400)
+
+    def get_snapshot(self, **kwargs):
+        return TrustChainSnapshot.get(RP_SUB, "openid_relying_party", **kwargs)
+
+    def post_authorization_code(self):
+        request = dict(
+            client_id = RP_CLIENT_ID,
+            client_assertion = self.ca_jws,
+            client_assertion_type = "urn:ietf:params:oauth:client-assertion-type:jwt-bearer",
+            grant_type="authorization_code",
+            code="code",
+            code_verifier = PKCE["code_verifier"]
+        )
+        return Client().post(reverse("oidc_provider_token_endpoint"), request)
+
+    def test_trust_chain_snapshot(self):
+        snapshot = self.get_snapshot()
+        key = snapshot.get_key("openid_relying_party", RP_METADATA_JWK1["kid"])
+        with self.assertNumQueries(0):
+            self.assertIs(self.get_snapshot(), snapshot)
+            self.assertIs(
+                snapshot.get_key("openid_relying_party", RP_METADATA_JWK1["kid"]), key
+            )
+        with self.assertRaises(KeyError):
+            snapshot.get_key("openid_relying_party", "unknown")
+
+        # after the TTL only its version is checked
+        snapshot.reload_at = 0
+        with self.assertNumQueries(1):
+            self.assertIs(self.get_snapshot(), snapshot)
+        self.assertTrue(snapshot.reload_at)
+
+        # changed by another process
+        TrustChain.objects.filter(pk=self.trust_chain.pk).update(
+            modified=timezone.localtime(), is_active=False
+        )
+        snapshot.reload_at = 0
+        snapshot = self.get_snapshot()
+        self.assertFalse(snapshot.is_active)
+
+        # any change to the trust chain by this process reloads it
+        self.trust_chain.is_active = True
+        self.trust_chain.exp = timezone.localtime()
+        self.trust_chain.save()
+        self.assertIsNot(self.get_snapshot(), snapshot)
+        self.assertTrue(self.get_snapshot().is_expired)
+
+        self.trust_chain.delete()
+        self.assertIsNone(self.get_snapshot())
+
+    def test_token_endpoint_client_assertion_replay(self):
+        client = Client()
+        url = reverse("oidc_provider_token_endpoint")
+        request = dict(
+            client_id = RP_CLIENT_ID,
+            client_assertion = self.ca_jws,
+            client_assertion_type = "urn:ietf:params:oauth:client-assertion-type:jwt-bearer",
+            grant_type="authorization_code",
+            code="code",
+            code_verifier = PKCE["code_verifier"]
+        )
+        with self.assertQueryBudget("oidc_provider_token_endpoint"):
+            res = client.post(url, request)
+        self.assertEqual(res.status_code, 200)
+        res = client.post(url, request)
+        self.assertEqual(res.status_code, 403)
+        self.assertEqual(res.json()["error"], "unauthorized_client")
+
+    def test_token_endpoint_expired_trust_chain(self):
+        self.trust_chain.exp = timezone.localtime() - timezone.timedelta(minutes=1)
+        self.trust_chain.save()
+        res = self.post_authorization_code()
+        self.assertEqual(res.status_code, 403)
+        self.assertEqual(res.json()["error"], "unauthorized_client")
+
+    def test_token_endpoint_trust_chains(self):
+        # a disabled chain doesn't hide the active one of the same client
+        self.trust_chain.is_active = False
+        self.trust_chain.save()
+        other_anchor = "http://other-anchor.example.org"
+        TrustChain.objects.create(
+            sub=RP_SUB,
+            exp=datetime_from_timestamp(exp_from_now(33)),
+            jwks=[],
+            metadata=RP_METADATA,
+            status="valid",
+            trust_anchor=FetchedEntityStatement.objects.create(
+                sub=other_anchor,
+                iss=other_anchor,
+                exp=datetime_from_timestamp(exp_from_now(33)),
+                iat=datetime_from_timestamp(iat_now()),
+            ),
+            is_active=True,
+        )
+        # if issued by one of the configured trust anchors
+        self.assertEqual(self.post_authorization_code().status_code, 403)
+        with override_settings(OIDCFED_TRUST_ANCHORS=[TA_SUB, other_anchor]):
+            self.assertEqual(self.post_authorization_code().status_code, 200)
+
+    def test_token_endpoint_queries(self):
+        IssuedToken.objects.update(expires_in=600)
+        client = Client()
+        url = reverse("oidc_provider_token_endpoint")
+        request = dict(
+            client_id = RP_CLIENT_ID,
+            client_assertion = self.ca_jws,
+            client_assertion_type = "urn:ietf:params:oauth:client-assertion-type:jwt-bearer",
+            grant_type="authorization_code",
+            code="code",
+            code_verifier = PKCE["code_verifier"]
+        )
+        # loads the configuration and the client trust chain
+        FederationEntityConfiguration.get_cached(entity_type="openid_provider")
+        self.get_snapshot(trust_anchors=[TA_SUB], active=True)
+        # the session and the tokens only
+        with self.assertNumQueries(1):
+            res = client.post(url, request)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.json()["expires_in"], 600)
+
+    @patch("spid_cie_oidc.provider.models.OIDCFED_PROVIDER_COMPACT_TOKENS", True)
+    def test_token_endpoint_compact_tokens(self):
+        session = OidcSession.objects.get(auth_code="code")
+        IssuedToken.objects.all().delete()
+        at = create_jws(dict(self.refresh_token, jti="at-jti"), op_conf_priv_jwk, typ="at-jwt")
+        idt = create_jws(self.refresh_token, op_conf_priv_jwk)
+        token = IssuedToken.issue(
+            session=session,
+            access_token=at,
+            id_token=idt,
+            jti="at-jti",
+            expires=timezone.localtime() + timezone.timedelta(minutes=10),
+            expires_in=600
+        )
+        token.refresh_from_db()
+        self.assertIsNone(token.access_token)
+        self.assertIsNone(token.id_token)
+        self.assertEqual(token.jti, "at-jti")
+        self.assertEqual(IssuedToken.get_by_access_token(at).first(), token)
+
+        client = Client()
+        url = reverse("oidc_provider_token_endpoint")
+        request = dict(
+            client_id = RP_CLIENT_ID,
+            client_assertion = self.ca_jws,
+            client_assertion_type = "urn:ietf:params:oauth:client-assertion-type:jwt-bearer",
+            grant_type="authorization_code",
+            code="code",
+            code_verifier = PKCE["code_verifier"]
+        )
+        res = client.post(url, request)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.json()["access_token"], at)
+        self.assertEqual(res.json()["id_token"], idt)
+
+        # the JWTs are given only once
+        request["client_assertion"] = create_jws(
+            dict(unpad_jwt_payload(self.ca_jws), jti="jti-2"), RP_METADATA_JWK1
+        )
+        res = client.post(url, request)
+        self.assertEqual(res.status_code, 400)
+
+    @patch("spid_cie_oidc.provider.models.OIDCFED_PROVIDER_COMPACT_TOKENS", True)
+    def test_compact_tokens_concurrent_pop(self):
+        session = OidcSession.objects.get(auth_code="code")
+        token = IssuedToken.issue(
+            session=session,
+            access_token="at",
+            id_token="idt",
+            expires=timezone.localtime() + timezone.timedelta(minutes=10),
+            expires_in=600
+        )
+        concurrent = IssuedToken.objects.get(pk=token.pk)
+        token_cache = caches[OIDCFED_PROVIDER_TOKEN_CACHE]
+        cache_get = token_cache.get
+        popped = []
+
+        # the concurrent request takes them after the first one has read them
+        def racing_get(*args, **kwargs):
+            jwts = cache_get(*args, **kwargs)
+            if not popped:
+                popped.append(None)
+                popped.append(concurrent.pop_jwts())
+            return jwts
+
+        with patch.object(token_cache, "get", side_effect=racing_get):
+            self.assertEqual(token.pop_jwts(), {})
+        self.assertEqual(popped[1]["access_token"], "at")
+        self.assertEqual(concurrent.pop_jwts(), {})
@@ -1,7 +1,8 @@
 
 from copy import deepcopy
 
-from django.test import Client, TestCase
+from django.core.cache import cache
+from django.test import Client, TestCase, override_settings
 from django.urls import reverse
 from spid_cie_oidc.accounts.models import User
 from spid_cie_oidc.authority.tests.settings import (
@@ -15,6 +16,7 @@ from spid_cie_oidc.entity.models import (
     FetchedEntityStatement, 
     TrustChain
 )
+from spid_cie_oidc.entity.tests import QueryBudgetTestMixin
 from spid_cie_oidc.entity.tests.settings import TA_SUB
 from spid_cie_oidc.entity.utils import (
     datetime_from_timestamp, 
@@ -27,9 +29,12 @@ from spid_cie_oidc.provider.tests.settings import op_conf, op_conf_priv_jwk
 RP_SUB = rp_conf["sub"]
 RP_CLIENT_ID = rp_conf["metadata"]["openid_relying_party"]["client_id"]
 
-class RevocationEndponitTest(TestCase):
+@override_settings(OIDCFED_TRUST_ANCHORS=[TA_SUB])
+class RevocationEndponitTest(QueryBudgetTestMixin, TestCase):
 
-    def setUp(self): 
+    def setUp(self):
+        # jti and nonce of the fixtures are the same in each test
+        cache.clear()
         ta_fes = FetchedEntityStatement.objects.create(
             sub=TA_SUB,
             iss=TA_SUB,
@@ -91,7 +96,8 @@ class RevocationEndponitTest(TestCase):
     def test_revocation_endpoint(self):
         client = Client()
         url = reverse("oidc_provider_end_session_endpoint")
-        res = client.post(url, self.request)
+        with self.assertQueryBudget("oidc_provider_end_session_endpoint"):
+            res = client.post(url, self.request)
         self.assertTrue(res.status_code == 200)
 
     def test_revocation_endpoint_no_correct_client_assert(self):
@@ -1,7 +1,8 @@
 from django.conf import settings
 from django.urls import path
 
-from .views.authz_request_view import AuthzRequestView
+from spid_cie_oidc.entity.settings import OIDCFED_ASYNC_VIEWS
+from .views.authz_request_view import AsyncAuthzRequestView, AuthzRequestView
 from .views.userinfo_endpoint import UserInfoEndpoint
 from spid_cie_oidc.entity.views import (
     openid_connect_jwks_uri,
@@ -23,7 +24,9 @@ _PREF = getattr(settings, "OIDC_PREFIX", "oidc/op")
 urlpatterns = [
     path(
         f"{_PREF}/authorization",
-        AuthzRequestView.as_view(),
+        (
+            AsyncAuthzRequestView if OIDCFED_ASYNC_VIEWS else AuthzRequestView
+        ).as_view(),
         name="oidc_provider_authnrequest",
     ),
     path(
@@ -1,23 +1,40 @@
+import hashlib
 import logging
 import uuid
 from cryptojwt.jws.utils import left_hash
 from django.conf import settings
+from django.core.cache import caches
 from pydantic import ValidationError
 from django.http import HttpResponseRedirect
 from django.urls import reverse
 from django.utils import timezone
 import urllib
-from spid_cie_oidc.entity.jwtse import create_jws, unpad_jwt_head, unpad_jwt_payload, verify_jws
-from spid_cie_oidc.entity.models import FederationEntityConfiguration, TrustChain
+from typing import Union
+from spid_cie_oidc.entity.jwtse import (
+    get_jws_signer,
+    unpad_jwt_head,
+    unpad_jwt_payload,
+    verify_jws,
+    verify_jws_with_key
+)
+from spid_cie_oidc.entity.metrics import REPLAY_REJECTIONS
+from spid_cie_oidc.entity.models import (
+    FederationEntityConfiguration,
+    TrustChain,
+    TrustChainSnapshot
+)
 from spid_cie_oidc.entity.settings import HTTPC_PARAMS
-from spid_cie_oidc.entity.trust_chain_operations import get_or_create_trust_chain
+from spid_cie_oidc.entity.trust_chain_operations import (
+    aget_or_create_trust_chain,
+    get_or_create_trust_chain,
+)
 from spid_cie_oidc.entity.utils import datetime_from_timestamp, exp_from_now, iat_now
-from spid_cie_oidc.entity.utils import get_jwks
 from spid_cie_oidc.entity.exceptions import TrustchainMissingMetadata
 from spid_cie_oidc.provider.exceptions import (
     AuthzRequestReplay,
     ExpiredAuthCode,
     InvalidSession,
+    JwtReplay,
     RevokedSession,
     ValidationException
 )
@@ -30,7 +47,8 @@ from spid_cie_oidc.provider.settings import (
     OIDCFED_PROVIDER_AUTH_CODE_MAX_AGE,
     OIDCFED_PROVIDER_PROFILES,
     OIDCFED_PROVIDER_PROFILES_ACR_4_REFRESH,
-    OIDCFED_PROVIDER_PROFILES_ID_TOKEN_CLAIMS
+    OIDCFED_PROVIDER_PROFILES_ID_TOKEN_CLAIMS,
+    OIDCFED_PROVIDER_REPLAY_CACHE
 )
 
 logger = logging.getLogger(__name__)
@@ -55,7 +73,7 @@ class OpBase:
             if valid_jwk and header["kid"] == valid_jwk:
                 return jwk
 
-    def validate_authz_request_object(self, req) -> TrustChain:
+    def validate_authz_request_object(self, req) -> TrustChainSnapshot:
         state = getattr(self, 'payload', {}).get("state", "")
         try:
             self.payload = unpad_jwt_payload(req)
@@ -70,11 +88,9 @@ class OpBase:
             raise Exception(_msg)
 
         self.is_a_replay_authz()
-        rp_trust_chain = TrustChain.objects.filter(
-            metadata__openid_relying_party__isnull=False,
-            sub=self.payload["iss"],
-            trust_anchor__sub__in=settings.OIDCFED_TRUST_ANCHORS
-        ).first()
+        rp_trust_chain = self.get_rp_trust_chain(
+            self.payload["iss"], trust_anchors=settings.OIDCFED_TRUST_ANCHORS
+        )
         if rp_trust_chain and not rp_trust_chain.is_active:
             _msg = (
                 f"Disabled client {rp_trust_chain.sub} requests an authorization. "
@@ -85,25 +101,7 @@ class OpBase:
             raise Exception(_msg)
 
         elif not rp_trust_chain or rp_trust_chain.is_expired:
-            rp_trust_chain = None
-            # TODO: get async here
-            for ta in settings.OIDCFED_TRUST_ANCHORS:
-                try:
-                    rp_trust_chain = get_or_create_trust_chain(
-                        subject=self.payload["iss"],
-                        trust_anchor=ta,
-                        httpc_params=HTTPC_PARAMS,
-                        required_trust_marks=getattr(
-                            settings, "OIDCFED_REQUIRED_TRUST_MARKS", []
-                        ),
-                    )
-                    if rp_trust_chain and rp_trust_chain.metadata:
-                        break
-                except TrustchainMissingMetadata as e:
-                    logger.debug(f"TrustchainMissingMetadata: {e}")
-                    # unless we find the good TA
-                    continue
-
+            rp_trust_chain = self.discover_rp_trust_chain(self.payload["iss"])
             if not rp_trust_chain or not rp_trust_chain.is_valid:
                 _msg = (
                     f"Failed trust chain validation for {self.payload['iss']}. "
@@ -113,10 +111,10 @@ class OpBase:
                 logger.warning(_msg)
                 raise Exception(_msg)
 
-        jwks = get_jwks(
-            rp_trust_chain.metadata['openid_relying_party'],
-            federation_jwks=rp_trust_chain.jwks
-        )
+        if isinstance(rp_trust_chain, TrustChain):
+            # just discovered
+            rp_trust_chain = TrustChainSnapshot(rp_trust_chain)
+        jwks = rp_trust_chain.get_jwks("openid_relying_party")
         jwk = self.find_jwk(header, jwks)
         if not jwk:
             _msg = (
@@ -141,12 +139,113 @@ class OpBase:
 
         return rp_trust_chain
 
+    def get_rp_trust_chain(
+        self, subject: str, trust_anchors: list = (), active: bool = False
+    ) -> Union[TrustChainSnapshot, None]:
+        """
+        the cached snapshot of the trust chain of a RP,
+        the one of the authorization or of any trust anchor if not given
+        """
+        return TrustChainSnapshot.get(
+            subject, "openid_relying_party", trust_anchors=trust_anchors, active=active
+        )
+
+    def get_rp_trust_chains(self, subject: str):
+        return TrustChain.objects.filter(
+            metadata__openid_relying_party__isnull=False,
+            sub=subject,
+            trust_anchor__sub__in=settings.OIDCFED_TRUST_ANCHORS
+        )
+
+    def discover_rp_trust_chain(self, subject: str) -> TrustChain:
+        """
+        builds the trust chain of a RP with the first trust anchor
+        that gives its metadata
+        """
+        rp_trust_chain = None
+        for ta in settings.OIDCFED_TRUST_ANCHORS:
+            try:
+                rp_trust_chain = get_or_create_trust_chain(
+                    subject=subject,
+                    trust_anchor=ta,
+                    httpc_params=HTTPC_PARAMS,
+                    required_trust_marks=getattr(
+                        settings, "OIDCFED_REQUIRED_TRUST_MARKS", []
+                    ),
+                )
+                if rp_trust_chain and rp_trust_chain.metadata:
+                    break
+            except TrustchainMissingMetadata as e:
+                logger.debug(f"TrustchainMissingMetadata: {e}")
+                # unless we find the good TA
+                continue
+        return rp_trust_chain
+
+    async def adiscover_rp_trust_chain(self, subject: str) -> TrustChain:
+        """
+        as discover_rp_trust_chain, with aget_or_create_trust_chain
+        """
+        rp_trust_chain = None
+        for ta in settings.OIDCFED_TRUST_ANCHORS:
+            try:
+                rp_trust_chain = await aget_or_create_trust_chain(
+                    subject=subject,
+                    trust_anchor=ta,
+                    httpc_params=HTTPC_PARAMS,
+                    required_trust_marks=getattr(
+                        settings, "OIDCFED_REQUIRED_TRUST_MARKS", []
+                    ),
+                )
+                if rp_trust_chain and rp_trust_chain.metadata:
+                    break
+            except TrustchainMissingMetadata as e:
+                logger.debug(f"TrustchainMissingMetadata: {e}")
+                # unless we find the good TA
+                continue
+        return rp_trust_chain
+
+    def get_replay_cache_key(self, jwt_type: str, payload: dict) -> str:
+        # the jti of a request object is optional, its nonce is not
+        _id = payload.get("jti", None) or payload.get("nonce", "")
+        _key = "|".join((jwt_type, payload.get("iss", ""), str(_id)))
+        return f"oidcfed-replay-{hashlib.sha256(_key.encode()).hexdigest()}"
+
+    def is_a_replay_jwt(self, jwt_type: str, payload: dict) -> bool:
+        return bool(
+            caches[OIDCFED_PROVIDER_REPLAY_CACHE].get(
+                self.get_replay_cache_key(jwt_type, payload)
+            )
+        )
+
+    def register_jwt(self, jwt_type: str, payload: dict) -> None:
+        """
+        keeps the identifier of a verified jwt until its expiration,
+        raises JwtReplay if it was already there
+        """
+        timeout = payload.get("exp", 0) - iat_now()
+        if timeout <= 0:
+            timeout = OIDCFED_PROVIDER_AUTH_CODE_MAX_AGE * 60
+        if not caches[OIDCFED_PROVIDER_REPLAY_CACHE].add(
+            self.get_replay_cache_key(jwt_type, payload), 1, timeout
+        ):
+            REPLAY_REJECTIONS.inc(kind=jwt_type)
+            raise JwtReplay(
+                f"{jwt_type} {payload.get('jti', payload.get('nonce'))} "
+                f"from {payload.get('iss')} already used"
+            )
+
     def is_a_replay_authz(self):
+        if self.is_a_replay_jwt("request_object", self.payload):
+            REPLAY_REJECTIONS.inc(kind="authz_request")
+            raise AuthzRequestReplay(
+                f"{self.payload['client_id']} with {self.payload['nonce']}"
+            )
         preexistent_authz = OidcSession.objects.filter(
             client_id=self.payload["client_id"],
             nonce=self.payload["nonce"]
         ).first()
         if preexistent_authz:
+            REPLAY_REJECTIONS.inc(kind="authz_request")
             raise AuthzRequestReplay(
                 f"{preexistent_authz.client_id} with {preexistent_authz.nonce}"
             )
@@ -188,9 +287,9 @@ class OpBase:
         return session
 
     def get_issuer(self):
-        return FederationEntityConfiguration.objects.filter(
+        return FederationEntityConfiguration.get_cached(
             entity_type="openid_provider"
-        ).first()
+        )
 
     def check_client_assertion(self, client_id: str, client_assertion: str) -> bool:
         head = unpad_jwt_head(client_assertion)
@@ -228,9 +327,20 @@ class OpBase:
             # TODO Specialize exceptions
             raise Exception("Client Assertion: fake audience")
 
-        tc = TrustChain.objects.get(sub=client_id, is_active=True)
-        jwk = self.find_jwk(head, tc.metadata['openid_relying_party']['jwks']['keys'])
-        verify_jws(client_assertion, jwk)
+        rp_trust_chain = self.get_rp_trust_chain(
+            client_id, trust_anchors=settings.OIDCFED_TRUST_ANCHORS, active=True
+        )
+        if not rp_trust_chain:
+            raise Exception(f"Client Assertion: no active trust chain for {client_id}")
+        elif rp_trust_chain.is_expired:
+            raise Exception(f"Client Assertion: expired trust chain for {client_id}")
+        try:
+            key = rp_trust_chain.get_key("openid_relying_party", head.get("kid"))
+        except KeyError as e:
+            raise Exception(f"Client Assertion: {e}")
+        verify_jws_with_key(client_assertion, key)
+        if payload.get("jti", None):
+            self.register_jwt("client_assertion", payload)
         return True
 
     def validate_json_schema(self, payload, schema_type, error_description):
@@ -344,22 +454,34 @@ class OpBase:
         commons = self.get_jwt_common_data()
         jwk = issuer.jwks_core[0]
 
+        signer = get_jws_signer()
+
         access_token = self.get_access_token(iss_sub, _sub, session, commons)
-        jwt_at = create_jws(access_token, jwk, typ="at+jwt")
-        id_token = self.get_id_token(iss_sub, _sub, session, jwt_at, commons)
-        jwt_id = create_jws(id_token, jwk)
+        jwt_at = signer.sign(access_token, jwk, typ="at+jwt")
+
+        # id token and refresh token both depend on the access token hash
+        # then they can be signed together
+        sign_requests = [
+            dict(
+                payload=self.get_id_token(iss_sub, _sub, session, jwt_at, commons),
+                jwk_dict=jwk
+            )
+        ]
+        _refresh_token = self.get_refresh_token(iss_sub, _sub, session, jwt_at, commons)
+        if _refresh_token:
+            sign_requests.append(dict(payload=_refresh_token, jwk_dict=jwk))
+        jwts = signer.sign_many(sign_requests)
 
         iss_token_data = dict(
             session=session,
             access_token=jwt_at,
-            id_token=jwt_id,
-            expires=datetime_from_timestamp(commons["exp"])
+            id_token=jwts[0],
+            jti=access_token["jti"],
+            expires=datetime_from_timestamp(commons["exp"]),
+            expires_in=self.get_expires_in(commons["iat"], commons["exp"])
         )
-
-        _refresh_token = self.get_refresh_token(iss_sub, _sub, session, jwt_at, commons)
         if _refresh_token:
-            jwt_rt = create_jws(_refresh_token, jwk)
-            iss_token_data["refresh_token"] = jwt_rt
+            iss_token_data["refresh_token"] = jwts[1]
         return iss_token_data
 
     def get_expires_in(self, iat: int, exp: int):
@@ -4,6 +4,7 @@ import urllib.parse
 import uuid
 import json
 
+from asgiref.sync import sync_to_async
 from djagger.decorators import schema
 from django.conf import settings
 from django.contrib.auth import authenticate, login, logout
@@ -18,10 +19,17 @@ from django.urls import reverse
 from django.utils.translation import gettext as _
 from django.views import View
 from spid_cie_oidc.entity.exceptions import InvalidEntityConfiguration
+from spid_cie_oidc.entity.jwtse import unpad_jwt_payload
+from spid_cie_oidc.entity.models import TrustChain
 from spid_cie_oidc.provider.schemas.authn_requests import AcrValues
 from spid_cie_oidc.provider.forms import AuthLoginForm, AuthzHiddenForm
 from spid_cie_oidc.provider.models import OidcSession
-from spid_cie_oidc.provider.exceptions import AuthzRequestReplay, InvalidRefreshRequestException, ValidationException
+from spid_cie_oidc.provider.exceptions import (
+    AuthzRequestReplay,
+    InvalidRefreshRequestException,
+    JwtReplay,
+    ValidationException
+)
 from spid_cie_oidc.provider.settings import (
     OIDCFED_DEFAULT_PROVIDER_PROFILE,
     OIDCFED_PROVIDER_PROFILES,
@@ -185,7 +193,8 @@ class AuthzRequestView(OpBase, View):
                     session = self.check_session(request)
                     if session.acr != AcrValues.l1.value:
                         logout(request)
-                        return self.get(request)
+                        # the sync one, also when called by AsyncAuthzRequestView
+                        return AuthzRequestView.get(self, request)
                     else:
                         url = self.get_url_consent(request.user)
                         return HttpResponseRedirect(url)
@@ -194,7 +203,7 @@ class AuthzRequestView(OpBase, View):
                         f"Failed SSO check session for {request.user}"
                     )
                     logout(request)
-                    return self.get(request)
+                    return AuthzRequestView.get(self, request)
 
         # stores the authz request in a hidden field in the form
         form = self.get_login_form()()
@@ -256,8 +265,16 @@ class AuthzRequestView(OpBase, View):
                     "state": self.payload["state"]
                 }
             )
-        else:
-            login(request, user)
+
+        try:
+            # the request object is consumed here, only once,
+            # before a replay could open a session of the user
+            self.register_jwt("request_object", self.payload)
+        except JwtReplay as e:
+            logger.warning(f"Authz request replay: {e}")
+            return HttpResponseForbidden()
+
+        login(request, user)
 
         # create auth_code
         auth_code = hashlib.sha512(
@@ -297,3 +314,54 @@ class AuthzRequestView(OpBase, View):
         session.set_sid(request)
         url = self.get_url_consent(user)
         return HttpResponseRedirect(url)
+
+
+class AsyncAuthzRequestView(AuthzRequestView):
+    """
+        As AuthzRequestView, for the ASGI deployments.
+        The trust chain of an unknown RP is built before the validation
+        of its request, without holding a thread while its statements are fetched
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        # {subject: TrustChain or the exception raised by its discovery}
+        self.discovered_trust_chains = {}
+
+    async def prefetch_rp_trust_chain(self, req: str) -> None:
+        try:
+            subject = unpad_jwt_payload(req)["iss"]
+        except Exception:
+            # rejected then by validate_authz_request_object
+            return
+
+        rp_trust_chain = await self.get_rp_trust_chains(subject).afirst()
+        if rp_trust_chain and (
+            not rp_trust_chain.is_active or not rp_trust_chain.is_expired
+        ):
+            return
+
+        try:
+            self.discovered_trust_chains[subject] = (
+                await self.adiscover_rp_trust_chain(subject)
+            )
+        except Exception as e:
+            self.discovered_trust_chains[subject] = e
+
+    def discover_rp_trust_chain(self, subject: str) -> TrustChain:
+        if subject not in self.discovered_trust_chains:
+            return super().discover_rp_trust_chain(subject)
+
+        rp_trust_chain = self.discovered_trust_chains[subject]
+        if isinstance(rp_trust_chain, Exception):
+            raise rp_trust_chain
+        return rp_trust_chain
+
+    async def get(self, request, *args, **kwargs):
+        req = request.GET.get("request", None)
+        if req:
+            await self.prefetch_rp_trust_chain(req)
+        return await sync_to_async(super().get)(request, *args, **kwargs)
+
+    async def post(self, request, *args, **kwargs):
+        return await sync_to_async(super().post)(request, *args, **kwargs)
@@ -12,9 +12,7 @@ from django.http import (
 from django.shortcuts import redirect, render
 from django.utils.translation import gettext as _
 from django.views import View
-from spid_cie_oidc.entity.models import (
-    TrustChain
-)
+from spid_cie_oidc.entity.metrics import TOKENS_ISSUED
 from spid_cie_oidc.provider.forms import ConsentPageForm
 from spid_cie_oidc.provider.models import IssuedToken, OidcSession
 from spid_cie_oidc.provider.settings import OIDCFED_PROVIDER_HISTORY_PER_PAGE
@@ -38,11 +36,7 @@ class ConsentPageView(OpBase, View):
             logger.warning("Invalid session on Consent page")
             return HttpResponseForbidden()
 
-        tc = TrustChain.objects.filter(
-            sub=session.client_id,
-            metadata__openid_relying_party__isnull=False,
-            is_active = True
-        ).first()
+        tc = self.get_rp_trust_chain(session.client_id)
 
         # if this auth code was already been used ... forbidden
         if IssuedToken.objects.filter(session=session):
@@ -83,7 +77,8 @@ class ConsentPageView(OpBase, View):
         issuer = self.get_issuer()
 
         iss_token_data = self.get_iss_token_data(session, issuer)
-        IssuedToken.objects.create(**iss_token_data)
+        IssuedToken.issue(**iss_token_data)
+        TOKENS_ISSUED.inc(grant_type="authorization_code")
 
         return self.redirect_response_data(
             self.payload["redirect_uri"],
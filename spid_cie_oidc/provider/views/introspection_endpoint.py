@@ -69,9 +69,7 @@ class IntrospectionEndpoint(OpBase, View):
 
         required_token = request.POST['token']
         # query con client_id, access token
-        token = IssuedToken.objects.filter(
-            access_token=required_token
-        ).first()
+        token = IssuedToken.get_by_access_token(required_token).first()
         session = token.session
         if session.client_id != client_id:
             return JsonResponse( # pragma: no cover
@@ -77,8 +77,7 @@ class RevocationEndpoint(OpBase, View):
                 status = 400
             )
 
-        token = IssuedToken.objects.filter(
-            access_token = access_token,
+        token = IssuedToken.get_by_access_token(access_token).filter(
             revoked = False
         ).first()
 
@@ -15,8 +15,9 @@ from django.views import View
 from django.views.decorators.csrf import csrf_exempt
 from pydantic import BaseModel
 from spid_cie_oidc.entity.jwtse import unpad_jwt_payload
+from spid_cie_oidc.entity.metrics import TOKENS_ISSUED
 from spid_cie_oidc.provider.exceptions import ValidationException
-from spid_cie_oidc.provider.models import IssuedToken, OidcSession
+from spid_cie_oidc.provider.models import IssuedToken
 from spid_cie_oidc.provider.settings import (
     OIDCFED_DEFAULT_PROVIDER_PROFILE,
     OIDCFED_PROVIDER_PROFILES,
@@ -77,24 +78,31 @@ class TokenEndpoint(OpBase, View):
             return HttpResponseForbidden()
         #
 
-        issued_token = IssuedToken.objects.filter(
-            session=self.authz,
-            revoked=False
-        ).first()
+        issued_token = self.issued_token
+        jwts = issued_token.pop_jwts()
+        if not jwts:
+            logger.warning(
+                f"Issued tokens of {self.authz} already redeemed or expired"
+            )
+            return HttpResponseBadRequest()
 
-        jwk_at = unpad_jwt_payload(issued_token.access_token)
-        expires_in = self.get_expires_in(jwk_at['iat'], jwk_at['exp'])
+        if issued_token.expires_in is not None:
+            expires_in = issued_token.expires_in
+        else:
+            # issued before expires_in was stored
+            jwk_at = unpad_jwt_payload(jwts["access_token"])
+            expires_in = self.get_expires_in(jwk_at['iat'], jwk_at['exp'])
 
         iss_token_data = dict(  # nosec B106
-            access_token=issued_token.access_token,
-            id_token=issued_token.id_token,
+            access_token=jwts["access_token"],
+            id_token=jwts["id_token"],
             token_type="Bearer",  # nosec B106
             expires_in=expires_in,
             # TODO: remove unsupported scope
             scope=self.authz.authz_request["scope"],
         )
-        if issued_token.refresh_token:
-            iss_token_data['refresh_token'] = issued_token.refresh_token
+        if jwts.get("refresh_token"):
+            iss_token_data['refresh_token'] = jwts["refresh_token"]
         return JsonResponse(iss_token_data)
 
     def is_token_renewable(self, session) -> bool:
@@ -104,8 +112,12 @@ class TokenEndpoint(OpBase, View):
                 session=session
             ).first()
 
-            id_token = unpad_jwt_payload(issuedToken.id_token)
-            consent_expiration = id_token['iat'] + OIDCFED_PROVIDER_MAX_CONSENT_TIMEFRAME
+            if issuedToken.id_token:
+                iat = unpad_jwt_payload(issuedToken.id_token)['iat']
+            else:
+                # compact tokens, issued along with the id token
+                iat = int(issuedToken.created.timestamp())
+            consent_expiration = iat + OIDCFED_PROVIDER_MAX_CONSENT_TIMEFRAME
             delta = consent_expiration - iat_now()
             if delta > 0:
                 return True
@@ -132,11 +144,10 @@ class TokenEndpoint(OpBase, View):
         # 1. get the IssuedToken refresh one, revoked = None
         # 2. create a new instance of issuedtoken linked to the same sessions and revoke the older
         # 3. response with a new refresh, access and id_token
-        issued_token = IssuedToken.objects.filter(
-            refresh_token=request.POST['refresh_token'],
-            revoked=False
-        ).first()
-        
+        issued_token = IssuedToken.get_by_refresh_token(
+            request.POST['refresh_token']
+        ).filter(revoked=False).first()
+
         if not issued_token:
             return JsonResponse(
                 {
@@ -156,19 +167,17 @@ class TokenEndpoint(OpBase, View):
                 }, status=400
             )
         iss_token_data = self.get_iss_token_data(session, self.get_issuer())
-        IssuedToken.objects.create(**iss_token_data)
+        IssuedToken.issue(redeemable=False, **iss_token_data)
+        TOKENS_ISSUED.inc(grant_type="refresh_token")
         issued_token.revoked = True
-        issued_token.save()
-
-        jwk_at = unpad_jwt_payload(iss_token_data['access_token'])
-        expires_in = self.get_expires_in(jwk_at['iat'], jwk_at['exp'])
+        issued_token.save(update_fields=["revoked", "modified"])
 
         data = dict(  # nosec B106
             access_token=iss_token_data['access_token'],
             id_token=iss_token_data['id_token'],
             refresh_token=iss_token_data['refresh_token'],
             token_type="Bearer",  # nosec B106
-            expires_in=expires_in
+            expires_in=iss_token_data['expires_in']
         )
 
         return JsonResponse(data)
@@ -212,14 +221,18 @@ class TokenEndpoint(OpBase, View):
             )
 
         if request.POST.get("grant_type") == 'authorization_code':
-            self.authz = OidcSession.objects.filter(
-                auth_code=request.POST["code"],
+            # session and tokens in a single query
+            self.issued_token = IssuedToken.objects.select_related("session").filter(
+                session__auth_code=request.POST["code"],
+                session__revoked=False,
                 revoked=False
             ).first()
 
-            if not self.authz:
+            if not self.issued_token:
                 return HttpResponseBadRequest()
 
+            self.authz = self.issued_token.session
+
             return self.grant_auth_code(request)
         elif request.POST.get("grant_type") == 'refresh_token':
             return self.grant_refresh_token(request)
@@ -8,15 +8,12 @@ from djagger.decorators import schema
 from django.utils import timezone
 from django.views import View
 from spid_cie_oidc.entity.jwtse import (
-    create_jws,
     create_jwe,
+    sign_jws,
     unpad_jwt_payload
 )
 
-from spid_cie_oidc.entity.models import (
-    TrustChain
-)
-from spid_cie_oidc.entity.utils import get_jwks, get_key, KeyUsage
+from spid_cie_oidc.entity.utils import get_key, KeyUsage
 from spid_cie_oidc.provider.models import IssuedToken
 
 from . import OpBase
@@ -53,8 +50,7 @@ class UserInfoEndpoint(OpBase, View):
             return HttpResponseForbidden()
         bearer = ah.split("Bearer ")[1]
 
-        token = IssuedToken.objects.filter(
-            access_token=bearer,
+        token = IssuedToken.get_by_access_token(bearer).filter(
             revoked=False,
             session__revoked=False,
             expires__gte=timezone.localtime(),
@@ -63,16 +59,12 @@ class UserInfoEndpoint(OpBase, View):
         if not token:
             return HttpResponseForbidden()
 
-        rp_tc = TrustChain.objects.filter(
-            sub=token.session.client_id,
-            metadata__openid_relying_party__isnull=False,
-            is_active=True
-        ).first()
-        if not rp_tc:
+        rp_tc = self.get_rp_trust_chain(token.session.client_id)
+        if not rp_tc or not rp_tc.is_active:
             return HttpResponseForbidden()
 
         issuer = self.get_issuer()
-        access_token_data = unpad_jwt_payload(token.access_token)
+        access_token_data = unpad_jwt_payload(bearer)
 
         # TODO: user claims
         jwt = {"sub": access_token_data["sub"]}
@@ -86,13 +78,10 @@ class UserInfoEndpoint(OpBase, View):
 
         # sign the data
         key = get_key(issuer.jwks_core, KeyUsage.signature)
-        jws = create_jws(jwt, key)
+        jws = sign_jws(jwt, key)
 
         # encrypt the data
-        client_jwks = get_jwks(
-            rp_tc.metadata['openid_relying_party'],
-            federation_jwks = rp_tc.jwks
-        )
+        client_jwks = rp_tc.get_jwks("openid_relying_party")
         client_jwk = get_key(client_jwks, KeyUsage.encryption)
 
         jwe = create_jwe(
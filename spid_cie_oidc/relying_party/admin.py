@@ -2,7 +2,7 @@ import logging
 
 from django.contrib import admin
 
-from .models import OidcAuthentication, OidcAuthenticationToken
+from .models import OidcAuthentication, OidcAuthenticationToken, OidcProviderMetadata
 from .utils import html_json_preview
 
 logger = logging.getLogger(__name__)
@@ -37,6 +37,7 @@ class OidcAuthenticationAdmin(admin.ModelAdmin):
         "endpoint",
         "successful",
         "json_preview",
+        "provider_metadata",
         "provider_configuration",
         "created",
         "modified",
@@ -66,7 +67,7 @@ class OidcAuthenticationAdmin(admin.ModelAdmin):
         (
             "Provider Discovery result",
             {
-                "fields": ("provider_configuration",),
+                "fields": ("provider_metadata", "provider_configuration"),
                 "classes": ("collapse",),
             },
         ),
@@ -76,3 +77,11 @@ class OidcAuthenticationAdmin(admin.ModelAdmin):
         return html_json_preview(obj.data)
 
     json_preview.short_description = "Authentication Request data"
+
+
+@admin.register(OidcProviderMetadata)
+class OidcProviderMetadataAdmin(admin.ModelAdmin):
+    search_fields = ("provider_id", "hash")
+    list_display = ("provider_id", "hash", "created")
+    list_filter = ("created",)
+    readonly_fields = ("hash", "provider_id", "metadata", "created")
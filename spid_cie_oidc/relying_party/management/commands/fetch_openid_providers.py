@@ -5,7 +5,7 @@ from django.core.management.base import BaseCommand
 from django.utils.translation import gettext as _
 
 from spid_cie_oidc.entity.settings import HTTPC_PARAMS
-from spid_cie_oidc.entity.trust_chain_operations import get_or_create_trust_chain
+from spid_cie_oidc.entity.trust_chain_operations import get_or_create_trust_chains
 
 
 logger = logging.getLogger(__name__)
@@ -40,27 +40,38 @@ class Command(BaseCommand):
         if not options["start"]:
             return # pragma: no cover
 
-        res = []
+        # the trust anchors of each provider, eg: the one of SPID and the one of CIE,
+        # are resolved with a single discovery of the provider
+        trust_anchors = {}
         for op_profile in settings.OIDCFED_IDENTITY_PROVIDERS.keys():
             for op_sub, ta in settings.OIDCFED_IDENTITY_PROVIDERS[op_profile].items():
-                logger.info(f"Fetching Entity Configuration for {op_sub}")
-                try:
-                    tc = get_or_create_trust_chain(
-                        subject=op_sub,
-                        trust_anchor=ta,
-                        httpc_params=HTTPC_PARAMS,
-                        required_trust_marks=getattr(
-                            settings, "OIDCFED_REQUIRED_TRUST_MARKS", []
-                        ),
-                        force=options["force"],
-                    )
-                    if tc.is_valid:
-                        res.append(tc)
+                trust_anchors.setdefault(op_sub, [])
+                if ta not in trust_anchors[op_sub]:
+                    trust_anchors[op_sub].append(ta)
 
-                    logger.info(f"Final Metadata for {tc.sub}:\n\n{tc.metadata}")
+        res = []
+        for op_sub, tas in trust_anchors.items():
+            logger.info(f"Fetching Entity Configuration for {op_sub}")
+            try:
+                tcs = get_or_create_trust_chains(
+                    subject=op_sub,
+                    trust_anchors=tas,
+                    httpc_params=HTTPC_PARAMS,
+                    required_trust_marks=getattr(
+                        settings, "OIDCFED_REQUIRED_TRUST_MARKS", []
+                    ),
+                    force=options["force"],
+                )
+            except Exception as e:
+                logger.error(f"Failed to download {op_sub} due to: {e}")
+                continue
 
-                except Exception as e:
-                    logger.error(f"Failed to download {op_sub} due to: {e}")
+            for ta, tc in tcs.items():
+                if isinstance(tc, Exception) or not tc:
+                    logger.error(f"Failed to download {op_sub} for {ta} due to: {tc}")
                     continue
+                if tc.is_valid:
+                    res.append(tc)
+                logger.info(f"Final Metadata for {tc.sub}:\n\n{tc.metadata}")
 
         logger.info(f"Found {res}")
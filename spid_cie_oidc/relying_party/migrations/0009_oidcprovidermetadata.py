@@ -0,0 +1,42 @@
+# Generated by Django 4.2.3 on 2026-10-19 05:20
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        (
+            "spid_cie_oidc_relying_party",
+            "0008_remove_oidcauthentication_provider_and_more",
+        ),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="OidcProviderMetadata",
+            fields=[
+                (
+                    "hash",
+                    models.CharField(max_length=64, primary_key=True, serialize=False),
+                ),
+                ("provider_id", models.CharField(max_length=255)),
+                ("metadata", models.JSONField(default=dict)),
+                ("created", models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                "verbose_name": "OIDC Provider Metadata",
+                "verbose_name_plural": "OIDC Provider Metadata",
+            },
+        ),
+        migrations.AddField(
+            model_name="oidcauthentication",
+            name="provider_metadata",
+            field=models.ForeignKey(
+                blank=True,
+                null=True,
+                on_delete=django.db.models.deletion.PROTECT,
+                to="spid_cie_oidc_relying_party.oidcprovidermetadata",
+            ),
+        ),
+    ]
@@ -1,9 +1,13 @@
+import hashlib
 import json
 import logging
 import uuid
 
 from django.contrib.auth import get_user_model
 from django.db import models
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+from functools import lru_cache
 
 from spid_cie_oidc.entity.jwtse import unpad_jwt_payload
 
@@ -11,6 +15,59 @@ from spid_cie_oidc.entity.jwtse import unpad_jwt_payload
 logger = logging.getLogger(__name__)
 
 
+class OidcProviderMetadata(models.Model):
+    """
+    Metadata of an OP, with the resolved jwks, used by the authorizations.
+    It's addressed by the hash of its content and shared
+    by all the authorizations to the same version of the metadata
+    """
+    hash = models.CharField(max_length=64, primary_key=True)
+    provider_id = models.CharField(max_length=255)
+    metadata = models.JSONField(default=dict)
+
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        verbose_name = "OIDC Provider Metadata"
+        verbose_name_plural = "OIDC Provider Metadata"
+
+    @classmethod
+    def get_or_create_snapshot(cls, provider_id: str, metadata: dict):
+        _hash = hashlib.sha256(
+            json.dumps(metadata, sort_keys=True).encode()
+        ).hexdigest()
+        snapshot, _ = cls.objects.get_or_create(
+            hash=_hash,
+            defaults=dict(provider_id=provider_id, metadata=metadata)
+        )
+        return snapshot
+
+    @classmethod
+    def get_cached(cls, _hash: str):
+        """
+        the snapshots never change, each process loads them once
+        """
+        return _get_provider_metadata(_hash)
+
+    @classmethod
+    def get_purgeable(cls, before):
+        """
+        snapshots created before the given datetime
+        and no longer used by any authorization
+        """
+        return cls.objects.filter(
+            created__lt=before, oidcauthentication__isnull=True
+        )
+
+    def __str__(self):
+        return f"{self.provider_id} {self.hash}"
+
+
+@lru_cache(maxsize=256)
+def _get_provider_metadata(_hash: str) -> OidcProviderMetadata:
+    return OidcProviderMetadata.objects.get(hash=_hash)
+
+
 class OidcAuthentication(models.Model):
     client_id = models.CharField(max_length=255)
     state = models.CharField(max_length=255, unique=True, default=uuid.uuid4)
@@ -19,6 +76,10 @@ class OidcAuthentication(models.Model):
     successful = models.BooleanField(default=False)
 
     provider_id = models.CharField(max_length=255, blank=True, null=True)
+    provider_metadata = models.ForeignKey(
+        OidcProviderMetadata, on_delete=models.PROTECT, blank=True, null=True
+    )
+    # the metadata of the authorizations created before the snapshots
     provider_configuration = models.JSONField(
         blank=True, null=True, default=dict
     )
@@ -30,6 +91,26 @@ class OidcAuthentication(models.Model):
         verbose_name = "OIDC Authentication"
         verbose_name_plural = "OIDC Authentications"
 
+    @classmethod
+    def get_purgeable(cls, before):
+        """
+        authorizations created before the given datetime
+        and without tokens, abandoned or already purged
+        """
+        return cls.objects.filter(
+            created__lt=before, oidcauthenticationtoken__isnull=True
+        )
+
+    @property
+    def provider_snapshot(self) -> OidcProviderMetadata:
+        if self.provider_metadata_id:
+            return OidcProviderMetadata.get_cached(self.provider_metadata_id)
+
+    def get_provider_configuration(self) -> dict:
+        if self.provider_metadata_id:
+            return self.provider_snapshot.metadata
+        return self.provider_configuration
+
     def __str__(self):
         return f"{self.client_id} {self.state} to {self.endpoint}"
 
@@ -52,6 +133,30 @@ class OidcAuthenticationToken(models.Model):
     modified = models.DateTimeField(auto_now=True)
     revoked = models.DateTimeField(blank=True, null=True)
 
+    @classmethod
+    def get_purgeable(cls, before):
+        """
+        tokens revoked before the given datetime,
+        or without a refresh token and expired before it.
+        The ones with a refresh token are kept until revoked
+        because they can still be refreshed
+        """
+        expires_in = models.ExpressionWrapper(
+            Coalesce("expires_in", 0) * models.Value(timezone.timedelta(seconds=1)),
+            output_field=models.DurationField(),
+        )
+        expires = models.ExpressionWrapper(
+            models.F("modified") + expires_in, output_field=models.DateTimeField()
+        )
+        return cls.objects.alias(expires=expires).filter(
+            models.Q(revoked__lt=before)
+            | models.Q(
+                models.Q(refresh_token__isnull=True) | models.Q(refresh_token=""),  # nosec B106
+                revoked__isnull=True,
+                expires__lt=before,
+            )
+        )
+
     def __str__(self):
         return f"{self.authz_request} {self.code}"
 
@@ -1,8 +1,8 @@
 import json
 import logging
-import requests
 import uuid
 
+from spid_cie_oidc.entity.http_client import get_async_http_client, get_http_client
 from spid_cie_oidc.entity.models import FederationEntityConfiguration
 from spid_cie_oidc.entity.jwtse import create_jws
 from spid_cie_oidc.entity.settings import HTTPC_PARAMS, HTTPC_TIMEOUT
@@ -16,7 +16,7 @@ class OAuth2AuthorizationCodeGrant(object):
     https://tools.ietf.org/html/rfc6749
     """
 
-    def access_token_request(
+    def get_access_token_grant(
         self,
         redirect_uri: str,
         state: str,
@@ -26,10 +26,9 @@ class OAuth2AuthorizationCodeGrant(object):
         token_endpoint_url: str,
         audience: list,
         code_verifier: str = None,
-    ):
+    ) -> dict:
         """
-        Access Token Request
-        https://tools.ietf.org/html/rfc6749#section-4.1.3
+        the form of the Access Token Request, with a private_key_jwt
         """
         grant_data = dict(
             grant_type="authorization_code",
@@ -52,15 +51,10 @@ class OAuth2AuthorizationCodeGrant(object):
                 jwk_dict=get_key(client_conf.jwks_core, KeyUsage.signature),
             ),
         )
-
         logger.debug(f"Access Token Request for {state}: {grant_data} ")
-        token_request = requests.post(
-            token_endpoint_url,
-            data=grant_data,
-            verify=HTTPC_PARAMS["connection"]["ssl"],
-            timeout=HTTPC_TIMEOUT,
-        )
+        return grant_data
 
+    def get_access_token_response(self, state: str, token_request):
         if token_request.status_code != 200: # pragma: no cover
             logger.error(
                 f"Something went wrong with {state}: {token_request.status_code}"
@@ -71,3 +65,67 @@ class OAuth2AuthorizationCodeGrant(object):
             except Exception as e:  # pragma: no cover
                 logger.error(f"Something went wrong with {state}: {e}")
         return token_request
+
+    def access_token_request(
+        self,
+        redirect_uri: str,
+        state: str,
+        code: str,
+        issuer_id: str,
+        client_conf: FederationEntityConfiguration,
+        token_endpoint_url: str,
+        audience: list,
+        code_verifier: str = None,
+    ):
+        """
+        Access Token Request
+        https://tools.ietf.org/html/rfc6749#section-4.1.3
+        """
+        grant_data = self.get_access_token_grant(
+            redirect_uri=redirect_uri,
+            state=state,
+            code=code,
+            issuer_id=issuer_id,
+            client_conf=client_conf,
+            token_endpoint_url=token_endpoint_url,
+            audience=audience,
+            code_verifier=code_verifier,
+        )
+        token_request = get_http_client().post(
+            token_endpoint_url,
+            data=grant_data,
+            verify=HTTPC_PARAMS["connection"]["ssl"],
+            timeout=HTTPC_TIMEOUT,
+        )
+        return self.get_access_token_response(state, token_request)
+
+    async def aaccess_token_request(
+        self,
+        redirect_uri: str,
+        state: str,
+        code: str,
+        issuer_id: str,
+        client_conf: FederationEntityConfiguration,
+        token_endpoint_url: str,
+        audience: list,
+        code_verifier: str = None,
+    ):
+        """
+        as access_token_request, with the AsyncHttpClient
+        """
+        grant_data = self.get_access_token_grant(
+            redirect_uri=redirect_uri,
+            state=state,
+            code=code,
+            issuer_id=issuer_id,
+            client_conf=client_conf,
+            token_endpoint_url=token_endpoint_url,
+            audience=audience,
+            code_verifier=code_verifier,
+        )
+        token_request = await get_async_http_client().post(
+            token_endpoint_url,
+            # requests skips the None values, aiohttp doesn't
+            data={k: v for k, v in grant_data.items() if v is not None},
+        )
+        return self.get_access_token_response(state, token_request)
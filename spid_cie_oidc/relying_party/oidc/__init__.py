@@ -1,9 +1,15 @@
 import logging
-import requests
 
 from django.conf import settings
 from spid_cie_oidc.entity.exceptions import UnknownKid
-from spid_cie_oidc.entity.jwtse import unpad_jwt_head, decrypt_jwe, verify_jws
+from spid_cie_oidc.entity.http_client import get_async_http_client, get_http_client
+from spid_cie_oidc.entity.metrics import USERINFO_SECONDS
+from spid_cie_oidc.entity.jwtse import (
+    cached_key_from_jwk_dict,
+    decrypt_jwe,
+    unpad_jwt_head,
+    verify_jws_with_key
+)
 from spid_cie_oidc.entity.utils import get_jwks
 
 logger = logging.getLogger(__name__)
@@ -28,15 +34,31 @@ class OidcUserInfo(object):
         """
         # userinfo
         headers = {"Authorization": f"Bearer {access_token}"}
-        authz_userinfo = requests.get(
-            provider_conf["userinfo_endpoint"],
-            headers=headers,
-            verify=verify,
-            timeout=getattr(
-                settings, "HTTPC_TIMEOUT", 8
-            ) # nosec - B113
-        )
+        with USERINFO_SECONDS.time(provider=provider_conf.get("issuer", "")):
+            authz_userinfo = get_http_client().get(
+                provider_conf["userinfo_endpoint"],
+                headers=headers,
+                verify=verify,
+                timeout=getattr(
+                    settings, "HTTPC_TIMEOUT", 8
+                ) # nosec - B113
+            )
+        return self.get_userinfo_response(state, authz_userinfo, provider_conf)
+
+    async def aget_userinfo(
+        self, state: str, access_token: str, provider_conf: dict, verify: bool
+    ):
+        """
+        as get_userinfo, with the AsyncHttpClient
+        """
+        headers = {"Authorization": f"Bearer {access_token}"}
+        with USERINFO_SECONDS.time(provider=provider_conf.get("issuer", "")):
+            authz_userinfo = await get_async_http_client().get(
+                provider_conf["userinfo_endpoint"], headers=headers
+            )
+        return self.get_userinfo_response(state, authz_userinfo, provider_conf)
 
+    def get_userinfo_response(self, state: str, authz_userinfo, provider_conf: dict):
         if authz_userinfo.status_code != 200: # pragma: no cover
             logger.error(
                 f"Something went wrong with {state}: {authz_userinfo.status_code}"
@@ -64,7 +86,7 @@ class OidcUserInfo(object):
                 idp_jwks = get_jwks(provider_conf)
                 idp_jwk = self.get_jwk(header["kid"], idp_jwks)
 
-                decoded_jwt = verify_jws(jws, idp_jwk)
+                decoded_jwt = verify_jws_with_key(jws, cached_key_from_jwk_dict(idp_jwk))
                 logger.debug(f"Userinfo endpoint result: {decoded_jwt}")
                 return decoded_jwt
 
@@ -117,3 +117,22 @@ RP_REQUEST_CLAIM_BY_PROFILE = {
 
 RP_DEFAULT_PROVIDER_PROFILES = getattr(settings, "RP_DEFAULT_PROVIDER_PROFILES", "spid")
 RP_REQUEST_EXP = getattr(settings, "RP_REQUEST_EXP", 60)
+
+# keeps the state of the authorization requests in a cookie, signed and encrypted
+# with the keys of the RP, instead of storing it in a OidcAuthentication.
+# The OidcAuthentication is then created by the callback, for the completed logins only
+RP_STATELESS_AUTHZ = getattr(settings, "RP_STATELESS_AUTHZ", False)
+RP_AUTHZ_STATE_COOKIE = getattr(
+    settings, "RP_AUTHZ_STATE_COOKIE", "spid_cie_oidc_rp_authz"
+)
+# in seconds, how long the user can take to authenticate to the OP
+RP_AUTHZ_STATE_EXP = getattr(settings, "RP_AUTHZ_STATE_EXP", 600)
+
+# the callback requests the userinfo while it verifies the tokens,
+# the userinfo is discarded if they are not valid
+RP_CALLBACK_PIPELINE = getattr(settings, "RP_CALLBACK_PIPELINE", False)
+# threads of each process that run the userinfo requests
+RP_CALLBACK_PIPELINE_WORKERS = getattr(settings, "RP_CALLBACK_PIPELINE_WORKERS", 8)
+# returns the duration of the stages of the callback in the Server-Timing header,
+# they are always logged
+RP_SERVER_TIMING = getattr(settings, "RP_SERVER_TIMING", settings.DEBUG)
@@ -186,8 +186,10 @@ class MockedTokenEndPointNoCorrectAtHashResponse:
 
 
 class MockedUserInfoResponse:
-    def __init__(self):
+    def __init__(self, jwk: dict = None):
         self.status_code = 200
+        # encryption key of the RP, the one of its metadata by default
+        self.jwk = jwk
 
     @property
     def content(self):
@@ -197,7 +199,7 @@ class MockedUserInfoResponse:
         }
         jws = create_jws(jwt, op_conf_priv_jwk)
         jwks = get_jwks(rp_conf["metadata"]["openid_relying_party"])
-        key = get_key(jwks, KeyUsage.encryption)
+        key = self.jwk or get_key(jwks, KeyUsage.encryption)
         jwe = create_jwe(
             jws, 
             key
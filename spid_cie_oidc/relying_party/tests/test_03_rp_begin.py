@@ -1,10 +1,11 @@
 import urllib
 
 from copy import deepcopy
-from unittest.mock import patch
+from unittest.mock import AsyncMock, patch
 
+from asgiref.sync import async_to_sync
 from django.http import HttpRequest
-from django.test import Client, TestCase, override_settings
+from django.test import Client, RequestFactory, TestCase, override_settings
 from django.urls import reverse
 from spid_cie_oidc.authority.tests.settings import rp_conf
 from spid_cie_oidc.entity.models import (
@@ -13,9 +14,12 @@ from spid_cie_oidc.entity.models import (
     TrustChain,
 )
 from spid_cie_oidc.entity.jwtse import unpad_jwt_payload
+from spid_cie_oidc.entity.tests import QueryBudgetTestMixin
 from spid_cie_oidc.entity.tests.settings import TA_SUB
 from spid_cie_oidc.entity.utils import datetime_from_timestamp, exp_from_now, iat_now
 from spid_cie_oidc.provider.tests.settings import op_conf
+from spid_cie_oidc.relying_party.models import OidcAuthentication, OidcProviderMetadata
+from spid_cie_oidc.relying_party.views.rp_begin import AsyncSpidCieOidcRpBeginView
 
 def create_tc():
     NOW = datetime_from_timestamp(iat_now())
@@ -57,7 +61,7 @@ def create_tc_metadata_no_correct():
         is_active=True,
     )
 
-class RPBeginTest(TestCase):
+class RPBeginTest(QueryBudgetTestMixin, TestCase):
 
     def setUp(self):
         self.req = HttpRequest()
@@ -86,10 +90,65 @@ class RPBeginTest(TestCase):
     def test_rp_begin(self):
         client = Client()
         url = reverse("spid_cie_rp_begin")
-        res = client.get(url, {"provider": op_conf["sub"], "trust_anchor": TA_SUB})
+        with self.assertQueryBudget("spid_cie_rp_begin"):
+            res = client.get(url, {"provider": op_conf["sub"], "trust_anchor": TA_SUB})
         self.assertTrue(res.status_code == 302)
 
     @override_settings(OIDCFED_DEFAULT_TRUST_ANCHOR=TA_SUB, OIDCFED_TRUST_ANCHORS=[TA_SUB])
+    def test_rp_begin_provider_metadata_snapshot(self):
+        client = Client()
+        url = reverse("spid_cie_rp_begin")
+        for i in range(2):
+            client.get(url, {"provider": op_conf["sub"], "trust_anchor": TA_SUB})
+
+        snapshot = OidcProviderMetadata.objects.get()
+        self.assertEqual(snapshot.provider_id, op_conf["sub"])
+        self.assertEqual(
+            snapshot.metadata["jwks"], op_conf["metadata"]["openid_provider"]["jwks"]
+        )
+        for authz in OidcAuthentication.objects.all():
+            self.assertEqual(authz.provider_metadata_id, snapshot.hash)
+            self.assertEqual(authz.provider_configuration, {})
+            self.assertEqual(authz.get_provider_configuration(), snapshot.metadata)
+
+        # a new version of the metadata gets its own snapshot
+        self.trust_chain.metadata["openid_provider"]["jwks"]["keys"][0]["kid"] = "new"
+        self.trust_chain.save()
+        client.get(url, {"provider": op_conf["sub"], "trust_anchor": TA_SUB})
+        self.assertEqual(OidcProviderMetadata.objects.count(), 2)
+
+    @override_settings(OIDCFED_DEFAULT_TRUST_ANCHOR=TA_SUB, OIDCFED_TRUST_ANCHORS=[TA_SUB])
+    def _async_rp_begin(self, data: dict):
+        request = RequestFactory().get(reverse("spid_cie_rp_begin"), data)
+        return async_to_sync(AsyncSpidCieOidcRpBeginView.as_view())(request)
+
+    @override_settings(OIDCFED_DEFAULT_TRUST_ANCHOR=TA_SUB, OIDCFED_TRUST_ANCHORS=[TA_SUB])
+    def test_async_rp_begin(self):
+        res = self._async_rp_begin({"provider": op_conf["sub"], "trust_anchor": TA_SUB})
+        self.assertEqual(res.status_code, 302)
+        self.assertIn("request=", res.url)
+
+    @override_settings(OIDCFED_DEFAULT_TRUST_ANCHOR=TA_SUB, OIDCFED_TRUST_ANCHORS=[TA_SUB])
+    def test_async_rp_begin_discovery(self):
+        self.trust_chain.delete()
+        with patch(
+            "spid_cie_oidc.relying_party.views.aget_or_create_trust_chain",
+            AsyncMock(return_value=self.trust_chain)
+        ) as discovery:
+            res = self._async_rp_begin(
+                {"provider": op_conf["sub"], "trust_anchor": TA_SUB}
+            )
+        self.assertEqual(res.status_code, 302)
+        discovery.assert_awaited_once()
+
+    @override_settings(OIDCFED_DEFAULT_TRUST_ANCHOR=TA_SUB, OIDCFED_TRUST_ANCHORS=[TA_SUB])
+    def test_async_rp_begin_unallowed_trust_anchor(self):
+        res = self._async_rp_begin(
+            {"provider": op_conf["sub"], "trust_anchor": "https://unknown.example.org"}
+        )
+        self.assertEqual(res.status_code, 404)
+        self.assertIn("Unallowed Trust Anchor", res.content.decode())
+
     @patch("spid_cie_oidc.relying_party.views.rp_begin.SpidCieOidcRpBeginView.get_oidc_op", return_value=None)
     def test_rp_begin_no_tc(self, mocked):
         client = Client()
@@ -1,14 +1,33 @@
 from copy import deepcopy
 import json
+import urllib.parse
 from unittest.mock import patch
+
+from asgiref.sync import async_to_sync
 from django.contrib.auth import get_user_model
-from django.test import Client, TestCase, override_settings
+from django.contrib.sessions.middleware import SessionMiddleware
+from django.test import Client, RequestFactory, TestCase, override_settings
 from django.urls import reverse
 from spid_cie_oidc.accounts.models import User
-from spid_cie_oidc.entity.models import FederationEntityConfiguration
-from spid_cie_oidc.entity.utils import get_jwks
+from spid_cie_oidc.entity.jwks import create_jwk, public_jwk_from_private_jwk
+from spid_cie_oidc.entity.jwtse import unpad_jwt_payload
+from spid_cie_oidc.entity.models import (
+    FederationEntityConfiguration,
+    FetchedEntityStatement,
+    TrustChain
+)
+from spid_cie_oidc.entity.tests import AsyncHttpClientMock, QueryBudgetTestMixin
+from spid_cie_oidc.entity.tests.settings import TA_SUB
+from spid_cie_oidc.entity.utils import (
+    datetime_from_timestamp,
+    exp_from_now,
+    get_jwks,
+    iat_now
+)
 
 from spid_cie_oidc.relying_party.models import OidcAuthentication
+from spid_cie_oidc.relying_party.views import rp_callback
+from spid_cie_oidc.relying_party.views.rp_callback import AsyncSpidCieOidcRpCallbackView
 from spid_cie_oidc.authority.tests.settings import rp_conf
 from spid_cie_oidc.provider.tests.settings import op_conf
 from spid_cie_oidc.provider.tests.authn_request_settings import AUTHN_REQUEST_SPID
@@ -24,9 +43,10 @@ from spid_cie_oidc.relying_party.tests.mocked_response import (
 
 STATE = "fyZiOL9Lf2CeKuNT2JzxiLRDink0uPcd"
 CODE = "usDwMnEzJPpG5oaV8x3j&"
+RP_EC_JWKS_CORE = [dict(create_jwk(kty="EC"), use=use) for use in ("sig", "enc")]
 
 
-class RpCallBack(TestCase):
+class RpCallBack(QueryBudgetTestMixin, TestCase):
     def setUp(self):
         self.rp_jwk = {
             'use': 'sig',
@@ -55,20 +75,69 @@ class RpCallBack(TestCase):
         self.op_conf = FederationEntityConfiguration.objects.create(**op_conf)
 
     @override_settings(HTTP_CLIENT_SYNC=True)
-    @patch("requests.post", return_value=MockedTokenEndPointResponse())
-    @patch("requests.get", return_value=MockedUserInfoResponse())
+    @patch("requests.Session.post", return_value=MockedTokenEndPointResponse())
+    @patch("requests.Session.get", return_value=MockedUserInfoResponse())
     def test_rp_callback(self, mocked, mocked_2):
         client = Client()
         url = reverse("spid_cie_rp_callback")
-        res = client.get(url, {"state": STATE, "code": CODE})
+        with self.assertQueryBudget("spid_cie_rp_callback"), patch(
+            "spid_cie_oidc.relying_party.views.rp_callback.RP_SERVER_TIMING", False
+        ), patch(
+            "spid_cie_oidc.relying_party.views.rp_callback._USERINFO_EXECUTOR", None
+        ):
+            res = client.get(url, {"state": STATE, "code": CODE})
+            # the pool of the pipelined userinfo requests is not started
+            self.assertIsNone(rp_callback._USERINFO_EXECUTOR)
+        self.assertEqual(res.status_code, 302)
         user = get_user_model().objects.first()
         self.assertTrue(
             user.attributes['fiscal_number'] == "sdfsfs908df09s8df90s8fd0"
         )
+        # the timings are only logged, if not enabled
+        self.assertNotIn("Server-Timing", res)
+
+    def _async_rp_callback(self, token_response, userinfo_response=None):
+        request = RequestFactory().get(
+            reverse("spid_cie_rp_callback"), {"state": STATE, "code": CODE}
+        )
+        SessionMiddleware(lambda request: None).process_request(request)
+        token_client = AsyncHttpClientMock(token_response)
+        userinfo_client = AsyncHttpClientMock(userinfo_response)
+        with patch(
+            "spid_cie_oidc.relying_party.oauth2.get_async_http_client",
+            return_value=token_client
+        ), patch(
+            "spid_cie_oidc.relying_party.oidc.get_async_http_client",
+            return_value=userinfo_client
+        ):
+            res = async_to_sync(AsyncSpidCieOidcRpCallbackView.as_view())(request)
+        return res, token_client, userinfo_client
+
+    @patch("spid_cie_oidc.relying_party.views.rp_callback.RP_SERVER_TIMING", True)
+    def test_async_rp_callback(self):
+        res, token_client, userinfo_client = self._async_rp_callback(
+            MockedTokenEndPointResponse(), MockedUserInfoResponse()
+        )
+        self.assertEqual(res.status_code, 302)
+        self.assertIn("token;dur=", res["Server-Timing"])
+        self.assertEqual([i[0] for i in token_client.requests], ["POST"])
+        self.assertEqual([i[0] for i in userinfo_client.requests], ["GET"])
+        user = get_user_model().objects.first()
+        self.assertEqual(
+            user.attributes['fiscal_number'], "sdfsfs908df09s8df90s8fd0"
+        )
+
+    def test_async_rp_callback_no_correct_id_token_response(self):
+        res, token_client, userinfo_client = self._async_rp_callback(
+            MockedTokenEndPointNoCorrectIdTokenResponse(), MockedUserInfoResponse()
+        )
+        self.assertEqual(res.status_code, 403)
+        self.assertIn("invalid_token", res.content.decode())
+        self.assertFalse(get_user_model().objects.exists())
 
     @override_settings(HTTP_CLIENT_SYNC=True)
-    @patch("requests.post", return_value=MockedTokenEndPointResponse())
-    @patch("requests.get", return_value=MockedUserInfoResponse())
+    @patch("requests.Session.post", return_value=MockedTokenEndPointResponse())
+    @patch("requests.Session.get", return_value=MockedUserInfoResponse())
     def test_rp_callback_mixups_attacks(self, mocked, mocked_2):
         client = Client()
         url = reverse("spid_cie_rp_callback")
@@ -77,8 +146,8 @@ class RpCallBack(TestCase):
 
     @override_settings(HTTP_CLIENT_SYNC=True)
     @patch("spid_cie_oidc.relying_party.views.rp_callback.process_user_attributes", return_value=None)
-    @patch("requests.post", return_value=MockedTokenEndPointResponse())
-    @patch("requests.get", return_value=MockedUserInfoResponse())
+    @patch("requests.Session.post", return_value=MockedTokenEndPointResponse())
+    @patch("requests.Session.get", return_value=MockedUserInfoResponse())
     def test_rp_callback_no_rp_attr_map(self, mocked, mocked_2, mocked_3):
         client = Client()
         url = reverse("spid_cie_rp_callback")
@@ -87,8 +156,8 @@ class RpCallBack(TestCase):
 
     @override_settings(HTTP_CLIENT_SYNC=True)
     @patch("spid_cie_oidc.relying_party.views.rp_callback.process_user_attributes", return_value=None)
-    @patch("requests.post", return_value=MockedTokenEndPointResponse())
-    @patch("requests.get", return_value=MockedUserInfoResponse())
+    @patch("requests.Session.post", return_value=MockedTokenEndPointResponse())
+    @patch("requests.Session.get", return_value=MockedUserInfoResponse())
     def test_rp_callback_incorret_request(self, mocked, mocked_2, mocked_3):
         client = Client()
         url = reverse("spid_cie_rp_callback")
@@ -97,7 +166,7 @@ class RpCallBack(TestCase):
 
     @override_settings(HTTP_CLIENT_SYNC=True)
     @patch("spid_cie_oidc.relying_party.views.rp_callback.process_user_attributes", return_value=None)
-    @patch("requests.post", return_value=MockedTokenEndPointResponse())
+    @patch("requests.Session.post", return_value=MockedTokenEndPointResponse())
     @patch("spid_cie_oidc.relying_party.views.rp_callback.SpidCieOidcRpCallbackView.get_userinfo", return_value=None)
     def test_rp_callback_no_userinfo(self, mocked, mocked_2, mocked_3):
         client = Client()
@@ -116,8 +185,8 @@ class RpCallBack(TestCase):
         self.assertTrue("invalid token response" in res.content.decode())
 
     @override_settings(HTTP_CLIENT_SYNC=True)
-    @patch("requests.post", return_value=MockedTokenEndPointResponse())
-    @patch("requests.get", return_value=MockedUserInfoResponse())
+    @patch("requests.Session.post", return_value=MockedTokenEndPointResponse())
+    @patch("requests.Session.get", return_value=MockedUserInfoResponse())
     def test_rp_callback_no_rp_conf(self, mocked, mocked_2):
         FederationEntityConfiguration.objects.filter(
             sub = self.rp_config["sub"]
@@ -128,8 +197,8 @@ class RpCallBack(TestCase):
         self.assertTrue("Relying party not found" in res.content.decode())
 
     @override_settings(HTTP_CLIENT_SYNC=True)
-    @patch("requests.post", return_value=MockedTokenEndPointResponse())
-    @patch("requests.get", return_value=MockedUserInfoResponse())
+    @patch("requests.Session.post", return_value=MockedTokenEndPointResponse())
+    @patch("requests.Session.get", return_value=MockedUserInfoResponse())
     def test_rp_callback_no_authz(self, mocked, mocked_2):
         OidcAuthentication.objects.all().delete()
         client = Client()
@@ -138,8 +207,8 @@ class RpCallBack(TestCase):
         self.assertTrue("Authentication not found" in res.content.decode())
 
     @override_settings(HTTP_CLIENT_SYNC=True)
-    @patch("requests.post", return_value=MockedTokenEndPointResponse())
-    @patch("requests.get", return_value=MockedUserInfoResponse())
+    @patch("requests.Session.post", return_value=MockedTokenEndPointResponse())
+    @patch("requests.Session.get", return_value=MockedUserInfoResponse())
     def test_rp_callback_reunification(self, mocked, mocked_2):
         user = User.objects.create(username = "username", attributes = {"fiscal_number" : "sdfsfs908df09s8df90s8fd0"}),
         client = Client()
@@ -151,8 +220,8 @@ class RpCallBack(TestCase):
         )
 
     @override_settings(HTTP_CLIENT_SYNC=True)
-    @patch("requests.post", return_value=MockedTokenEndPointNoCorrectResponse())
-    @patch("requests.get", return_value=MockedUserInfoResponse())
+    @patch("requests.Session.post", return_value=MockedTokenEndPointNoCorrectResponse())
+    @patch("requests.Session.get", return_value=MockedUserInfoResponse())
     def test_rp_callback_no_correct_token_response(self, mocked, mocked1):
         client = Client()
         url = reverse("spid_cie_rp_callback")
@@ -161,8 +230,8 @@ class RpCallBack(TestCase):
         self.assertTrue("invalid_request" in res.content.decode())
 
     @override_settings(HTTP_CLIENT_SYNC=True)
-    @patch("requests.post", return_value=MockedTokenEndPointNoCorrectIdTokenResponse())
-    @patch("requests.get", return_value=MockedUserInfoResponse())
+    @patch("requests.Session.post", return_value=MockedTokenEndPointNoCorrectIdTokenResponse())
+    @patch("requests.Session.get", return_value=MockedUserInfoResponse())
     def test_rp_callback_no_correct_id_token_response(self, mocked, mocked1):
         client = Client()
         url = reverse("spid_cie_rp_callback")
@@ -171,11 +240,129 @@ class RpCallBack(TestCase):
         self.assertTrue("invalid_token" in res.content.decode())
 
     @override_settings(HTTP_CLIENT_SYNC=True)
-    @patch("requests.post", return_value=MockedTokenEndPointNoCorrectAtHashResponse())
-    @patch("requests.get", return_value=MockedUserInfoResponse())
+    @patch("requests.Session.post", return_value=MockedTokenEndPointNoCorrectAtHashResponse())
+    @patch("requests.Session.get", return_value=MockedUserInfoResponse())
     def test_rp_callback_no_correct_at_hash_response(self, mocked, mocked1):
         client = Client()
         url = reverse("spid_cie_rp_callback")
         res = client.get(url, {"state": STATE, "code": CODE})
         self.assertTrue(res.status_code == 403)
         self.assertTrue("at_hash verification failed" in res.content.decode())
+
+    def _rp_callback_stateless(self):
+        OidcAuthentication.objects.all().delete()
+        ta_fes = FetchedEntityStatement.objects.create(
+            sub=TA_SUB,
+            iss=TA_SUB,
+            exp=datetime_from_timestamp(exp_from_now(33)),
+            iat=datetime_from_timestamp(iat_now()),
+        )
+        TrustChain.objects.create(
+            sub=op_conf["sub"],
+            exp=datetime_from_timestamp(exp_from_now(33)),
+            jwks=[],
+            metadata=deepcopy(op_conf["metadata"]),
+            status="valid",
+            trust_anchor=ta_fes,
+            is_active=True,
+        )
+        client = Client()
+        res = client.get(
+            reverse("spid_cie_rp_begin"),
+            {"provider": op_conf["sub"], "trust_anchor": TA_SUB}
+        )
+        self.assertEqual(res.status_code, 302)
+        self.assertFalse(OidcAuthentication.objects.exists())
+
+        query = dict(urllib.parse.parse_qsl(urllib.parse.urlparse(res.url).query))
+        state = unpad_jwt_payload(query["request"])["state"]
+        cookie = client.cookies[f"spid_cie_oidc_rp_authz_{state}"]
+        self.assertTrue(cookie["httponly"])
+
+        url = reverse("spid_cie_rp_callback")
+        res = client.get(url, {"state": state, "code": CODE})
+        self.assertEqual(res.status_code, 302)
+        authz = OidcAuthentication.objects.get(state=state)
+        self.assertTrue(authz.successful)
+        self.assertEqual(authz.provider_id, op_conf["sub"])
+        self.assertEqual(
+            authz.get_provider_configuration()["token_endpoint"],
+            op_conf["metadata"]["openid_provider"]["token_endpoint"]
+        )
+        self.assertEqual(client.cookies[cookie.key].value, "")
+
+        # the same state can't be used twice
+        client.cookies[cookie.key] = cookie.value
+        res = client.get(url, {"state": state, "code": CODE})
+        self.assertEqual(res.status_code, 401)
+
+        # nor without its cookie
+        res = Client().get(url, {"state": state, "code": CODE})
+        self.assertEqual(res.status_code, 401)
+
+    @override_settings(
+        HTTP_CLIENT_SYNC=True,
+        OIDCFED_DEFAULT_TRUST_ANCHOR=TA_SUB,
+        OIDCFED_TRUST_ANCHORS=[TA_SUB]
+    )
+    @patch("spid_cie_oidc.relying_party.views.rp_begin.RP_STATELESS_AUTHZ", True)
+    @patch("spid_cie_oidc.relying_party.views.rp_callback.RP_STATELESS_AUTHZ", True)
+    @patch("requests.Session.post", return_value=MockedTokenEndPointResponse())
+    @patch("requests.Session.get", return_value=MockedUserInfoResponse())
+    def test_rp_callback_stateless(self, mocked, mocked_2):
+        self._rp_callback_stateless()
+
+    @override_settings(
+        HTTP_CLIENT_SYNC=True,
+        OIDCFED_DEFAULT_TRUST_ANCHOR=TA_SUB,
+        OIDCFED_TRUST_ANCHORS=[TA_SUB]
+    )
+    @patch("spid_cie_oidc.relying_party.views.rp_begin.RP_STATELESS_AUTHZ", True)
+    @patch("spid_cie_oidc.relying_party.views.rp_callback.RP_STATELESS_AUTHZ", True)
+    @patch("requests.Session.post", return_value=MockedTokenEndPointResponse())
+    @patch(
+        "requests.Session.get",
+        return_value=MockedUserInfoResponse(public_jwk_from_private_jwk(RP_EC_JWKS_CORE[1]))
+    )
+    def test_rp_callback_stateless_ec_keys(self, mocked, mocked_2):
+        # the state cookie and the userinfo encrypted with the EC keys of the RP
+        rp_conf_saved = FederationEntityConfiguration.objects.first()
+        rp_conf_saved.jwks_core = RP_EC_JWKS_CORE
+        rp_conf_saved.save()
+        self._rp_callback_stateless()
+        user = get_user_model().objects.first()
+        self.assertEqual(user.attributes["fiscal_number"], "sdfsfs908df09s8df90s8fd0")
+
+    @override_settings(HTTP_CLIENT_SYNC=True)
+    @patch("spid_cie_oidc.relying_party.views.rp_callback.RP_CALLBACK_PIPELINE", True)
+    @patch("spid_cie_oidc.relying_party.views.rp_callback.RP_SERVER_TIMING", True)
+    @patch("requests.Session.post", return_value=MockedTokenEndPointResponse())
+    @patch("requests.Session.get", return_value=MockedUserInfoResponse())
+    def test_rp_callback_pipeline(self, mocked, mocked_2):
+        client = Client()
+        url = reverse("spid_cie_rp_callback")
+        res = client.get(url, {"state": STATE, "code": CODE})
+        self.assertEqual(res.status_code, 302)
+        user = get_user_model().objects.first()
+        self.assertEqual(user.attributes['fiscal_number'], "sdfsfs908df09s8df90s8fd0")
+        self.assertIsNotNone(rp_callback._USERINFO_EXECUTOR)
+        stages = [i.split(";")[0] for i in res["Server-Timing"].split(", ")]
+        self.assertEqual(
+            sorted(stages), ["token", "user", "userinfo", "userinfo_wait", "verify"]
+        )
+
+    @override_settings(HTTP_CLIENT_SYNC=True)
+    @patch("spid_cie_oidc.relying_party.views.rp_callback.RP_CALLBACK_PIPELINE", True)
+    @patch("requests.Session.post", return_value=MockedTokenEndPointNoCorrectAtHashResponse())
+    @patch("requests.Session.get", return_value=MockedUserInfoResponse())
+    def test_rp_callback_pipeline_invalid_tokens(self, mocked, mocked_2):
+        client = Client()
+        url = reverse("spid_cie_rp_callback")
+        with patch(
+            "spid_cie_oidc.relying_party.views.rp_callback._USERINFO_EXECUTOR"
+        ) as executor:
+            res = client.get(url, {"state": STATE, "code": CODE})
+        self.assertEqual(res.status_code, 403)
+        # the userinfo has been submitted but cancelled
+        executor.submit.return_value.cancel.assert_called_once()
+        self.assertFalse(get_user_model().objects.exists())
@@ -39,7 +39,7 @@ class RpIntiatedLogoutTest(TestCase):
         )
 
     
-    @patch("requests.post", return_value=MockedLogout())
+    @patch("requests.Session.post", return_value=MockedLogout())
     def test_rpinitiated_logout(self, mokced):
         c = Client()
         c.login(username="test", password="test")
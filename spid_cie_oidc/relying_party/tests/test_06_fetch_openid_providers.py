@@ -56,10 +56,15 @@ class FetchProviderTest(TestCase):
     @override_settings(OIDCFED_IDENTITY_PROVIDERS = {"spid": {"http://127.0.0.1:8000/oidc/op/" :"http://testserver/"}, "cie":{}})
     def test_fetch_provider(self):
         self.patcher = patch(
-            "spid_cie_oidc.entity.trust_chain_operations.get_or_create_trust_chain", 
-            return_value = create_tc()
+            "spid_cie_oidc.relying_party.management.commands."
+            "fetch_openid_providers.get_or_create_trust_chains",
+            return_value = {"http://testserver/": create_tc()}
         )
-        self.patcher.start()
+        mocked = self.patcher.start()
         self.exec('fetch_openid_providers', '--start')
         self.patcher.stop()
+        mocked.assert_called_once()
+        self.assertEqual(
+            mocked.call_args.kwargs["trust_anchors"], ["http://testserver/"]
+        )
 
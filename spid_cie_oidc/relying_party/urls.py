@@ -4,8 +4,9 @@ from spid_cie_oidc.entity.views import (
     openid_connect_jwks_uri,
     openid_connect_signed_jwks_uri
 )
-from .views.rp_begin import SpidCieOidcRpBeginView
-from .views.rp_callback import SpidCieOidcRpCallbackView
+from spid_cie_oidc.entity.settings import OIDCFED_ASYNC_VIEWS
+from .views.rp_begin import AsyncSpidCieOidcRpBeginView, SpidCieOidcRpBeginView
+from .views.rp_callback import AsyncSpidCieOidcRpCallbackView, SpidCieOidcRpCallbackView
 from .views.rp_extend_session import SpidCieOidcRefreshToken
 from .views.rp_callback_echo_attributes import SpidCieOidcRpCallbackEchoAttributes
 from .views.rp_initiated_logout import SpidCieOidcRpLogout  # oidc_rpinitiated_logout
@@ -18,14 +19,19 @@ urlpatterns = []
 urlpatterns += (
     path(
         f"{_PREF}/authorization",
-        SpidCieOidcRpBeginView.as_view(),
+        (
+            AsyncSpidCieOidcRpBeginView if OIDCFED_ASYNC_VIEWS else SpidCieOidcRpBeginView
+        ).as_view(),
         name="spid_cie_rp_begin",
     ),
 )
 urlpatterns += (
     path(
         f"{_PREF}/callback",
-        SpidCieOidcRpCallbackView.as_view(),
+        (
+            AsyncSpidCieOidcRpCallbackView if OIDCFED_ASYNC_VIEWS
+            else SpidCieOidcRpCallbackView
+        ).as_view(),
         name="spid_cie_rp_callback",
     ),
 )
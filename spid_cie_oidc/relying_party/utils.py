@@ -5,8 +5,10 @@ import logging
 import random
 import secrets
 import string
+import time
 import urllib
 
+from contextlib import contextmanager
 
 from django.utils.module_loading import import_string
 from django.utils.safestring import mark_safe
@@ -73,3 +75,37 @@ def process_user_attributes(userinfo: dict, user_map: dict, authz: dict):
                     data[k] = value
                     break
     return data
+
+
+class StageTimer:
+    """
+    durations in milliseconds of the stages of a request
+    """
+
+    def __init__(self):
+        self.timings = {}
+        self._started = {}
+
+    def start(self, name: str) -> None:
+        self._started[name] = time.perf_counter()
+
+    def stop(self, name: str) -> None:
+        start = self._started.pop(name)
+        self.timings[name] = round((time.perf_counter() - start) * 1000, 3)
+
+    @contextmanager
+    def stage(self, name: str):
+        self.start(name)
+        try:
+            yield
+        finally:
+            self.stop(name)
+
+    def as_server_timing(self) -> str:
+        """
+        value of the Server-Timing response header
+        """
+        return ", ".join(f"{k};dur={v}" for k, v in self.timings.items())
+
+    def __str__(self):
+        return " ".join(f"{k}={v}ms" for k, v in self.timings.items())
@@ -1,10 +1,14 @@
+import json
 import logging
+import urllib.parse
+
 from django.conf import settings
+from django.db import IntegrityError, transaction
 from pydantic import ValidationError
 
 from django.urls import reverse
 from django.http import HttpResponseRedirect
-from spid_cie_oidc.entity.jwtse import create_jws
+from spid_cie_oidc.entity.jwtse import create_jwe, create_jws, decrypt_jwe, verify_jws
 from spid_cie_oidc.entity.models import FederationEntityConfiguration
 from ..oidc import *
 from ..oauth2 import *
@@ -12,11 +16,19 @@ from ..oauth2 import *
 from enum import Enum
 
 from spid_cie_oidc.entity.exceptions import InvalidTrustchain
+from spid_cie_oidc.entity.http_client import get_http_client
+from spid_cie_oidc.entity.metrics import REPLAY_REJECTIONS
 from spid_cie_oidc.entity.models import TrustChain
-from spid_cie_oidc.entity.utils import get_key
-from spid_cie_oidc.entity.trust_chain_operations import get_or_create_trust_chain
+from spid_cie_oidc.entity.utils import get_key, iat_now, KeyUsage
+from spid_cie_oidc.entity.trust_chain_operations import (
+    aget_or_create_trust_chain,
+    get_or_create_trust_chain,
+)
 from spid_cie_oidc.relying_party.exceptions import ValidationException
+from spid_cie_oidc.relying_party.models import OidcAuthentication, OidcProviderMetadata
 from spid_cie_oidc.relying_party.settings import (
+    RP_AUTHZ_STATE_COOKIE,
+    RP_AUTHZ_STATE_EXP,
     RP_DEFAULT_PROVIDER_PROFILES,
     RP_PROVIDER_PROFILES
 )
@@ -35,9 +47,9 @@ class SpidCieOidcRp:
     Baseclass with common methods for RPs
     """
 
-    def get_oidc_op(self, request) -> TrustChain:
+    def get_oidc_op_trust_anchor(self, request) -> str:
         """
-            get available trust to a specific OP
+            the trust anchor of the OP requested
         """
         if not request.GET.get("provider", None):
             logger.warning(
@@ -59,16 +71,12 @@ class SpidCieOidcRp:
 
         if not trust_anchor:
             trust_anchor = settings.OIDCFED_DEFAULT_TRUST_ANCHOR
+        return trust_anchor
 
-        tc = TrustChain.objects.filter(
-            sub=request.GET["provider"],
-            trust_anchor__sub=trust_anchor,
-        ).first()
-
-        discover_trust = False
+    def is_oidc_op_to_discover(self, request, tc: TrustChain) -> bool:
         if not tc:
             logger.info(f'Trust Chain not found for {request.GET["provider"]}')
-            discover_trust = True
+            return True
 
         elif not tc.is_active:
             logger.warning(f"{tc} found but DISABLED at {tc.modified}")
@@ -77,9 +85,20 @@ class SpidCieOidcRp:
         elif tc.is_expired:
             logger.warning(f"{tc} found but expired at {tc.exp}")
             logger.warning("Try to renew the trust chain")
-            discover_trust = True
+            return True
+        return False
 
-        if discover_trust:
+    def get_oidc_op(self, request) -> TrustChain:
+        """
+            get available trust to a specific OP
+        """
+        trust_anchor = self.get_oidc_op_trust_anchor(request)
+        tc = TrustChain.objects.filter(
+            sub=request.GET["provider"],
+            trust_anchor__sub=trust_anchor,
+        ).first()
+
+        if self.is_oidc_op_to_discover(request, tc):
             tc = get_or_create_trust_chain(
                 subject=request.GET["provider"],
                 trust_anchor=trust_anchor,
@@ -89,6 +108,24 @@ class SpidCieOidcRp:
             )
         return tc
 
+    async def aget_oidc_op(self, request) -> TrustChain:
+        """
+            as get_oidc_op, with aget_or_create_trust_chain
+        """
+        trust_anchor = self.get_oidc_op_trust_anchor(request)
+        tc = await TrustChain.objects.filter(
+            sub=request.GET["provider"],
+            trust_anchor__sub=trust_anchor,
+        ).afirst()
+
+        if self.is_oidc_op_to_discover(request, tc):
+            tc = await aget_or_create_trust_chain(
+                subject=request.GET["provider"],
+                trust_anchor=trust_anchor,
+                force=True,
+            )
+        return tc
+
     def validate_json_schema(self, request, schema_type, error_description):
         try:
             schema = RP_PROVIDER_PROFILES[RP_DEFAULT_PROVIDER_PROFILES]
@@ -100,6 +137,91 @@ class SpidCieOidcRp:
             )
             raise ValidationException()
 
+    def get_authz_state_cookie(self, state: str) -> str:
+        return f"{RP_AUTHZ_STATE_COOKIE}_{state}"
+
+    def set_authz_state(self, response, authz_entry: dict, entity_conf) -> None:
+        """
+        stores the authorization request in a cookie instead of the DB,
+        as a JWS of the RP encrypted with its own key.
+        The provider metadata are referenced by the hash of their snapshot
+        """
+        authz_data = json.loads(authz_entry["data"])
+        payload = dict(
+            client_id=authz_entry["client_id"],
+            state=authz_entry["state"],
+            endpoint=authz_entry["endpoint"],
+            provider_id=authz_entry["provider_id"],
+            provider_metadata=authz_entry["provider_metadata"].pk,
+            nonce=authz_data["nonce"],
+            redirect_uri=authz_data["redirect_uri"],
+            code_verifier=authz_data["code_verifier"],
+            exp=iat_now() + RP_AUTHZ_STATE_EXP,
+        )
+        jws = create_jws(payload, get_key(entity_conf.jwks_core, KeyUsage.signature))
+        response.set_cookie(
+            self.get_authz_state_cookie(authz_entry["state"]),
+            create_jwe(jws, get_key(entity_conf.jwks_core, KeyUsage.encryption)),
+            max_age=RP_AUTHZ_STATE_EXP,
+            path=urllib.parse.urlparse(authz_data["redirect_uri"]).path,
+            secure=settings.SESSION_COOKIE_SECURE,
+            httponly=True,
+            samesite="Lax",
+        )
+
+    def get_authz_state(self, request, state: str) -> OidcAuthentication:
+        """
+        creates the OidcAuthentication of the state stored in the cookie,
+        only once for each state
+        """
+        authz_state = request.COOKIES.get(self.get_authz_state_cookie(state))
+        entity_conf = FederationEntityConfiguration.get_cached(
+            entity_type="openid_relying_party"
+        )
+        if not authz_state or not entity_conf:
+            return None
+
+        try:
+            jws = decrypt_jwe(
+                authz_state, get_key(entity_conf.jwks_core, KeyUsage.encryption)
+            )
+            payload = verify_jws(
+                jws.decode(), get_key(entity_conf.jwks_core, KeyUsage.signature)
+            )
+        except Exception as e:
+            logger.warning(f"Invalid authorization state for {state}: {e}")
+            return None
+
+        if payload["state"] != state or payload["exp"] < iat_now():
+            logger.warning(f"Expired authorization state for {state}")
+            return None
+
+        try:
+            OidcProviderMetadata.get_cached(payload["provider_metadata"])
+        except OidcProviderMetadata.DoesNotExist:
+            logger.warning(f"Provider metadata of the authorization state {state} not found")
+            return None
+
+        try:
+            with transaction.atomic():
+                return OidcAuthentication.objects.create(
+                    client_id=payload["client_id"],
+                    state=state,
+                    endpoint=payload["endpoint"],
+                    provider_id=payload["provider_id"],
+                    data=json.dumps(
+                        {
+                            k: payload[k]
+                            for k in ("nonce", "redirect_uri", "code_verifier")
+                        }
+                    ),
+                    provider_metadata_id=payload["provider_metadata"],
+                )
+        except IntegrityError:
+            REPLAY_REJECTIONS.inc(kind="authz_state")
+            logger.warning(f"Authorization state {state} already used")
+            return None
+
     def get_token_request(self, auth_token, request, token_type):
 
         default_logout_url = getattr(
@@ -122,15 +244,15 @@ class SpidCieOidcRp:
         if token_type == TokenRequestType.refresh:
             token_request_data["grant_type"] = "refresh_token"
             token_request_data["refresh_token"] = auth_token.refresh_token
-            audience = authz.provider_configuration["token_endpoint"]
+            audience = authz.get_provider_configuration()["token_endpoint"]
 
         elif token_type == TokenRequestType.revocation:
             token_request_data["token"] = auth_token.access_token
-            audience = authz.provider_configuration["revocation_endpoint"]
+            audience = authz.get_provider_configuration()["revocation_endpoint"]
 
         elif token_type == TokenRequestType.introspection:
             token_request_data["token"] = auth_token.access_token
-            audience = authz.provider_configuration["introspection_endpoint"]
+            audience = authz.get_provider_configuration()["introspection_endpoint"]
 
         if not audience:
             logger.warning(
@@ -152,7 +274,7 @@ class SpidCieOidcRp:
         token_request_data["client_assertion"] = client_assertion
 
         try:
-            token_request = requests.post(
+            token_request = get_http_client().post(
                 audience,
                 data=token_request_data,
                 timeout=getattr(
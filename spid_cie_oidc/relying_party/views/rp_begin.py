@@ -3,6 +3,7 @@ import logging
 import uuid
 from copy import deepcopy
 
+from asgiref.sync import sync_to_async
 from djagger.decorators import schema
 from django.http import HttpResponseRedirect
 from django.shortcuts import render
@@ -13,15 +14,16 @@ from django.views import View
 from spid_cie_oidc.entity.exceptions import InvalidTrustchain
 from spid_cie_oidc.entity.jwtse import create_jws
 from spid_cie_oidc.entity.utils import get_jwks, get_key, KeyUsage
-from spid_cie_oidc.entity.models import FederationEntityConfiguration
+from spid_cie_oidc.entity.models import FederationEntityConfiguration, TrustChain
 from spid_cie_oidc.relying_party.settings import OIDCFED_ACR_PROFILES, RP_PROVIDER_PROFILES, \
     RP_DEFAULT_PROVIDER_PROFILES
 
-from ..models import OidcAuthentication
+from ..models import OidcAuthentication, OidcProviderMetadata
 from ..settings import (
     RP_PKCE_CONF,
     RP_REQUEST_CLAIM_BY_PROFILE,
-    RP_REQUEST_EXP
+    RP_REQUEST_EXP,
+    RP_STATELESS_AUTHZ
 )
 from ..utils import (
     http_dict_to_redirect_uri_path,
@@ -173,11 +175,15 @@ class SpidCieOidcRpBeginView(SpidCieOidcRp, View):
             # TODO: better have here an organization name
             provider_id=tc.sub,
             data=json.dumps(authz_data),
-            provider_configuration=provider_metadata,
+            # shared by all the authorizations to this version of the metadata
+            provider_metadata=OidcProviderMetadata.get_or_create_snapshot(
+                tc.sub, provider_metadata
+            ),
         )
 
-        # TODO: Prune the old or unbounded authz ...
-        OidcAuthentication.objects.create(**authz_entry)
+        if not RP_STATELESS_AUTHZ:
+            # the abandoned ones are deleted by the purge_expired command
+            OidcAuthentication.objects.create(**authz_entry)
 
         authz_data.pop("code_verifier")
         # add the signed request object
@@ -208,4 +214,28 @@ class SpidCieOidcRpBeginView(SpidCieOidcRp, View):
             qstring = "?"
         url = qstring.join((authz_endpoint, uri_path))
         logger.info(f"Starting Authz request to {url}")
-        return HttpResponseRedirect(url)
+        response = HttpResponseRedirect(url)
+        if RP_STATELESS_AUTHZ:
+            self.set_authz_state(response, authz_entry, entity_conf)
+        return response
+
+
+class AsyncSpidCieOidcRpBeginView(SpidCieOidcRpBeginView):
+    """
+        As SpidCieOidcRpBeginView, for the ASGI deployments.
+        The trust chain of the OP is built without holding a thread
+        while its statements are fetched
+    """
+
+    async def get(self, request, *args, **kwargs):
+        try:
+            self.oidc_op = await self.aget_oidc_op(request)
+        except Exception as e:
+            # handled by the sync view, as if raised by get_oidc_op
+            self.oidc_op = e
+        return await sync_to_async(super().get)(request, *args, **kwargs)
+
+    def get_oidc_op(self, request) -> TrustChain:
+        if isinstance(self.oidc_op, Exception):
+            raise self.oidc_op
+        return self.oidc_op
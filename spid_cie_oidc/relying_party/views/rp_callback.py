@@ -1,18 +1,24 @@
+import asyncio
 import json
 import logging
+import threading
 
+from asgiref.sync import sync_to_async
+from concurrent.futures import ThreadPoolExecutor
 from djagger.decorators import schema
 from django.conf import settings
 from django.contrib.auth import get_user_model, login
-from django.http import HttpResponseRedirect, JsonResponse
+from django.http import HttpResponse, HttpResponseRedirect, JsonResponse
 from django.shortcuts import render
 from django.urls import reverse
 from django.utils.translation import gettext as _
 from django.views import View
+from typing import Union
 from spid_cie_oidc.entity.jwtse import (
+    cached_key_from_jwk_dict,
     unpad_jwt_payload,
-    verify_jws,
-    verify_at_hash
+    verify_at_hash,
+    verify_jws_with_key
 )
 from spid_cie_oidc.entity.models import FederationEntityConfiguration
 from spid_cie_oidc.entity.settings import HTTPC_PARAMS
@@ -25,10 +31,14 @@ from ..oauth2 import *
 from ..oidc import *
 from ..settings import (
     RP_ATTR_MAP,
+    RP_CALLBACK_PIPELINE,
+    RP_CALLBACK_PIPELINE_WORKERS,
+    RP_SERVER_TIMING,
+    RP_STATELESS_AUTHZ,
     RP_USER_CREATE,
     RP_USER_LOOKUP_FIELD,
 )
-from ..utils import process_user_attributes
+from ..utils import StageTimer, process_user_attributes
 
 from . import SpidCieOidcRp
 
@@ -36,6 +46,22 @@ logger = logging.getLogger(__name__)
 
 schema_profile = RP_PROVIDER_PROFILES[RP_DEFAULT_PROVIDER_PROFILES]
 
+# runs the userinfo requests of the pipelined callbacks, started by the first one
+_USERINFO_EXECUTOR = None
+_USERINFO_EXECUTOR_LOCK = threading.Lock()
+
+
+def _get_userinfo_executor() -> ThreadPoolExecutor:
+    global _USERINFO_EXECUTOR
+    if _USERINFO_EXECUTOR is None:
+        with _USERINFO_EXECUTOR_LOCK:
+            if _USERINFO_EXECUTOR is None:
+                _USERINFO_EXECUTOR = ThreadPoolExecutor(
+                    max_workers=RP_CALLBACK_PIPELINE_WORKERS,
+                    thread_name_prefix="rp-userinfo"
+                )
+    return _USERINFO_EXECUTOR
+
 
 @schema(
     summary="OIDC Relying Party auth code Callback",
@@ -89,9 +115,18 @@ class SpidCieOidcRpCallbackView(View, SpidCieOidcRp, OidcUserInfo, OAuth2Authori
             logger.info(f"Created new user {user}")
             return user
 
-    def get(self, request, *args, **kwargs):
+    def timed_userinfo(self, timer: StageTimer, **kwargs):
+        with timer.stage("userinfo"):
+            return self.get_userinfo(**kwargs)
+
+    async def atimed_userinfo(self, timer: StageTimer, **kwargs):
+        with timer.stage("userinfo"):
+            return await self.aget_userinfo(**kwargs)
+
+    def get_callback_context(self, request) -> Union[HttpResponse, dict]:
         """
-            The Authorization callback, the redirect uri where the auth code lands
+        validates the authorization response and gets its authorization request,
+        returns the error response if it's not valid
         """
         request_args = {k: v for k, v in request.GET.items()}
         if "error" in request_args:
@@ -101,9 +136,6 @@ class SpidCieOidcRpCallbackView(View, SpidCieOidcRp, OidcUserInfo, OAuth2Authori
                 request_args,
                 status=401
             )
-        authz = OidcAuthentication.objects.filter(
-            state=request_args.get("state"),
-        )
         try:
             self.validate_json_schema(
                 request.GET.dict(),
@@ -119,14 +151,18 @@ class SpidCieOidcRpCallbackView(View, SpidCieOidcRp, OidcUserInfo, OAuth2Authori
                 status = 400
             )
 
+        if RP_STATELESS_AUTHZ:
+            authz = self.get_authz_state(request, request_args.get("state"))
+        else:
+            authz = OidcAuthentication.objects.filter(
+                state=request_args.get("state"),
+            ).last()
         if not authz:
             context = {
                 "error": "unauthorized request",
                 "error_description": _("Authentication not found"),
             }
             return render(request, self.error_template, context, status=401)
-        else:
-            authz = authz.last()
 
         code = request.GET.get("code")
         # mixups attacks prevention
@@ -153,17 +189,31 @@ class SpidCieOidcRpCallbackView(View, SpidCieOidcRp, OidcUserInfo, OAuth2Authori
             }
             return render(request, self.error_template, context, status=400)
 
-        authz_data = json.loads(authz.data)
-        token_response = self.access_token_request(
-            redirect_uri=authz_data["redirect_uri"],
-            state=authz.state,
+        return dict(
+            authz=authz,
+            authz_token=authz_token,
+            authz_data=json.loads(authz.data),
+            provider_conf=authz.get_provider_configuration(),
             code=code,
+        )
+
+    def get_token_request_kwargs(self, ctx: dict) -> dict:
+        authz = ctx["authz"]
+        return dict(
+            redirect_uri=ctx["authz_data"]["redirect_uri"],
+            state=authz.state,
+            code=ctx["code"],
             issuer_id=authz.provider_id,
             client_conf=self.rp_conf,
-            token_endpoint_url=authz.provider_configuration["token_endpoint"],
+            token_endpoint_url=ctx["provider_conf"]["token_endpoint"],
             audience=[authz.provider_id],
-            code_verifier=authz_data.get("code_verifier"),
+            code_verifier=ctx["authz_data"].get("code_verifier"),
         )
+
+    def validate_token_response(self, request, token_response) -> HttpResponse:
+        """
+        returns the error response if the token response is not valid
+        """
         if not token_response:
             context = {
                 "error": "invalid token response",
@@ -171,24 +221,37 @@ class SpidCieOidcRpCallbackView(View, SpidCieOidcRp, OidcUserInfo, OAuth2Authori
             }
             return render(request, self.error_template, context, status=400)
 
-        else:
-            try:
-                self.validate_json_schema(
-                    token_response,
-                    "token_response",
-                    "Token response object validation failed"
-                )
-            except ValidationException:
-                return JsonResponse(
-                    {
-                        "error": "invalid_request",
-                        "error_description": "Token response object validation failed",
-                    },
-                    status = 400
-                )
-        jwks = get_jwks(authz.provider_configuration)
+        try:
+            self.validate_json_schema(
+                token_response,
+                "token_response",
+                "Token response object validation failed"
+            )
+        except ValidationException:
+            return JsonResponse(
+                {
+                    "error": "invalid_request",
+                    "error_description": "Token response object validation failed",
+                },
+                status = 400
+            )
+
+    def get_userinfo_kwargs(self, ctx: dict, token_response: dict) -> dict:
+        return dict(
+            state=ctx["authz"].state,
+            access_token=token_response["access_token"],
+            provider_conf=ctx["provider_conf"],
+            verify=HTTPC_PARAMS.get("connection", {}).get("ssl", True)
+        )
+
+    def verify_tokens(self, request, ctx: dict, token_response: dict) -> HttpResponse:
+        """
+        verifies the signatures of the tokens and stores them,
+        returns the error response if they are not valid
+        """
         access_token = token_response["access_token"]
         id_token = token_response["id_token"]
+        jwks = get_jwks(ctx["provider_conf"])
 
         op_ac_jwk = get_jwk_from_jwt(access_token, jwks)
         op_id_jwk = get_jwk_from_jwt(id_token, jwks)
@@ -205,7 +268,8 @@ class SpidCieOidcRpCallbackView(View, SpidCieOidcRp, OidcUserInfo, OAuth2Authori
             return render(request, self.error_template, context, status=403)
 
         try:
-            verify_jws(access_token, op_ac_jwk)
+            # the keys of the same metadata are parsed once
+            verify_jws_with_key(access_token, cached_key_from_jwk_dict(op_ac_jwk))
         except Exception as e:
             logger.warning(
                 f"Access Token signature validation error: {e} "
@@ -217,7 +281,7 @@ class SpidCieOidcRpCallbackView(View, SpidCieOidcRp, OidcUserInfo, OAuth2Authori
             return render(request, self.error_template, context, status=403)
 
         try:
-            verify_jws(id_token, op_id_jwk)
+            verify_jws_with_key(id_token, cached_key_from_jwk_dict(op_id_jwk))
         except Exception as e:
             logger.warning(
                 f"ID Token signature validation error: {e} "
@@ -243,9 +307,10 @@ class SpidCieOidcRpCallbackView(View, SpidCieOidcRp, OidcUserInfo, OAuth2Authori
             }
             return render(request, self.error_template, context, status=403)
 
-        decoded_access_token = unpad_jwt_payload(access_token)
-        logger.debug(decoded_access_token)
+        ctx["decoded_access_token"] = unpad_jwt_payload(access_token)
+        logger.debug(ctx["decoded_access_token"])
 
+        authz_token = ctx["authz_token"]
         authz_token.access_token = access_token
         authz_token.id_token = id_token
         authz_token.scope = token_response.get("scope")
@@ -253,12 +318,15 @@ class SpidCieOidcRpCallbackView(View, SpidCieOidcRp, OidcUserInfo, OAuth2Authori
         authz_token.expires_in = token_response["expires_in"]
         authz_token.save()
 
-        userinfo = self.get_userinfo(
-            authz.state,
-            authz_token.access_token,
-            authz.provider_configuration,
-            verify=HTTPC_PARAMS.get("connection", {}).get("ssl", True)
-        )
+    def login_user(
+        self, request, ctx: dict, token_response: dict, userinfo, timer: StageTimer
+    ) -> HttpResponse:
+        """
+        logs in the user of the userinfo and redirects to LOGIN_REDIRECT_URL
+        """
+        authz = ctx["authz"]
+        authz_token = ctx["authz_token"]
+        decoded_access_token = ctx["decoded_access_token"]
         if not userinfo:
             logger.warning(
                 "Userinfo request failed for state: "
@@ -282,7 +350,8 @@ class SpidCieOidcRpCallbackView(View, SpidCieOidcRp, OidcUserInfo, OAuth2Authori
             }
             return render(request, self.error_template, context, status=403)
 
-        user = self.user_reunification(user_attrs)
+        with timer.stage("user"):
+            user = self.user_reunification(user_attrs)
         if not user:
             # TODO: verify error message and status
             context = {"error": _("No user found"), "error_description": _("")}
@@ -307,8 +376,114 @@ class SpidCieOidcRpCallbackView(View, SpidCieOidcRp, OidcUserInfo, OAuth2Authori
 
         authz_token.user = user
         authz_token.save()
-        return HttpResponseRedirect(
+        response = HttpResponseRedirect(
             getattr(
                 settings, "LOGIN_REDIRECT_URL", None
             ) or reverse("spid_cie_rp_echo_attributes")
         )
+        if RP_STATELESS_AUTHZ:
+            response.delete_cookie(
+                self.get_authz_state_cookie(authz.state),
+                path=request.path,
+            )
+        logger.info(f"Callback of {authz.state} to {authz.provider_id}: {timer}")
+        if RP_SERVER_TIMING:
+            response["Server-Timing"] = timer.as_server_timing()
+        return response
+
+    def get(self, request, *args, **kwargs):
+        """
+            The Authorization callback, the redirect uri where the auth code lands
+        """
+        timer = StageTimer()
+        ctx = self.get_callback_context(request)
+        if isinstance(ctx, HttpResponse):
+            return ctx
+
+        timer.start("token")
+        token_response = self.access_token_request(**self.get_token_request_kwargs(ctx))
+        timer.stop("token")
+        error_response = self.validate_token_response(request, token_response)
+        if error_response:
+            return error_response
+
+        userinfo_kwargs = self.get_userinfo_kwargs(ctx, token_response)
+        userinfo_future = None
+        if RP_CALLBACK_PIPELINE:
+            # the userinfo is requested while the tokens are verified,
+            # it's discarded if they are not valid
+            userinfo_future = _get_userinfo_executor().submit(
+                self.timed_userinfo, timer, **userinfo_kwargs
+            )
+
+        timer.start("verify")
+        error_response = self.verify_tokens(request, ctx, token_response)
+        if error_response:
+            if userinfo_future:
+                # not sent if still queued, the running one is discarded
+                userinfo_future.cancel()
+            return error_response
+        timer.stop("verify")
+
+        if userinfo_future:
+            with timer.stage("userinfo_wait"):
+                userinfo = userinfo_future.result()
+        else:
+            userinfo = self.timed_userinfo(timer, **userinfo_kwargs)
+        return self.login_user(request, ctx, token_response, userinfo, timer)
+
+
+class AsyncSpidCieOidcRpCallbackView(SpidCieOidcRpCallbackView):
+    """
+        As SpidCieOidcRpCallbackView, for the ASGI deployments.
+        The token and userinfo requests are made with the AsyncHttpClient,
+        the DB queries and the token verification run in the sync threads
+    """
+
+    async def get(self, request, *args, **kwargs):
+        """
+            The Authorization callback, the redirect uri where the auth code lands
+        """
+        timer = StageTimer()
+        ctx = await sync_to_async(self.get_callback_context)(request)
+        if isinstance(ctx, HttpResponse):
+            return ctx
+
+        timer.start("token")
+        token_response = await self.aaccess_token_request(
+            **self.get_token_request_kwargs(ctx)
+        )
+        timer.stop("token")
+        error_response = await sync_to_async(self.validate_token_response)(
+            request, token_response
+        )
+        if error_response:
+            return error_response
+
+        userinfo_kwargs = self.get_userinfo_kwargs(ctx, token_response)
+        userinfo_task = None
+        if RP_CALLBACK_PIPELINE:
+            # the userinfo is requested while the tokens are verified,
+            # it's discarded if they are not valid
+            userinfo_task = asyncio.ensure_future(
+                self.atimed_userinfo(timer, **userinfo_kwargs)
+            )
+
+        timer.start("verify")
+        error_response = await sync_to_async(self.verify_tokens)(
+            request, ctx, token_response
+        )
+        if error_response:
+            if userinfo_task:
+                userinfo_task.cancel()
+            return error_response
+        timer.stop("verify")
+
+        if userinfo_task:
+            with timer.stage("userinfo_wait"):
+                userinfo = await userinfo_task
+        else:
+            userinfo = await self.atimed_userinfo(timer, **userinfo_kwargs)
+        return await sync_to_async(self.login_user)(
+            request, ctx, token_response, userinfo, timer
+        )
@@ -62,7 +62,7 @@ class StaffTestingPageView(OpBase, View):
         issuer = self.get_issuer()
         iss_token_data = self.get_iss_token_data(session, issuer)
 
-        IssuedToken.objects.create(**iss_token_data)
+        IssuedToken.issue(**iss_token_data)
         self.payload = session.authz_request
 
         return self.redirect_response_data(